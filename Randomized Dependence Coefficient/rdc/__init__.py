@@ -5,4 +5,4 @@ David Lopez-Paz, Philipp Hennig, Bernhard Schoelkopf
 http://papers.nips.cc/paper/5138-the-randomized-dependence-coefficient.pdf
 """
 
-from .rdc import rdc
+from .rdc import rdc, rdc_batch, copula_transform, check_random_state
@@ -7,7 +7,28 @@ http://papers.nips.cc/paper/5138-the-randomized-dependence-coefficient.pdf
 import numpy as np
 from scipy.stats import rankdata
 
-def rdc(x, y, f=np.sin, k=20, s=1/6., n=1):
+def copula_transform(x):
+    """
+    Computes the empirical copula transformation (ranks / size) of x
+    x:   numpy array 1-D or 2-D
+         If 1-D, size (samples,)
+         If 2-D, size (samples, variables)
+    """
+    x = np.asarray(x)
+    if len(x.shape) == 1: x = x.reshape((-1, 1))
+    return np.column_stack([rankdata(xc, method='ordinal') for xc in x.T])/float(x.size)
+
+def check_random_state(random_state):
+    """
+    Turns random_state into a source of random numbers
+    random_state: None (the global numpy random state), an integer seed
+                  or a numpy.random.RandomState
+    """
+    if random_state is None: return np.random
+    if isinstance(random_state, np.random.RandomState): return random_state
+    return np.random.RandomState(random_state)
+
+def rdc(x, y, f=np.sin, k=20, s=1/6., n=1, cx=None, cy=None, random_state=None):
     """
     Computes the Randomized Dependence Coefficient
     x,y: numpy arrays 1-D or 2-D
@@ -18,24 +39,26 @@ def rdc(x, y, f=np.sin, k=20, s=1/6., n=1):
     s:   scale parameter
     n:   number of times to compute the RDC and
          return the median (for stability)
+    cx,cy: precomputed copula_transform of x and y, e.g. to
+           reuse the transformation of a fixed series
+    random_state: seed or numpy.random.RandomState of the random
+                  projections, None uses the global numpy random state
 
     According to the paper, the coefficient should be relatively insensitive to
     the settings of the f, k, and s parameters.
     """
+    random_state = check_random_state(random_state)
     if n > 1:
         values = []
         for i in range(n):
             try:
-                values.append(rdc(x, y, f, k, s, 1))
+                values.append(rdc(x, y, f, k, s, 1, cx, cy, random_state))
             except np.linalg.linalg.LinAlgError: pass
         return np.median(values)
 
-    if len(x.shape) == 1: x = x.reshape((-1, 1))
-    if len(y.shape) == 1: y = y.reshape((-1, 1))
-
     # Copula Transformation
-    cx = np.column_stack([rankdata(xc, method='ordinal') for xc in x.T])/float(x.size)
-    cy = np.column_stack([rankdata(yc, method='ordinal') for yc in y.T])/float(y.size)
+    if cx is None: cx = copula_transform(x)
+    if cy is None: cy = copula_transform(y)
 
     # Add a vector of ones so that w.x + b is just a dot product
     O = np.ones(cx.shape[0])
@@ -43,8 +66,8 @@ def rdc(x, y, f=np.sin, k=20, s=1/6., n=1):
     Y = np.column_stack([cy, O])
 
     # Random linear projections
-    Rx = (s/X.shape[1])*np.random.randn(X.shape[1], k)
-    Ry = (s/Y.shape[1])*np.random.randn(Y.shape[1], k)
+    Rx = (s/X.shape[1])*random_state.randn(X.shape[1], k)
+    Ry = (s/Y.shape[1])*random_state.randn(Y.shape[1], k)
     X = np.dot(X, Rx)
     Y = np.dot(Y, Ry)
 
@@ -55,6 +78,13 @@ def rdc(x, y, f=np.sin, k=20, s=1/6., n=1):
     # Compute full covariance matrix
     C = np.cov(np.hstack([fX, fY]).T)
 
+    return np.sqrt(np.max(_canonical_correlations(C, k)))
+
+def _canonical_correlations(C, k):
+    """
+    Computes the squared canonical correlations between the first k
+    and the last k variables of the covariance matrix C
+    """
     # Due to numerical issues, if k is too large,
     # then rank(fX) < k or rank(fY) < k, so we need
     # to find the largest k such that the eigenvalues
@@ -87,4 +117,109 @@ def rdc(x, y, f=np.sin, k=20, s=1/6., n=1):
         else:
             k = (ub + lb) // 2
 
-    return np.sqrt(np.max(eigs))
+    return eigs
+
+def rdc_batch(x, Y, f=np.sin, k=20, s=1/6., n=1, cx=None, chunk_size=1024,
+              random_state=None):
+    """
+    Computes the Randomized Dependence Coefficient between x and every
+    column of Y at once
+    x:   numpy array 1-D or 2-D, size (samples,) or (samples, variables)
+    Y:   numpy array 2-D, size (samples, series), every column is a
+         univariate variable
+    f,k,s,n: see rdc
+    cx:  precomputed copula_transform of x
+    chunk_size: number of columns of Y processed at once
+    random_state: seed or numpy.random.RandomState of the random
+                  projections, None uses the global numpy random state
+
+    The copula and the random projection of x and one random projection
+    for all columns of Y are computed once, the canonical correlations of
+    all columns with batched linear algebra. With the same random_state,
+    rdc(x, Y[:, i]) draws the same projections, but its covariances are
+    computed differently, and the search for k on nearly singular
+    covariance matrices can end at a different value. Use rdc_batch for
+    single columns too to get identical coefficients.
+    """
+    random_state = check_random_state(random_state)
+    if n > 1:
+        values = [rdc_batch(x, Y, f, k, s, 1, cx, chunk_size, random_state)
+                  for i in range(n)]
+        return np.nanmedian(values, axis=0)
+
+    Y = np.asarray(Y)
+    if cx is None: cx = copula_transform(x)
+    # Copula transformation of all columns, ordinal ranks like rankdata
+    cY = np.argsort(np.argsort(Y, axis=0, kind='mergesort'), axis=0,
+                    kind='mergesort') + 1.
+    cY /= float(Y.shape[0])
+
+    O = np.ones(cx.shape[0])
+    X = np.column_stack([cx, O])
+    Rx = (s/X.shape[1])*random_state.randn(X.shape[1], k)
+    Ry = (s/2.)*random_state.randn(2, k)
+    fX = f(np.dot(X, Rx))
+    fX -= fX.mean(axis=0)
+    Cxx = np.dot(fX.T, fX)/(Y.shape[0] - 1)
+    Cxx_inv = np.linalg.pinv(Cxx)
+
+    values = np.empty(Y.shape[1])
+    for start in range(0, Y.shape[1], chunk_size):
+        # Random projection of (cy, 1) for every column at once
+        fY = f(cY[:, start:start + chunk_size, None]*Ry[0] + Ry[1])
+        fY -= fY.mean(axis=0)
+        fY = np.transpose(fY, (1, 0, 2))
+        Cyy = np.matmul(np.transpose(fY, (0, 2, 1)), fY)/(Y.shape[0] - 1)
+        Cxy = np.matmul(fX.T, fY)/(Y.shape[0] - 1)
+        values[start:start + chunk_size] = np.sqrt(
+            _batched_canonical_correlations(Cxx, Cxy, Cyy, k))
+
+    return values
+
+def _batched_canonical_correlations(Cxx, Cxy, Cyy, k):
+    """
+    Computes the largest squared canonical correlation like
+    _canonical_correlations for a batch of covariance matrices
+    Cxx: covariance matrix (k, k) of the projections of x
+    Cxy,Cyy: covariance matrices (batch, k, k) of the projections of x and y
+             and of the projections of y
+
+    Every element of the batch runs the binary search of
+    _canonical_correlations; the elements that currently try the same k
+    are computed together.
+    """
+    n = Cxy.shape[0]
+    ks = np.full(n, k)
+    lbs = np.ones(n, dtype=int)
+    ubs = np.full(n, k)
+    active = np.ones(n, dtype=bool)
+    largest = np.full(n, np.nan)
+    while np.any(active):
+        for kk in np.unique(ks[active]):
+            batch = np.flatnonzero(active & (ks == kk))
+            if kk < 1:
+                active[batch] = False
+                continue
+            Cxy_k = Cxy[batch, :kk, :kk]
+            eigs = np.linalg.eigvals(np.matmul(
+                np.matmul(np.linalg.pinv(Cxx[:kk, :kk]), Cxy_k),
+                np.matmul(np.linalg.pinv(Cyy[batch, :kk, :kk]),
+                          np.transpose(Cxy_k, (0, 2, 1)))))
+            valid = (np.all(np.isreal(eigs), axis=1) &
+                     (np.min(eigs.real, axis=1) >= 0) &
+                     (np.max(eigs.real, axis=1) <= 1))
+
+            # Binary search if k is too large
+            invalid = batch[~valid]
+            ubs[invalid] -= 1
+            ks[invalid] = (ubs[invalid] + lbs[invalid]) // 2
+
+            batch = batch[valid]
+            largest[batch] = np.max(eigs[valid].real, axis=1)
+            found = lbs[batch] == ubs[batch]
+            active[batch[found]] = False
+            batch = batch[~found]
+            lbs[batch] = ks[batch]
+            ks[batch] = np.where(ubs[batch] == lbs[batch] + 1, ubs[batch],
+                                 (ubs[batch] + lbs[batch]) // 2)
+    return largest
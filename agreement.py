@@ -0,0 +1,201 @@
+"""
+Module to compute where similarity measures agree on dependencies
+
+The similarity maps of several measures are stacked (measure, latitude, longitude) and scaled
+once. A summary map (the mean) and an agreement map (e.g. the standard deviation or the entropy
+over the measures) are filtered with all value and agreement thresholds at once by broadcasting,
+which gives a (value threshold, agreement threshold, latitude, longitude) boolean cube. The cube
+can be stored bit-packed with PackedCube, 8 points per byte.
+"""
+import numpy as np
+from scipy.special import entr
+import comparing as comp
+
+#Scaling functions that scale every map of a stack in one call with their axis argument
+STACK_SCALINGS = [comp.binning_values_to_quantiles, comp.min_max_normalization]
+
+#Number of set bits of every byte
+_BIT_COUNTS = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+class PackedCube:
+    """
+    Boolean array stored bit-packed along its last dimension
+
+    Attributes:
+        shape (tuple): Shape of the boolean array
+        bits (numpy.ndarray): Packed bits, see numpy.packbits
+    """
+    def __init__(self, cube):
+        cube = np.asarray(cube, dtype=bool)
+        self.shape = cube.shape
+        self.bits = np.packbits(cube, axis=-1)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        """
+        Unpack a part of the array
+
+        Args:
+            key: Index along the dimensions except the last one, e.g. (value threshold,
+                 agreement threshold)
+
+        Returns:
+            numpy.ndarray of booleans
+        """
+        return np.unpackbits(self.bits[key], axis=-1, count=self.shape[-1]).astype(bool)
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def unpack(self):
+        """
+        Returns:
+            numpy.ndarray of booleans with the whole array
+        """
+        return self[...]
+
+    def count(self, axis=(-2, -1)):
+        """
+        Count the true values without unpacking
+
+        Args:
+            axis (tuple, optional): Axes to count over, must include the last one
+                Defaults to (-2, -1) (the points of every map)
+
+        Returns:
+            numpy.ndarray with the number of true values
+        """
+        return _BIT_COUNTS[self.bits].sum(axis=axis, dtype=np.int64)
+
+
+def scale_similarities(similarities, scaling_func=comp.binning_values_to_quantiles):
+    """
+    Scale every map of a stack of similarity maps to make them comparable
+
+    Args:
+        similarities (numpy.ndarray): Similarity maps with dimensions measure, latitude, longitude
+        scaling_func (function, optional): Function that takes a map of similarity values and
+                                           scales it. Functions of STACK_SCALINGS scale the whole
+                                           stack in one call.
+            Defaults to comp.binning_values_to_quantiles
+
+    Returns:
+        numpy.ndarray with the scaled similarity maps
+    """
+    similarities = np.asarray(similarities, dtype=float)
+    if scaling_func in STACK_SCALINGS:
+        return scaling_func(similarities, axis=tuple(range(1, similarities.ndim)))
+    return np.array([scaling_func(similarity) for similarity in similarities], dtype=float)
+
+
+def std_agreement(similarities, axis=0):
+    """
+    Compute the agreement of similarity maps as their standard deviation, lower is more agreement
+
+    Args:
+        similarities (numpy.ndarray): Similarity maps with dimensions measure, latitude, longitude
+        axis (int, optional): Measure dimension
+            Defaults to 0
+
+    Returns:
+        numpy.ndarray with the agreement of every point
+    """
+    return np.std(similarities, axis=axis)
+
+
+def entropy_agreement(similarities, axis=0):
+    """
+    Compute the agreement of similarity maps as the entropy of the normalized similarity values
+    of every point, like scipy.stats.entropy. Higher is more agreement, the maximum log(number
+    of measures) is reached for equal values.
+
+    Args:
+        similarities (numpy.ndarray): Non-negative similarity maps with dimensions measure,
+                                      latitude, longitude
+        axis (int, optional): Measure dimension
+            Defaults to 0
+
+    Returns:
+        numpy.ndarray with the agreement of every point
+    """
+    similarities = np.asarray(similarities, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        probabilities = similarities / similarities.sum(axis=axis, keepdims=True)
+    return entr(probabilities).sum(axis=axis)
+
+
+def filter_thresholds(map_array, thresholds, high=True):
+    """
+    Filter a map with every threshold at once, see calculations.filter_map
+
+    Args:
+        map_array (numpy.ndarray): Map of values
+        thresholds (list): Thresholds
+        high (bool, optional): If True values >= threshold are kept, else values < threshold
+            Defaults to True
+
+    Returns:
+        numpy.ndarray of booleans with dimensions threshold and the dimensions of map_array
+    """
+    map_array = np.asarray(map_array)
+    thresholds = np.asarray(thresholds, dtype=float).reshape((-1,) + (1,) * map_array.ndim)
+    return map_array >= thresholds if high else map_array < thresholds
+
+
+def agreement_areas(mean_map, agreement_map, value_thresholds, agreement_thresholds,
+                    filter_values_high=True, filter_agreement_high=False, packed=False):
+    """
+    Find the points that satisfy both a value threshold and an agreement threshold for every
+    combination of thresholds
+
+    Args:
+        mean_map (numpy.ndarray): Summary map of the similarity values
+        agreement_map (numpy.ndarray): Map of the agreement between the similarity measures
+        value_thresholds (list): Thresholds to filter the summary values on
+        agreement_thresholds (list): Thresholds to filter the agreement on
+        filter_values_high (bool, optional): Keep summary values >= (True) or < (False) the
+                                             thresholds
+            Defaults to True
+        filter_agreement_high (bool, optional): Keep agreement values >= (True) or < (False) the
+                                                thresholds
+            Defaults to False
+        packed (bool, optional): Return a PackedCube
+            Defaults to False
+
+    Returns:
+        numpy.ndarray of booleans (or PackedCube) with dimensions value threshold, agreement
+        threshold, latitude, longitude
+    """
+    values = filter_thresholds(mean_map, value_thresholds, filter_values_high)
+    agreements = filter_thresholds(agreement_map, agreement_thresholds, filter_agreement_high)
+    cube = values[:, np.newaxis] & agreements[np.newaxis]
+    return PackedCube(cube) if packed else cube
+
+
+def level_of_agreement(similarities, scoring_func):
+    """
+    Compute the fraction of similarity measures that score a dependency at every point
+
+    Args:
+        similarities (numpy.ndarray): Scaled similarity maps with dimensions measure, latitude,
+                                      longitude
+        scoring_func (function): Function that takes values and outputs booleans (whether there
+                                 is a dependency or not), e.g. lambda x: x >= 0.8. It is applied
+                                 to the whole stack, functions that only take single values are
+                                 applied value by value.
+
+    Returns:
+        numpy.ndarray with the fraction of measures for every point
+    """
+    similarities = np.asarray(similarities, dtype=float)
+    try:
+        votes = np.asarray(scoring_func(similarities))
+    except (TypeError, ValueError): #E.g. "and" of arrays
+        votes = None
+    if votes is None or votes.shape != similarities.shape:
+        votes = np.vectorize(scoring_func)(similarities)
+    return np.mean(votes, axis=0)
@@ -0,0 +1,267 @@
+"""
+Module with a persistent on-disk cache for similarity maps
+
+Similarity maps are stored as compressed .npz files, named by a hash of everything that
+determines them: the dataset, the level, the reference series and the similarity measure
+including its parameters. When the cache grows beyond its maximal size, the least recently
+used maps are removed.
+
+To let calculations.calculate_series_similarity (and all plots using it) use a cache, enable
+it once per session:
+
+    caching.enable_cache("data/cache")
+"""
+import functools
+import hashlib
+import os
+import numpy as np
+
+#Change to invalidate all cached maps, e.g. when a similarity measure is changed
+CACHE_VERSION = 2
+
+_default_cache = None
+
+
+class SimilarityCache:
+    """
+    Content-addressed cache of similarity maps in a directory
+
+    Attributes:
+        directory (str): Directory the maps are stored in
+        max_size (int): Maximal size of the cache in bytes
+    """
+    def __init__(self, directory, max_size=2 * 1024 ** 3):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, map_array, reference_series, level, sim_func):
+        """
+        Compute the key of a similarity map
+
+        Args:
+            map_array (numpy.ndarray): Map with 4 dimensions - time, level, latitude, longitude
+            reference_series (numpy.ndarray): 1 dimensional reference series
+            level (int): Level on which the similarity is calculated
+            sim_func (function): Similarity measure
+
+        Returns:
+            Hexadecimal hash identifying the similarity map
+        """
+        return self._key(fingerprint_dataset(map_array, level), reference_series, level, sim_func)
+
+    def get(self, key):
+        """
+        Load a similarity map and mark it as recently used
+
+        Args:
+            key (str): Key of the map
+
+        Returns:
+            numpy.ndarray with the map or None if the map is not in the cache
+        """
+        filename = self._filename(key)
+        try:
+            with np.load(filename) as stored:
+                similarity = stored["similarity"]
+        except (IOError, KeyError, ValueError):
+            return None
+        os.utime(filename, None)
+        return similarity
+
+    def put(self, key, similarity):
+        """
+        Store a similarity map and evict the least recently used maps if the cache is too large
+
+        Args:
+            key (str): Key of the map
+            similarity (numpy.ndarray): Similarity map
+        """
+        filename = self._filename(key)
+        temporary = "{}.{}.tmp.npz".format(filename[:-len(".npz")], os.getpid())
+        np.savez_compressed(temporary, similarity=np.asarray(similarity))
+        os.replace(temporary, filename)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used maps until the cache is not larger than max_size
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz") and ".tmp" not in name:
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        size = sum(entry[1] for entry in entries)
+        for (_, entry_size, name) in sorted(entries):
+            if size <= self.max_size:
+                break
+            os.remove(os.path.join(self.directory, name))
+            size -= entry_size
+
+    def clear(self):
+        """
+        Remove all maps from the cache
+        """
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz"):
+                os.remove(os.path.join(self.directory, name))
+
+    def calculate_series_similarities(self, map_array, reference_series, measures, level, calculate):
+        """
+        Look up the similarity maps of several measures and calculate only the missing ones
+
+        Args:
+            map_array (numpy.ndarray): Map with 4 dimensions - time, level, latitude, longitude
+            reference_series (numpy.ndarray): 1 dimensional reference series
+            measures (list): List of similarity measures
+            level (int): Level on which the similarity is calculated
+            calculate (function): Function that takes a list of measures and returns the stack
+                                  of their similarity maps
+
+        Returns:
+            3 dimensional numpy.ndarray with dimensions measure, latitude, longitude
+        """
+        dataset = fingerprint_dataset(map_array, level)
+        keys = [self._key(dataset, reference_series, level, measure) for measure in measures]
+        cached = [self.get(key) for key in keys]
+        missing = [i for i, similarity in enumerate(cached) if similarity is None]
+
+        if missing:
+            calculated = calculate([measures[i] for i in missing])
+            for i, similarity in zip(missing, calculated):
+                self.put(keys[i], similarity)
+                cached[i] = similarity
+        return np.array(cached)
+
+    def _key(self, dataset, reference_series, level, sim_func):
+        digest = hashlib.sha1()
+        for part in (str(CACHE_VERSION), dataset, str(level), _hash_array(reference_series),
+                     describe_function(sim_func)):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+
+def enable_cache(directory, max_size=2 * 1024 ** 3):
+    """
+    Use a cache for all similarity maps calculated with calculations.calculate_series_similarity
+    and calculations.calculate_series_similarities
+
+    Args:
+        directory (str): Directory the maps are stored in
+        max_size (int, optional): Maximal size of the cache in bytes
+            Defaults to 2 GiB
+
+    Returns:
+        The enabled SimilarityCache
+    """
+    global _default_cache # pylint: disable=W0603
+    _default_cache = SimilarityCache(directory, max_size)
+    return _default_cache
+
+
+def disable_cache():
+    """
+    Stop using the cache enabled with enable_cache
+    """
+    global _default_cache # pylint: disable=W0603
+    _default_cache = None
+
+
+def get_default_cache():
+    """
+    Returns:
+        SimilarityCache enabled with enable_cache or None
+    """
+    return _default_cache
+
+
+def fingerprint_dataset(map_array, level=None):
+    """
+    Identify the values of a map
+
+    A datasets.LazyMap is identified by its file (path, size and modification time) and its
+    selection, so the values do not have to be read. Other arrays are identified by a hash of
+    their values, only of the given level if there is one.
+
+    Args:
+        map_array (numpy.ndarray): Map
+        level (int, optional): Level of a map with 4 dimensions - time, level, latitude, longitude
+            Defaults to None (the whole map)
+
+    Returns:
+        String identifying the map
+    """
+    if hasattr(map_array, "fingerprint"):
+        return map_array.fingerprint()
+    if level is not None:
+        map_array = map_array[:, level]
+    return _hash_array(map_array)
+
+
+def describe_function(func):
+    """
+    Describe a similarity measure including its parameters
+
+    Covers functools.partial objects, default arguments and the variables closures capture
+    (e.g. the measure wrapped by comparing.invert).
+
+    Args:
+        func (function): Similarity measure
+
+    Returns:
+        String describing the function
+    """
+    if isinstance(func, functools.partial):
+        return "partial({}, {!r}, {!r})".format(describe_function(func.func), func.args,
+                                                sorted(func.keywords.items()))
+    name = "{}.{}".format(getattr(func, "__module__", ""),
+                          getattr(func, "__qualname__", type(func).__name__))
+    code = getattr(func, "__code__", None)
+    if code is None:
+        return name
+    parts = [name, hashlib.sha1(code.co_code).hexdigest(), _describe_constants(code.co_consts),
+             repr(func.__defaults__),
+             repr(sorted((func.__kwdefaults__ or {}).items()))]
+    for cell in func.__closure__ or ():
+        value = cell.cell_contents
+        parts.append(describe_function(value) if callable(value) else repr(value))
+    return "|".join(parts)
+
+
+def _describe_constants(constants):
+    """
+    Returns:
+        String describing the constants of a code object, including those of nested functions
+    """
+    parts = []
+    for constant in constants:
+        if hasattr(constant, "co_consts"):
+            parts.append(_describe_constants(constant.co_consts + (constant.co_code,)))
+        elif isinstance(constant, frozenset): #Order of sets changes with the hash seed
+            parts.append(repr(sorted(constant, key=repr)))
+        else:
+            parts.append(repr(constant))
+    return "[{}]".format(", ".join(parts))
+
+
+def _hash_array(array):
+    """
+    Hash the shape, type and values of an array
+
+    Args:
+        array (numpy.ndarray): Array to hash
+
+    Returns:
+        Hexadecimal hash
+    """
+    #Hashed in its own type, converting a large map would copy it
+    array = np.ascontiguousarray(array)
+    digest = hashlib.sha1("{}{}".format(array.shape, array.dtype.str).encode("utf-8"))
+    digest.update(array.data)
+    return digest.hexdigest()
+
@@ -2,11 +2,20 @@
     TODO: Module Docstring
 """
 
+import os
+import shutil
+import tempfile
 import numpy as np
 import pandas as pd # pylint: disable=E0401
-from joblib import Parallel, delayed # pylint: disable=E0401
+import agreement
+import caching
+import climatology
 import comparing as comp
+import execution as exe
+import grid
+import lags as lag_measures
 import similarity_measures
+import windows
 
 def calculate_pointwise_similarity(map_array, lat, lon, level=0,
                                    sim_func=similarity_measures.pearson_correlation):
@@ -25,36 +34,498 @@ def calculate_pointwise_similarity(map_array, lat, lon, level=0,
     Returns:
         2 dimensional numpy.ndarray with similarity values to reference point
     """
-    len_time = map_array.shape[0]
-    reference_series = np.array([map_array[time, level, lat, lon] for time in range(len_time)])
+    reference_series = np.array(map_array[:, level, lat, lon])
     return calculate_series_similarity(map_array, reference_series, level, sim_func)
 
 
 def calculate_series_similarity(map_array, reference_series, level=0,
-                                sim_func=similarity_measures.pearson_correlation):
+                                sim_func=similarity_measures.pearson_correlation, chunk_size=None,
+                                out=None, execution=None, cache=None):
     """
     Calculate similarity of all points on a map to a reference series
 
+    If sim_func has a vectorized counterpart (see similarity_measures.MAP_MEASURES), the whole map
+    is computed in one NumPy operation. Otherwise the similarity is computed point by point as
+    configured by execution.
+
+    If chunk_size or out is given, the map is processed out-of-core in tiles, see
+    calculate_series_similarity_in_tiles. If a cache is used, the map is only calculated if it is
+    not cached yet.
+
     Args:
         map_array (numpy.ndarray): Map with 4 dimensions - time, level, latitude, longitude
+                                   (e.g. a datasets.LazyMap, of which only level is read)
         referenceSeries (numpy.ndarray): 1 dimensional reference series
         level (int, optional): Level on which the similarity should be calculated
             Defaults to 0
         sim_func (str, optional): The similarity function that should be used.
             Defaults to Pearon's Correlation Coefficient.
+        chunk_size (int or tuple, optional): Size of the tiles - number of latitudes or
+                                             (number of latitudes, number of longitudes)
+            Defaults to None (whole map at once)
+        out (numpy.ndarray, optional): Preallocated 2 dimensional array (e.g. a numpy.memmap)
+                                       the similarity values are written to
+            Defaults to None
+        execution (execution.Execution, optional): Backend, number of workers and number of
+                                                   points per task of the point-wise computation
+            Defaults to None (chosen by execution.default_execution)
+        cache (caching.SimilarityCache, optional): Cache of similarity maps
+            Defaults to None (the cache enabled with caching.enable_cache, if any)
 
     Returns:
         2 dimensional numpy.ndarray with similarity values to reference point
     """
+    if cache is None:
+        cache = caching.get_default_cache()
+    if chunk_size is not None or out is not None or cache is not None:
+        return calculate_series_similarity_in_tiles(map_array, reference_series, level, sim_func,
+                                                    chunk_size, out, execution, cache)
+
     map_array = map_array[:, level, :, :] #Eliminate level dimension
-    (len_latitude, len_longitude) = map_array.shape[1:]
-    sim = np.zeros((len_latitude, len_longitude))
+    return _calculate_similarity_of_block(map_array, reference_series, sim_func, execution)
+
+
+def calculate_series_similarity_in_tiles(map_array, reference_series, level=0,
+                                         sim_func=similarity_measures.pearson_correlation,
+                                         chunk_size=16, out=None, execution=None, cache=None):
+    """
+    Calculate similarity of all points on a map to a reference series, one spatial tile at a time
+
+    Each tile is read from map_array, computed and written into out before the next tile is read.
+    With a lazily loaded map (e.g. datasets.LazyMap or numpy.memmap) and a memory-mapped output
+    the peak memory therefore only depends on the tile size, not on the size of the map:
+
+        out = np.lib.format.open_memmap("similarity.npy", mode="w+", dtype=float,
+                                        shape=map_array.shape[2:])
+        calculate_series_similarity_in_tiles(map_array, reference_series, level, sim_func, 16, out)
+
+    Args:
+        map_array (numpy.ndarray): Map with 4 dimensions - time, level, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        level (int, optional): Level on which the similarity should be calculated
+            Defaults to 0
+        sim_func (function, optional): The similarity function that should be used.
+            Defaults to Pearson's Correlation Coefficient.
+        chunk_size (int or tuple, optional): Size of the tiles - number of latitudes or
+                                             (number of latitudes, number of longitudes)
+            Defaults to 16
+        out (numpy.ndarray, optional): Preallocated 2 dimensional array the similarity values
+                                       are written to
+            Defaults to None (a new array is allocated)
+        execution (execution.Execution, optional): Execution of the point-wise computation of
+                                                   each tile
+            Defaults to None (chosen by execution.default_execution)
+        cache (caching.SimilarityCache, optional): Cache of similarity maps
+            Defaults to None (the cache enabled with caching.enable_cache, if any)
+
+    Returns:
+        2 dimensional numpy.ndarray (out, if given) with similarity values to reference series
+    """
+    stacked_out = None if out is None else out[np.newaxis, :, :]
+    sim = calculate_series_similarities(map_array, reference_series, [sim_func], level,
+                                        chunk_size, stacked_out, execution, cache)
+    return sim[0] if out is None else out
+
+
+def calculate_series_similarities(map_array, reference_series, measures, level=0, chunk_size=None,
+                                  out=None, execution=None, cache=None):
+    """
+    Calculate similarity of all points on a map to a reference series with several similarity
+    measures in a single pass over the map
+
+    Every tile of the map is read once and evaluated with all measures: measures with a vectorized
+    counterpart (see similarity_measures.MAP_MEASURES) on the whole tile, the others point by point
+    in one dispatch to the workers that computes all of them per point. If a cache is used, only
+    the measures whose maps are not cached yet are calculated.
+
+    Args:
+        map_array (numpy.ndarray): Map with 4 dimensions - time, level, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        measures (list): List of similarity measures to compute similarity between two time series
+        level (int, optional): Level on which the similarity should be calculated
+            Defaults to 0
+        chunk_size (int or tuple, optional): Size of the tiles - number of latitudes or
+                                             (number of latitudes, number of longitudes)
+            Defaults to None (whole map at once)
+        out (numpy.ndarray, optional): Preallocated 3 dimensional array (e.g. a numpy.memmap)
+                                       with dimensions measure, latitude, longitude the similarity
+                                       values are written to
+            Defaults to None (a new array is allocated)
+        execution (execution.Execution, optional): Execution of the point-wise computation
+            Defaults to None (chosen by execution.default_execution)
+        cache (caching.SimilarityCache, optional): Cache of similarity maps
+            Defaults to None (the cache enabled with caching.enable_cache, if any)
+
+    Returns:
+        3 dimensional numpy.ndarray (out, if given) with dimensions measure, latitude, longitude
+    """
+    if cache is None:
+        cache = caching.get_default_cache()
+    if cache is not None:
+        sim = cache.calculate_series_similarities(
+            map_array, reference_series, measures, level,
+            lambda missing: _calculate_series_similarities(map_array, reference_series, missing,
+                                                           level, chunk_size, None, execution))
+        if out is None:
+            return sim
+        out[:] = sim
+        return out
+
+    return _calculate_series_similarities(map_array, reference_series, measures, level, chunk_size,
+                                          out, execution)
+
+
+def _calculate_series_similarities(map_array, reference_series, measures, level=0, chunk_size=None,
+                                   out=None, execution=None):
+    """
+    Calculate similarity of all points on a map to a reference series with several similarity
+    measures in a single pass over the map, without using a cache
+
+    See calculate_series_similarities for the arguments.
+
+    Returns:
+        3 dimensional numpy.ndarray (out, if given) with dimensions measure, latitude, longitude
+    """
+    (len_latitude, len_longitude) = map_array.shape[2:]
+    if out is None:
+        out = np.zeros((len(measures), len_latitude, len_longitude))
+
+    #Shared by all tiles, so derived values of the reference series are only computed once
+    reference_series = similarity_measures.prepare_reference(reference_series)
+
+    for (lat_slice, lon_slice) in _tiles(len_latitude, len_longitude, chunk_size):
+        tile = np.asarray(map_array[:, level, lat_slice, lon_slice])
+        out[:, lat_slice, lon_slice] = _calculate_similarities_of_block(tile, reference_series,
+                                                                        measures, execution)
+    return out
+
+
+def calculate_series_similarity_volume(map_array, reference_series, levels=None,
+                                       sim_func=similarity_measures.pearson_correlation,
+                                       chunk_size=None, level_chunk_size=1, out=None,
+                                       execution=None):
+    """
+    Calculate similarity of all points on several levels of a map to a reference series
+
+    See calculate_series_similarities_volume.
+
+    Args:
+        map_array (numpy.ndarray): Map with 4 dimensions - time, level, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        levels (list, optional): Indices of the levels, e.g. found with datasets.LazyMap.level_index
+            Defaults to None (all levels)
+        sim_func (function, optional): The similarity function that should be used
+            Defaults to similarity_measures.pearson_correlation
+        chunk_size (int or tuple, optional): Size of the tiles, see calculate_series_similarities
+            Defaults to None (whole map at once)
+        level_chunk_size (int, optional): Number of levels read at once
+            Defaults to 1
+        out (numpy.ndarray, optional): Preallocated 3 dimensional array (e.g. a numpy.memmap)
+                                       with dimensions level, latitude, longitude
+            Defaults to None (a new array is allocated)
+        execution (execution.Execution, optional): Execution of the point-wise computation
+            Defaults to None (chosen by execution.default_execution)
+
+    Returns:
+        3 dimensional numpy.ndarray (out, if given) with dimensions level, latitude, longitude
+    """
+    stacked_out = None if out is None else out[np.newaxis]
+    sim = calculate_series_similarities_volume(map_array, reference_series, [sim_func], levels,
+                                               chunk_size, level_chunk_size, stacked_out, execution)
+    return sim[0] if out is None else out
+
+
+def calculate_series_similarities_volume(map_array, reference_series, measures, levels=None,
+                                         chunk_size=None, level_chunk_size=1, out=None,
+                                         execution=None):
+    """
+    Calculate similarity of all points on several levels of a map to a reference series with
+    several similarity measures in a single pass over the map
+
+    The levels are read in chunks of level_chunk_size levels and tiles of chunk_size, e.g. from a
+    datasets.LazyMap with 37 pressure levels. The reference series is prepared once and the
+    execution of the point-wise measures is chosen once for the whole volume, so all levels share
+    the workers. The levels of a chunk are stacked along the latitude, so every measure evaluates
+    them in one NumPy operation or one dispatch to the workers.
+
+    Args:
+        map_array (numpy.ndarray): Map with 4 dimensions - time, level, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        measures (list): List of similarity measures to compute similarity between two time series
+        levels (list, optional): Indices of the levels, e.g. found with datasets.LazyMap.level_index
+            Defaults to None (all levels)
+        chunk_size (int or tuple, optional): Size of the tiles, see calculate_series_similarities
+            Defaults to None (whole map at once)
+        level_chunk_size (int, optional): Number of levels read at once
+            Defaults to 1
+        out (numpy.ndarray, optional): Preallocated 4 dimensional array (e.g. a numpy.memmap)
+                                       with dimensions measure, level, latitude, longitude
+            Defaults to None (a new array is allocated)
+        execution (execution.Execution, optional): Execution of the point-wise computation
+            Defaults to None (chosen by execution.default_execution)
+
+    Returns:
+        4 dimensional numpy.ndarray (out, if given) with dimensions measure, level, latitude,
+        longitude
+    """
+    (len_time, len_level, len_latitude, len_longitude) = map_array.shape
+    levels = np.arange(len_level) if levels is None else np.atleast_1d(levels)
+    if out is None:
+        out = np.zeros((len(measures), len(levels), len_latitude, len_longitude))
+
+    #Shared by all levels and tiles, so derived values of the reference series are only
+    #computed once
+    reference_series = similarity_measures.prepare_reference(reference_series)
+    pointwise = [measure for measure in measures
+                 if similarity_measures.get_map_measure(measure) is None]
+    if execution is None and pointwise:
+        execution = exe.default_execution(pointwise, len(levels) * len_latitude * len_longitude,
+                                          len_time)
+
+    for level_start in range(0, len(levels), level_chunk_size):
+        level_chunk = levels[level_start:level_start + level_chunk_size].tolist()
+        level_slice = slice(level_start, level_start + len(level_chunk))
+        for (lat_slice, lon_slice) in _tiles(len_latitude, len_longitude, chunk_size):
+            tile = np.asarray(map_array[:, level_chunk, lat_slice, lon_slice])
+            (_, n_levels, tile_latitude, tile_longitude) = tile.shape
+            sim = _calculate_similarities_of_block(
+                tile.reshape(len_time, n_levels * tile_latitude, tile_longitude),
+                reference_series, measures, execution)
+            out[:, level_slice, lat_slice, lon_slice] = sim.reshape(len(measures), n_levels,
+                                                                   tile_latitude, tile_longitude)
+    return out
+
+
+def calculate_lagged_similarity(map_array, reference_series, lags, level=0,
+                                sim_func=similarity_measures.pearson_correlation, chunk_size=None,
+                                execution=None, maximize=True):
+    """
+    Calculate similarity of all points on a map to a reference series shifted by every time lag
+    and find the lag of the highest similarity
+
+    Args:
+        map_array (numpy.ndarray): Map with 4 dimensions - time, level, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        lags (list): Time lags the reference series is shifted by, see shift
+        level (int, optional): Level on which the similarity should be calculated
+            Defaults to 0
+        sim_func (function, optional): The similarity function that should be used
+            Defaults to similarity_measures.pearson_correlation
+        chunk_size (int or tuple, optional): Size of the tiles, see calculate_series_similarities
+            Defaults to None (whole map at once)
+        execution (execution.Execution, optional): Execution of the point-wise computation
+            Defaults to None (chosen by execution.default_execution)
+        maximize (bool, optional): True if the best lag has the highest value, False for
+                                   distances
+            Defaults to True
+
+    Returns:
+        Tuple of the similarities with dimensions lag, latitude, longitude, the map of the best
+        lags and the map of the similarity at the best lag
+    """
+    sim = calculate_lagged_similarities(map_array, reference_series, lags, [sim_func], level,
+                                        chunk_size, execution)[0]
+    (best_lag, best_value) = lag_measures.best_lags(sim, lags, maximize)
+    return sim, best_lag, best_value
+
+
+def calculate_lagged_similarities(map_array, reference_series, lags, measures, level=0,
+                                  chunk_size=None, execution=None):
+    """
+    Calculate similarity of all points on a map to a reference series shifted by every time lag
+    with several similarity measures in a single pass over the map
+
+    Every tile of the map is read once. Measures with a counterpart in lags.LAG_MEASURES compute
+    all lags at once from the tile, e.g. Pearson's correlation with one FFT cross-correlation.
+    The others are computed for each shifted reference series like calculate_series_similarities.
+
+    Args:
+        map_array (numpy.ndarray): Map with 4 dimensions - time, level, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        lags (list): Time lags the reference series is shifted by, see shift
+        measures (list): List of similarity measures to compute similarity between two time series
+        level (int, optional): Level on which the similarity should be calculated
+            Defaults to 0
+        chunk_size (int or tuple, optional): Size of the tiles, see calculate_series_similarities
+            Defaults to None (whole map at once)
+        execution (execution.Execution, optional): Execution of the point-wise computation
+            Defaults to None (chosen by execution.default_execution)
+
+    Returns:
+        4 dimensional numpy.ndarray with dimensions measure, lag, latitude, longitude
+    """
+    (len_latitude, len_longitude) = map_array.shape[2:]
+    sim = np.zeros((len(measures), len(lags), len_latitude, len_longitude))
+
+    lag_funcs = [lag_measures.get_lag_measure(measure) for measure in measures]
+    swept = [i for (i, lag_func) in enumerate(lag_funcs) if lag_func is not None]
+    shifted = [i for (i, lag_func) in enumerate(lag_funcs) if lag_func is None]
+    shifted_measures = [measures[i] for i in shifted]
+    #Shared by all tiles, so derived values of the reference series are only computed once
+    references = [similarity_measures.prepare_reference(lag_measures.shift(reference_series, lag))
+                  for lag in lags] if shifted else []
+
+    for (lat_slice, lon_slice) in _tiles(len_latitude, len_longitude, chunk_size):
+        tile = np.asarray(map_array[:, level, lat_slice, lon_slice])
+        for i in swept:
+            sim[i, :, lat_slice, lon_slice] = lag_funcs[i](tile, reference_series, lags)
+        for (j, reference) in enumerate(references):
+            sim[shifted, j, lat_slice, lon_slice] = _calculate_similarities_of_block(
+                tile, reference, shifted_measures, execution)
+    return sim
+
+
+def _tiles(len_latitude, len_longitude, chunk_size=None):
+    """
+    Split a map into tiles
+
+    Args:
+        len_latitude (int): Number of latitudes
+        len_longitude (int): Number of longitudes
+        chunk_size (int or tuple, optional): Size of the tiles - number of latitudes or
+                                             (number of latitudes, number of longitudes)
+            Defaults to None (one tile)
 
-    sim[:, :] = Parallel(n_jobs=-1)(delayed(calculate_series_similarity_on_latitude)
-                                    (map_array[:, lat, :], reference_series, sim_func)
-                                    for lat in range(len_latitude))
+    Returns:
+        List of (latitude slice, longitude slice) tuples
+    """
+    if chunk_size is None:
+        chunk_size = len_latitude
+    (tile_latitude, tile_longitude) = (np.broadcast_to(chunk_size, 2) if np.ndim(chunk_size)
+                                       else (chunk_size, len_longitude))
+    return [(slice(lat_start, min(lat_start + tile_latitude, len_latitude)),
+             slice(lon_start, min(lon_start + tile_longitude, len_longitude)))
+            for lat_start in range(0, len_latitude, tile_latitude)
+            for lon_start in range(0, len_longitude, tile_longitude)]
+
+
+def _calculate_similarity_of_block(map_array, reference_series, sim_func, execution=None):
+    """
+    Calculate similarity of all points of a block of the map to a reference series
+
+    Args:
+        map_array (numpy.ndarray): Map with 3 dimensions - time, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        sim_func (function): The similarity function that should be used
+        execution (execution.Execution, optional): Execution of the point-wise computation
+            Defaults to None (chosen by execution.default_execution)
+
+    Returns:
+        2 dimensional numpy.ndarray with similarity values to reference series
+    """
+    return _calculate_similarities_of_block(map_array, reference_series, [sim_func], execution)[0]
+
+
+def _calculate_similarities_of_block(map_array, reference_series, measures, execution=None):
+    """
+    Calculate similarity of all points of a block of the map to a reference series with several
+    similarity measures
+
+    Measures with a vectorized counterpart are computed in one NumPy operation each. The others
+    are computed point by point, all of them in the same tasks, as configured by execution.
+
+    Args:
+        map_array (numpy.ndarray): Map with 3 dimensions - time, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        measures (list): List of similarity measures
+        execution (execution.Execution, optional): Execution of the point-wise computation
+            Defaults to None (chosen by execution.default_execution)
+
+    Returns:
+        3 dimensional numpy.ndarray with dimensions measure, latitude, longitude
+    """
+    (len_time, len_latitude, len_longitude) = map_array.shape
+    sim = np.zeros((len(measures), len_latitude, len_longitude))
+
+    pointwise = []
+    for i, measure in enumerate(measures):
+        map_func = similarity_measures.get_map_measure(measure)
+        if map_func is not None:
+            sim[i] = map_func(map_array, reference_series)
+        else:
+            pointwise.append(i)
+    if not pointwise:
+        return sim
+
+    sim_funcs = [measures[i] for i in pointwise]
+    if execution is None:
+        execution = exe.default_execution(sim_funcs, len_latitude * len_longitude, len_time)
+
+    #Let the measures fill the cache of the reference series on the first point,
+    #so every worker receives it precomputed
+    reference_series = similarity_measures.prepare_reference(reference_series)
+    for sim_func in sim_funcs:
+        sim_func(map_array[:, 0, 0], reference_series)
+
+    batches = execution.batches(len_latitude, len_longitude)
+    if execution.shares_memory:
+        pointwise_sim = np.zeros((len(sim_funcs), len_latitude, len_longitude))
+        execution.run(_calculate_series_similarities_of_points_in_place,
+                      ((map_array, start, end, reference_series, sim_funcs, pointwise_sim)
+                       for (start, end) in batches))
+        sim[pointwise] = pointwise_sim
+        return sim
+
+    #Place the block and the result in shared memory-mapped files once. The workers only receive
+    #references to them, index the points they need without copies and write in place.
+    folder = tempfile.mkdtemp(prefix="similarity_")
+    try:
+        shared_map_array = _to_shared_memmap(map_array, os.path.join(folder, "map.npy"))
+        pointwise_sim = np.lib.format.open_memmap(os.path.join(folder, "similarity.npy"),
+                                                  mode="w+", dtype=float,
+                                                  shape=(len(sim_funcs), len_latitude,
+                                                         len_longitude))
+
+        execution.run(_calculate_series_similarities_of_points_in_place,
+                      ((shared_map_array, start, end, reference_series, sim_funcs, pointwise_sim)
+                       for (start, end) in batches))
+
+        sim[pointwise] = pointwise_sim
+        return sim
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def _to_shared_memmap(map_array, filename):
+    """
+    Return a read-only memory map of the array that can be passed to workers without copying it
+
+    Memory maps backed by a file are passed as they are, other arrays are written to filename once.
+
+    Args:
+        map_array (numpy.ndarray): Array to share
+        filename (str): Path of the .npy file to write the array to if necessary
+
+    Returns:
+        numpy.memmap with the values of map_array
+    """
+    if isinstance(map_array, np.memmap) and map_array.filename is not None:
+        return map_array
+    np.save(filename, np.asarray(map_array))
+    return np.load(filename, mmap_mode="r")
+
+
+def _calculate_series_similarities_of_points_in_place(map_array, start, end, reference_series,
+                                                      measures, out):
+    """
+    Calculate similarity of a range of points to a reference series with several similarity
+    measures and write them into out
 
-    return np.array(sim).reshape(len_latitude, len_longitude)
+    Args:
+        map_array (numpy.ndarray): Map with 3 dimensions - time, latitude, longitude
+        start (int): First flat point index (latitude * number of longitudes + longitude)
+        end (int): Flat point index after the last point
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        measures (list): List of similarity measures
+        out (numpy.ndarray): 3 dimensional array (e.g. a shared numpy.memmap) with dimensions
+                             measure, latitude, longitude to write the results to
+    """
+    len_longitude = map_array.shape[2]
+    for point in range(start, end):
+        (lat, lon) = divmod(point, len_longitude)
+        series = map_array[:, lat, lon]
+        for i, sim_func in enumerate(measures):
+            out[i, lat, lon] = sim_func(series, reference_series)
 
 
 def calculate_series_similarity_on_latitude(map_array, reference_series,
@@ -79,7 +550,8 @@ def calculate_series_similarity_on_latitude(map_array, reference_series,
 
 def calculate_series_similarity_per_period(map_array, reference_series,
                                            level=0, period_length=12,
-                                           sim_func=similarity_measures.pearson_correlation):
+                                           sim_func=similarity_measures.pearson_correlation,
+                                           chunk_size=None, execution=None):
     """
     Calculate similarity of all points on a map to a reference series per period
 
@@ -95,6 +567,12 @@ def calculate_series_similarity_per_period(map_array, reference_series,
             Defaults to 12
         sim_func (str, optional): The similarity function that should be used.
             Defaults to Pearson's Correlation Coefficient.
+        chunk_size (int or tuple, optional): Size of the tiles processed at once,
+                                             see calculate_series_similarity
+            Defaults to None (whole map at once)
+        execution (execution.Execution, optional): Execution of the point-wise computation,
+                                                   see calculate_series_similarity
+            Defaults to None (chosen by execution.default_execution)
 
     Returns:
         List of similarity maps to reference series
@@ -105,14 +583,114 @@ def calculate_series_similarity_per_period(map_array, reference_series,
     for i in range(num_periods):
         start = i * period_length
         end = start + period_length
-        period_similarity = calculate_series_similarity(map_array[start:end, :, :, :],
+        #Only read the requested level of this period
+        period_similarity = calculate_series_similarity(map_array[start:end, [level], :, :],
                                                         reference_series[start:end],
-                                                        level,
-                                                        sim_func)
+                                                        0,
+                                                        sim_func,
+                                                        chunk_size,
+                                                        execution=execution)
         sim.append(period_similarity)
     return sim
 
 
+def calculate_series_similarity_in_windows(map_array, reference_series, window, step=1, level=0,
+                                           sim_func=similarity_measures.pearson_correlation,
+                                           chunk_size=None, out=None, execution=None):
+    """
+    Calculate similarity of all points on a map to a reference series in sliding time windows,
+    e.g. a window of 10 years stepped by one month
+
+    See calculate_series_similarities_in_windows.
+
+    Args:
+        map_array (numpy.ndarray): Map with 4 dimensions - time, level, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        window (int): Length of a window in time steps
+        step (int, optional): Number of time steps between the starts of two windows
+            Defaults to 1
+        level (int, optional): Level on which the similarity should be calculated
+            Defaults to 0
+        sim_func (function, optional): The similarity function that should be used
+            Defaults to similarity_measures.pearson_correlation
+        chunk_size (int or tuple, optional): Size of the tiles, see calculate_series_similarities
+            Defaults to None (whole map at once)
+        out (numpy.ndarray, optional): Preallocated 3 dimensional array (e.g. a numpy.memmap)
+                                       with dimensions window, latitude, longitude
+            Defaults to None (a new array is allocated)
+        execution (execution.Execution, optional): Execution of the point-wise computation
+            Defaults to None (chosen by execution.default_execution)
+
+    Returns:
+        3 dimensional numpy.ndarray (out, if given) with dimensions window, latitude, longitude
+    """
+    stacked_out = None if out is None else out[np.newaxis]
+    sim = calculate_series_similarities_in_windows(map_array, reference_series, window, [sim_func],
+                                                   step, level, chunk_size, stacked_out, execution)
+    return sim[0] if out is None else out
+
+
+def calculate_series_similarities_in_windows(map_array, reference_series, window, measures, step=1,
+                                             level=0, chunk_size=None, out=None, execution=None):
+    """
+    Calculate similarity of all points on a map to a reference series in sliding time windows with
+    several similarity measures
+
+    The windows start at windows.window_starts(len_time, window, step). Measures registered in
+    windows.WINDOW_MEASURES (Pearson's correlation, covariance, cosine similarity and the
+    Euclidean and Manhattan distances) are updated incrementally from window to window, the
+    others are computed from scratch for every window. Every tile of the map is read once and its
+    results are written to out, so a numpy.memmap (e.g. from numpy.lib.format.open_memmap)
+    streams them to disk.
+
+    Args:
+        map_array (numpy.ndarray): Map with 4 dimensions - time, level, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        window (int): Length of a window in time steps
+        measures (list): List of similarity measures to compute similarity between two time series
+        step (int, optional): Number of time steps between the starts of two windows
+            Defaults to 1
+        level (int, optional): Level on which the similarity should be calculated
+            Defaults to 0
+        chunk_size (int or tuple, optional): Size of the tiles, see calculate_series_similarities
+            Defaults to None (whole map at once)
+        out (numpy.ndarray, optional): Preallocated 4 dimensional array (e.g. a numpy.memmap)
+                                       with dimensions measure, window, latitude, longitude
+            Defaults to None (a new array is allocated)
+        execution (execution.Execution, optional): Execution of the point-wise computation
+            Defaults to None (chosen by execution.default_execution)
+
+    Returns:
+        4 dimensional numpy.ndarray (out, if given) with dimensions measure, window, latitude,
+        longitude
+    """
+    (len_time, _, len_latitude, len_longitude) = map_array.shape
+    #Windows only cover the time steps of both the map and the reference series
+    len_time = min(len_time, len(reference_series))
+    starts = windows.window_starts(len_time, window, step)
+    if out is None:
+        out = np.zeros((len(measures), len(starts), len_latitude, len_longitude))
+
+    running = [i for (i, measure) in enumerate(measures) if windows.get_window_measure(measure)]
+    other = [i for i in range(len(measures)) if i not in running]
+    running_measures = [measures[i] for i in running]
+    other_measures = [measures[i] for i in other]
+    reference_series = np.asarray(reference_series, dtype=float)[:len_time]
+
+    for (lat_slice, lon_slice) in _tiles(len_latitude, len_longitude, chunk_size):
+        tile = np.asarray(map_array[:len_time, level, lat_slice, lon_slice])
+        if running:
+            out[running, :, lat_slice, lon_slice] = windows.rolling_similarities(
+                tile, reference_series, window, running_measures, step)
+        if not other:
+            continue
+        for (j, start) in enumerate(starts):
+            out[other, j, lat_slice, lon_slice] = _calculate_similarities_of_block(
+                tile[start:start + window], reference_series[start:start + window],
+                other_measures, execution)
+    return out
+
+
 def calculate_surrounding_mean(map_array, lat, lon, lat_step=0, lon_step=0):
     """
     Calculate Mean of the value at a point and of it's surrounding values
@@ -134,7 +712,7 @@ def calculate_surrounding_mean(map_array, lat, lon, lat_step=0, lon_step=0):
     return np.mean(values)
 
 
-def deseasonalize_map(map_array, period_length=12):
+def deseasonalize_map(map_array, period_length=12, dtype=None, out=None):
     """
     Deseasonalize every data point of a map by subtracting the respective mean and dividing by
     the respective standard deviation.
@@ -143,34 +721,23 @@ def deseasonalize_map(map_array, period_length=12):
     mean for this month and divide by the alltime standard deviation for this month.
 
     If the length of the time dimension is no multiple of the period length, values from behind
-    will be dropped until this condition is met.
+    will be dropped until this condition is met. Points with a standard deviation of zero are
+    deseasonalized to 0. See climatology for maps that do not fit into memory.
 
     Args:
         map_array (np.ndarray): Map with 4 dimensions - time, level, latitude, longitude
         period_length (int): length of one period
             Defaults to 12
+        dtype (numpy.dtype, optional): Type of the deseasonalized map, e.g. numpy.float32
+            Defaults to None (float64 or the floating type of map_array)
+        out (numpy.ndarray, optional): Array the deseasonalized map is written to, map_array
+                                       itself to deseasonalize in place
+            Defaults to None
 
     Returns:
         Deseasonalized map
     """
-    (len_time, len_level, len_latitude, len_longitude) = map_array.shape
-    num_periods = int(np.floor(len_time / period_length))
-
-    reshaped_map_array = map_array[:num_periods * period_length, :, :, :].reshape(num_periods,
-                                                                                  period_length,
-                                                                                  len_level,
-                                                                                  len_latitude,
-                                                                                  len_longitude)
-
-    period_mean = np.mean(reshaped_map_array, axis=0)
-    period_std = np.std(reshaped_map_array, axis=0)
-
-    deseasonalized_map = (reshaped_map_array - period_mean) / period_std
-
-    return deseasonalized_map.reshape(num_periods * period_length,
-                                      len_level,
-                                      len_latitude,
-                                      len_longitude)
+    return climatology.deseasonalize(map_array, period_length, dtype, out)
 
 
 def deseasonalize_time_series(series, period_length=12):
@@ -192,30 +759,16 @@ def deseasonalize_time_series(series, period_length=12):
     Returns:
         Deseasonalized time series
     """
-    period_mean = np.zeros(period_length)
-    period_std = np.zeros(period_length)
-
-    len_time = len(series)
-    num_periods = int(np.floor(len_time / period_length))
-
-    for i in range(period_length):
-        period_mean[i] = np.mean(np.array([series[j * period_length + i]
-                                           for j in range(num_periods)]))
-        period_std[i] = np.std(np.array([series[j * period_length + i]
-                                         for j in range(num_periods)]))
-
-    #Cut off last values that prevent series from having length that is a multiple of period_length
-    series_short = series[:num_periods*period_length]
-
-    normalized_series = [(series_short[k] - period_mean[k % period_length])
-                         / period_std[k % period_length] for k in range(len(series_short))]
-    return normalized_series
+    return climatology.deseasonalize(np.asarray(series, dtype=float), period_length)
 
 
-def derive(map_array, lat, lon, level=0, lat_step=0, lon_step=0): # pylint: disable=R0913
+def derive(map_array, lat, lon, level=0, lat_step=0, lon_step=0, latitudes=None, # pylint: disable=R0913
+           wrap_longitude=True):
     """
     Derive time series for a given index from a map.
 
+    The mean over the box around the starting point is taken for all times at once.
+
     Args:
         map_array (numpy.ndarray): Map with 4 dimensions - time, level, latitude, longitude
         lat (int): Latitude of starting point
@@ -228,19 +781,73 @@ def derive(map_array, lat, lon, level=0, lat_step=0, lon_step=0): # pylint: disa
         lon_step (int, optional): Stepsize in Longitude-dimension:
             How many points in the horizontal direction should be taken into account.
             Defaults to 0
+        latitudes (numpy.ndarray, optional): Latitudes of the map in degrees. If given, the
+                                             values are weighted by the cosine of their latitude,
+                                             i.e. by the area of their grid cell
+            Defaults to None (all values have the same weight)
+        wrap_longitude (bool, optional): Continue boxes that cross the first or last longitude on
+                                         the other side of the map (the dateline of a global map)
+            Defaults to True
+
+    The box covering a region given in degrees can be found with grid.GridIndex.box.
 
     Returns:
-        List containing the mean values of all values in the respective index per time
+        numpy.ndarray containing the mean values of all values in the respective index per time
     """
-    len_time = map_array.shape[0]
+    len_latitude, len_longitude = map_array.shape[2:]
+    lat_start = max(lat - lat_step, 0)
+    lat_end = min(lat + lat_step + 1, len_latitude)
+    lon_indices = np.arange(lon - lon_step, lon + lon_step + 1)
+    if wrap_longitude:
+        lon_indices = np.unique(lon_indices % len_longitude)
+    else:
+        lon_indices = lon_indices[(lon_indices >= 0) & (lon_indices < len_longitude)]
+
+    values = np.asarray(map_array[:, level, lat_start:lat_end, :], dtype=float)[:, :, lon_indices]
+    if latitudes is None:
+        return values.mean(axis=(1, 2))
+    weights = np.cos(np.deg2rad(np.asarray(latitudes, dtype=float)[lat_start:lat_end]))
+    return np.average(values.mean(axis=2), axis=1, weights=weights)
 
-    time_series = []
-    for time in range(len_time):
-        value = calculate_surrounding_mean(map_array[time, level, :, :],
-                                           lat, lon, lat_step, lon_step)
-        time_series.append(value)
 
-    return time_series
+def derive_indices(map_array, indices, latitudes=None, wrap_longitude=True):
+    """
+    Derive time series for several indices from a map, reading the latitudes they cover on each
+    level only once
+
+    Args:
+        map_array (numpy.ndarray): Map with 4 dimensions - time, level, latitude, longitude
+        indices (dict): Arguments of derive (lat, lon and optionally level, lat_step, lon_step)
+                        per name of an index, e.g. {"QBO": {"lat": 64, "lon": 0, "lon_step": 256}}
+        latitudes (numpy.ndarray, optional): Latitudes of the map in degrees for area weighting,
+                                             see derive
+            Defaults to None
+        wrap_longitude (bool, optional): See derive
+            Defaults to True
+
+    Returns:
+        Dictionary with the derived time series per name of an index
+    """
+    len_latitude = map_array.shape[2]
+    names_per_level = {}
+    for name, index in indices.items():
+        names_per_level.setdefault(index.get("level", 0), []).append(name)
+
+    series = {}
+    for level, names in names_per_level.items():
+        lat_start = min(max(indices[name]["lat"] - indices[name].get("lat_step", 0), 0)
+                        for name in names)
+        lat_end = max(min(indices[name]["lat"] + indices[name].get("lat_step", 0) + 1,
+                          len_latitude) for name in names)
+        block = np.asarray(map_array[:, [level], lat_start:lat_end, :], dtype=float)
+        block_latitudes = (None if latitudes is None
+                           else np.asarray(latitudes)[lat_start:lat_end])
+        for name in names:
+            index = dict(indices[name], level=0)
+            index["lat"] -= lat_start
+            series[name] = derive(block, latitudes=block_latitudes, wrap_longitude=wrap_longitude,
+                                  **index)
+    return {name: series[name] for name in indices}
 
 
 def convert_coordinates_to_grid(geo_coordinates, value):
@@ -250,20 +857,13 @@ def convert_coordinates_to_grid(geo_coordinates, value):
     Args:
         geo_coordinates (List): List containing the meaning of the indices expressed
                                 in geographical coordinates
-        value (int): Coordinate to convert
+        value (int): Coordinate to convert, or numpy.ndarray of coordinates
 
     Returns:
-        Indice for the respective geographical coordinate
+        Indice for the respective geographical coordinate, the closest one if none matches
+        exactly. See grid.GridIndex to look up many latitudes and longitudes.
     """
-    tolerance = 0.1
-    while len(np.where((geo_coordinates < value + tolerance) &
-                       (geo_coordinates > value - tolerance))[0]) == 0:
-        tolerance += 0.1
-
-    gridpoint = np.where((geo_coordinates < value + tolerance) &
-                         (geo_coordinates > value - tolerance))[0][0]
-
-    return gridpoint
+    return grid.nearest_index(geo_coordinates, value)
 
 
 def combine_similarity_measures(similarities_1, similarities_2, combination_func):
@@ -300,7 +900,7 @@ def shift(series, shift):
 
 def calculate_filtered_agreement_areas(map_array, reference_series, measures, value_thresholds, agreement_thresholds,
                                        agreement_func=np.std, filter_values_high=True, filter_agreement_high=False,
-                                       scaling_func=comp.binning_values_to_quantiles, level=0):
+                                       scaling_func=comp.binning_values_to_quantiles, level=0, packed=False):
     """
     Calculate the areas where the similarity measures agree on the dependencies.
     Contains the following steps:
@@ -334,36 +934,23 @@ def calculate_filtered_agreement_areas(map_array, reference_series, measures, va
             Defaults to comp.binning_values_to_quantiles
         level (int, optional): Level on which the similarity should be calculated
             Defaults to 0
+        packed (Boolean, optional): Return the agreement maps as bit-packed agreement.PackedCube
+            Defaults to False
 
     Returns:
-        Array with the resulting agreement maps
+        Array with the resulting agreement maps with dimensions value threshold, agreement threshold,
+        latitude, longitude
     """
-    maps = np.zeros((len(value_thresholds), len(agreement_thresholds), len(map_array[0,0,:,0]), len(map_array[0,0,0,:])))
-    similarities = []
-    mean_map = np.zeros(map_array[0, 0, :, :].shape)
-    agreement = np.zeros_like(mean_map)
-
-    for measure in measures:
-        similarity = calculate_series_similarity(map_array, reference_series, level, measure)
-        if (measure != similarity_measures.pearson_correlation or measure !=similarity_measures.pearson_correlation_abs):
-            similarity = scaling_func(similarity)
-        similarities.append(similarity)
-
-    agreement = agreement_func(similarities, axis=0)
+    similarities = agreement.scale_similarities(calculate_series_similarities(map_array, reference_series,
+                                                                              measures, level),
+                                                scaling_func)
+    agreement_map = agreement_func(similarities, axis=0)
     mean_map = np.mean(similarities, axis=0)
 
-
-    for i, value_threshold in enumerate(value_thresholds):
-        for j, agreement_threshold in enumerate(agreement_thresholds):
-            map = np.ones_like(mean_map)
-
-            agreement_filtered = filter_map(agreement, agreement_threshold, high=filter_agreement_high)
-            mean_map_filtered = filter_map(mean_map, value_threshold, high=filter_values_high)
-
-            map = map * agreement_filtered * mean_map_filtered
-            maps[i, j, :, :] = map
-
-    return maps
+    #All combinations of thresholds at once
+    maps = agreement.agreement_areas(mean_map, agreement_map, value_thresholds, agreement_thresholds,
+                                     filter_values_high, filter_agreement_high, packed)
+    return maps if packed else maps.astype(float)
 
 
 def filter_map(map, threshold, high=True):
@@ -0,0 +1,230 @@
+"""
+Module to compute climatologies and deseasonalize series and maps
+
+A climatology is the mean and standard deviation of every step of a period (e.g. of every month
+of the year) over all periods. Deseasonalizing subtracts the climatological mean from each value
+and divides by the climatological standard deviation.
+
+The climatology of arrays that do not fit into memory, e.g. a datasets.LazyMap of many years and
+levels, is accumulated from chunks of time steps with ClimatologyAccumulator, and
+deseasonalize_in_chunks writes the deseasonalized chunks into an output array such as a
+numpy.memmap.
+
+Steps with a standard deviation of zero (constant values) are deseasonalized to zero_std,
+by default 0, instead of NaN or inf.
+"""
+import numpy as np
+
+
+class Climatology:
+    """
+    Mean and standard deviation of every step of a period
+
+    Attributes:
+        mean (numpy.ndarray): Mean with dimensions period step and the non-time dimensions of the
+                              data
+        std (numpy.ndarray): Standard deviation with the dimensions of mean
+        count (numpy.ndarray): Number of values per period step
+    """
+    def __init__(self, mean, std, count):
+        self.mean = mean
+        self.std = std
+        self.count = count
+
+    @property
+    def period_length(self):
+        return len(self.mean)
+
+    def deseasonalize(self, values, start=0, dtype=None, out=None, zero_std=0.):
+        """
+        Deseasonalize values with this climatology
+
+        Args:
+            values (numpy.ndarray): Values with time as first dimension and the other dimensions
+                                    of the climatology
+            start (int, optional): Step of the period of the first value
+                Defaults to 0
+            dtype (numpy.dtype, optional): Type of the result if out is not given
+                Defaults to None (float64 or the floating type of values)
+            out (numpy.ndarray, optional): Array the result is written to, can be values itself
+                Defaults to None
+            zero_std (float, optional): Result for steps with a standard deviation of zero
+                Defaults to 0.
+
+        Returns:
+            numpy.ndarray (out, if given) with the deseasonalized values
+        """
+        if out is None:
+            if dtype is None:
+                dtype = getattr(values, "dtype", np.float64)
+                dtype = dtype if np.issubdtype(dtype, np.floating) else np.float64
+            out = np.empty(np.shape(values), dtype=dtype)
+        if out is not values:
+            out[...] = values
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scale = np.where(self.std > 0, 1. / self.std, 0.)
+        for step in range(self.period_length):
+            first = (step - start) % self.period_length
+            block = out[first::self.period_length]
+            block -= self.mean[step].astype(out.dtype)
+            block *= scale[step].astype(out.dtype)
+            if zero_std != 0:
+                block[...] = np.where(self.std[step] == 0, zero_std, block)
+        return out
+
+
+class ClimatologyAccumulator:
+    """
+    Streaming computation of a climatology from chunks of time steps
+
+    Means and variances are merged with the parallel variant of Welford's algorithm, which stays
+    accurate for long records, so only one chunk has to be in memory at a time.
+
+    Attributes:
+        period_length (int): Length of one period
+        time (int): Number of time steps added so far
+    """
+    def __init__(self, period_length=12):
+        self.period_length = period_length
+        self.time = 0
+        self._count = np.zeros(period_length, dtype=np.int64)
+        self._mean = None
+        self._squares = None
+
+    def update(self, chunk):
+        """
+        Add the next time steps
+
+        Args:
+            chunk (numpy.ndarray): Values with time as first dimension, following the values
+                                   added before
+        """
+        chunk = np.asarray(chunk, dtype=float)
+        if self._mean is None:
+            self._mean = np.zeros((self.period_length,) + chunk.shape[1:])
+            self._squares = np.zeros((self.period_length,) + chunk.shape[1:])
+
+        for step in range(self.period_length):
+            values = chunk[(step - self.time) % self.period_length::self.period_length]
+            count = len(values)
+            if count == 0:
+                continue
+            mean = values.mean(axis=0)
+            squares = np.sum(np.square(values - mean), axis=0)
+
+            total = self._count[step] + count
+            delta = mean - self._mean[step]
+            self._mean[step] += delta * (count / float(total))
+            self._squares[step] += squares + np.square(delta) * (self._count[step] * count
+                                                                  / float(total))
+            self._count[step] = total
+        self.time += len(chunk)
+
+    def climatology(self):
+        """
+        Returns:
+            Climatology of all time steps added so far
+        """
+        if self._mean is None:
+            raise ValueError("No values added to the accumulator")
+        shape = (-1,) + (1,) * (self._mean.ndim - 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            std = np.sqrt(self._squares / self._count.reshape(shape))
+        return Climatology(self._mean.copy(), std, self._count.copy())
+
+
+def climatology(values, period_length=12, chunk_size=None):
+    """
+    Compute the climatology of values over all complete periods
+
+    If the length of the time dimension is no multiple of the period length, values from behind
+    are ignored until this condition is met.
+
+    Args:
+        values (numpy.ndarray): Values with time as first dimension, e.g. a series or a map with
+                                dimensions time, level, latitude, longitude
+        period_length (int, optional): Length of one period
+            Defaults to 12
+        chunk_size (int, optional): Number of time steps read at once
+            Defaults to None (one period step over all periods at a time)
+
+    Returns:
+        Climatology
+    """
+    len_time = (len(values) // period_length) * period_length
+    if chunk_size is not None:
+        accumulator = ClimatologyAccumulator(period_length)
+        for start in range(0, len_time, chunk_size):
+            accumulator.update(values[start:min(start + chunk_size, len_time)])
+        return accumulator.climatology()
+
+    (mean, std) = ([], [])
+    for step in range(period_length):
+        values_of_step = np.asarray(values[step:len_time:period_length], dtype=float)
+        mean.append(values_of_step.mean(axis=0))
+        std.append(values_of_step.std(axis=0))
+    return Climatology(np.array(mean), np.array(std), np.full(period_length, len_time // period_length))
+
+
+def deseasonalize(values, period_length=12, dtype=None, out=None, zero_std=0.):
+    """
+    Deseasonalize values by subtracting the respective mean and dividing by the respective
+    standard deviation.
+
+    For example: Monthly (period_length = 12). From each value, subtract the alltime
+    mean for this month and divide by the alltime standard deviation for this month.
+
+    If the length of the time dimension is no multiple of the period length, values from behind
+    will be dropped until this condition is met.
+
+    Args:
+        values (numpy.ndarray): Values with time as first dimension, e.g. a series or a map with
+                                dimensions time, level, latitude, longitude
+        period_length (int, optional): Length of one period
+            Defaults to 12
+        dtype (numpy.dtype, optional): Type of the result, e.g. numpy.float32 to halve the memory
+            Defaults to None (float64 or the floating type of values)
+        out (numpy.ndarray, optional): Array the result is written to. Can be values itself (or
+                                       its complete periods) to deseasonalize in place.
+            Defaults to None
+        zero_std (float, optional): Result for steps with a standard deviation of zero
+            Defaults to 0.
+
+    Returns:
+        numpy.ndarray (out, if given) with the deseasonalized values of all complete periods
+    """
+    len_time = (len(values) // period_length) * period_length
+    periods = values[:len_time]
+    if out is not None:
+        out = periods if out is values else out[:len_time]
+    return climatology(periods, period_length).deseasonalize(periods, dtype=dtype, out=out,
+                                                             zero_std=zero_std)
+
+
+def deseasonalize_in_chunks(values, out, period_length=12, chunk_size=120, zero_std=0.):
+    """
+    Deseasonalize values that do not fit into memory, reading chunks of time steps twice:
+    once to accumulate the climatology and once to deseasonalize them
+
+    Args:
+        values (numpy.ndarray): Values with time as first dimension, e.g. a datasets.LazyMap
+        out (numpy.ndarray): Array of the shape of the complete periods of values, e.g. a
+                             numpy.memmap of type float32
+        period_length (int, optional): Length of one period
+            Defaults to 12
+        chunk_size (int, optional): Number of time steps read at once
+            Defaults to 120
+        zero_std (float, optional): Result for steps with a standard deviation of zero
+            Defaults to 0.
+
+    Returns:
+        out
+    """
+    len_time = (len(values) // period_length) * period_length
+    climate = climatology(values, period_length, chunk_size)
+    for start in range(0, len_time, chunk_size):
+        end = min(start + chunk_size, len_time)
+        climate.deseasonalize(values[start:end], start=start % period_length, out=out[start:end],
+                              zero_std=zero_std)
+    return out
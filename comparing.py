@@ -3,12 +3,11 @@ Module containing different functions to make results of similarity measures
 comparable
 """
 
-import pandas as pd
 import numpy as np
 from skimage import exposure
 
 #Comparing functions
-def binning_values_to_quantiles(map_array, num_bins=10):
+def binning_values_to_quantiles(map_array, num_bins=10, axis=None, out=None, duplicates="raise"):
     """
     Convert a map of values into n percentile bins.
 
@@ -16,18 +15,48 @@ def binning_values_to_quantiles(map_array, num_bins=10):
     0.3 means this value belongs to the 20%-30% bin which contains the 20%-30%
     smallest values of the map.
 
-    All the bins have the same size
+    All the bins have the same size. The bins are the ones of pandas.qcut: bin edges are the
+    linearly interpolated quantiles of the values that are not NaN, bins include their upper
+    edge and the first bin its lower edge. NaN values stay NaN.
+
+    A stack of maps, e.g. with dimensions measure, latitude, longitude, is binned at once with
+    axis=(1, 2), every map with its own quantiles.
 
     Args:
         map_array (array): Map with values to scale
         num_bins (int): Number or bins
+        axis (int or tuple, optional): Axes of the values that are binned together
+            Defaults to None (all values)
+        out (np.ndarray, optional): Float array the result is written to, can be map_array itself
+            Defaults to None
+        duplicates (str, optional): "raise" or "drop" if bin edges are not unique, like pandas.qcut
+            Defaults to "raise"
 
     Returns:
-        Map with the bin numbers for each value
+        Map (out, if given) with the bin numbers for each value
     """
-    values = pd.DataFrame(np.array(map_array).flatten())
-    bins = pd.qcut(values.iloc[:, 0], num_bins, labels=False)
-    return np.array((bins + 1) / num_bins).reshape(map_array.shape)
+    values = np.asarray(map_array, dtype=float)
+    edges = _quantile_edges(values, num_bins, axis)
+    distinct = np.diff(edges, axis=-1) != 0
+    if duplicates == "raise" and not np.all(distinct | np.isnan(edges[..., 1:])):
+        raise ValueError("Bin edges must be unique: {}. You can drop duplicate edges by setting "
+                         "duplicates='drop'".format(edges[~np.all(distinct, axis=-1)][0]))
+    if duplicates not in ("raise", "drop"):
+        raise ValueError("duplicates must be 'raise' or 'drop', not {}".format(duplicates))
+
+    #Index of the bin: number of distinct inner edges below the value
+    labels = np.zeros(values.shape, dtype=np.min_scalar_type(num_bins))
+    for j in range(1, num_bins):
+        labels += (values > edges[..., j]) & distinct[..., j - 1]
+
+    if out is None:
+        out = np.empty(values.shape)
+    np.add(labels, 1, out=out)
+    out /= num_bins
+    out[np.isnan(values)] = np.nan
+    #Without distinct edges no bin is left
+    out[np.broadcast_to(edges[..., 0] == edges[..., -1], values.shape)] = np.nan
+    return out
 
 def equalize_histogram(map_array, num_bins=10):
     """
@@ -46,24 +75,78 @@ def equalize_histogram(map_array, num_bins=10):
     return exposure.equalize_hist(map_array, nbins=num_bins)
 
 
-def min_max_normalization(map_array, a=0, b=1):
+def min_max_normalization(map_array, a=0, b=1, axis=None, out=None):
     """
     Rescale a map of values to range [a, b] using min-max normalization
 
+    NaN values are ignored for the minimum and maximum and stay NaN.
+
     Args:
         map_array (np.ndarray): Map with values to scale
         a (int, optional): Lower bound
             Defaults to 0
         b (int, optional): Upper bound
             Defaults to 0
+        axis (int or tuple, optional): Axes of the values that are scaled together, e.g. (1, 2)
+                                       for a stack of maps with dimensions measure, latitude,
+                                       longitude
+            Defaults to None (all values)
+        out (np.ndarray, optional): Float array the result is written to, can be map_array itself
+            Defaults to None
 
     Returns:
-        Map with scaled values
+        Map (out, if given) with scaled values
+    """
+    map_array = np.asarray(map_array)
+    minimum = np.nanmin(map_array, axis=axis, keepdims=True)
+    maximum = np.nanmax(map_array, axis=axis, keepdims=True)
+
+    if out is None:
+        out = np.empty(map_array.shape, dtype=np.result_type(map_array, float))
+    np.subtract(map_array, minimum, out=out)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out *= (b - a) / (maximum - minimum)
+    out += a
+    return out
+
+
+def _quantile_edges(values, num_bins, axis=None):
     """
-    min = map_array.min()
-    max = map_array.max()
+    Compute the bin edges of pandas.qcut, the quantiles of the values that are not NaN
+
+    Args:
+        values (np.ndarray): Values
+        num_bins (int): Number of bins
+        axis (int or tuple, optional): Axes of the values that are binned together
+            Defaults to None (all values)
 
-    return a + ((map_array - min) * (b - a) / (max - min))
+    Returns:
+        np.ndarray with the edges along the last dimension and the dimensions of values, with
+        length 1 along axis
+    """
+    axes = tuple(range(values.ndim)) if axis is None else tuple(np.atleast_1d(axis) % values.ndim)
+    stack_axes = tuple(i for i in range(values.ndim) if i not in axes)
+    rows = values.transpose(stack_axes + axes).reshape(-1, int(np.prod([values.shape[i] for i in axes])))
+
+    #Like pandas.qcut, round quantiles that are not representable in base 2 up
+    quantiles = np.linspace(0, 1, num_bins + 1)
+    inexact = num_bins * quantiles != np.arange(num_bins + 1)
+    quantiles[inexact] = np.nextafter(quantiles[inexact], 1)
+
+    #Linear interpolation between the sorted values like numpy.quantile, NaN are sorted last
+    sorted_rows = np.sort(rows, axis=1)
+    count = np.sum(~np.isnan(rows), axis=1, keepdims=True)
+    position = quantiles * np.maximum(count - 1, 0)
+    lower = np.floor(position).astype(int)
+    upper = np.minimum(lower + 1, np.maximum(count - 1, 0))
+    weight = position - lower
+    (below, above) = (np.take_along_axis(sorted_rows, lower, axis=1),
+                      np.take_along_axis(sorted_rows, upper, axis=1))
+    difference = above - below
+    edges = np.where(weight >= 0.5, above - difference * (1 - weight), below + difference * weight)
+
+    shape = [1 if i in axes else values.shape[i] for i in range(values.ndim)] + [num_bins + 1]
+    return edges.reshape(shape)
 
 
 #Preprocessing
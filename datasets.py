@@ -0,0 +1,216 @@
+"""
+Module giving lazy access to the variables of NetCDF files
+
+A LazyMap behaves like the 4 dimensional map (time, level, latitude, longitude) the functions in
+calculations expect, but it is backed by a memory-mapped file. Only the values that are indexed
+are read from disk, so a single level or period of a large file can be used without
+extracting it beforehand (e.g. with cdo -select,level=...).
+"""
+import os
+import numpy as np
+from scipy.io import netcdf_file
+
+def open_dataset(filename, variable="u"):
+    """
+    Open a variable of a NetCDF file as a lazily loaded map
+
+    Args:
+        filename (str): Path to the NetCDF file
+        variable (str, optional): Name of the variable with 4 dimensions - time, level,
+                                  latitude, longitude
+            Defaults to "u"
+
+    Returns:
+        LazyMap of the variable
+    """
+    file = netcdf_file(filename, mmap=True)
+    return LazyMap(file, variable)
+
+
+class LazyMap:
+    """
+    Lazily loaded, memory-mapped view of a 4 dimensional NetCDF variable
+
+    Indexing returns a numpy.ndarray with the scale_factor and add_offset of the variable applied
+    and fill values replaced by NaN. select returns a new LazyMap restricted to some times or
+    levels without reading anything.
+
+    Attributes:
+        times (numpy.ndarray): Values of the time coordinate of the selected times
+        levels (numpy.ndarray): Values of the level coordinate of the selected levels
+        latitudes (numpy.ndarray): Values of the latitude coordinate
+        longitudes (numpy.ndarray): Values of the longitude coordinate
+    """
+    def __init__(self, file, variable="u", time_indices=None, level_indices=None):
+        self.file = file
+        self.variable = variable
+        nc_variable = file.variables[variable]
+        self._data = nc_variable.data
+        self._scale_factor = getattr(nc_variable, "scale_factor", None)
+        self._add_offset = getattr(nc_variable, "add_offset", None)
+        self._fill_value = getattr(nc_variable, "_FillValue",
+                                   getattr(nc_variable, "missing_value", None))
+
+        (len_time, len_level) = self._data.shape[:2]
+        self._time_indices = (np.arange(len_time) if time_indices is None
+                              else np.asarray(time_indices))
+        self._level_indices = (np.arange(len_level) if level_indices is None
+                               else np.asarray(level_indices))
+
+        coordinates = [self._coordinate(dimension, length)
+                       for dimension, length in zip(nc_variable.dimensions, self._data.shape)]
+        self.times = coordinates[0][self._time_indices]
+        self.levels = coordinates[1][self._level_indices]
+        self.latitudes = coordinates[2]
+        self.longitudes = coordinates[3]
+
+    @property
+    def shape(self):
+        return (len(self._time_indices), len(self._level_indices)) + self._data.shape[2:]
+
+    @property
+    def ndim(self):
+        return 4
+
+    @property
+    def dtype(self):
+        return np.dtype(float)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        """
+        Read the indexed values from disk
+
+        Args:
+            key: Index along the dimensions time, level, latitude, longitude
+                 (integers, slices, lists or arrays of integers)
+
+        Returns:
+            numpy.ndarray with the indexed values
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            position = [i for i, k in enumerate(key) if k is Ellipsis][0]
+            key = key[:position] + (slice(None),) * (5 - len(key)) + key[position + 1:]
+        key = key + (slice(None),) * (4 - len(key))
+
+        indices = [self._time_indices[key[0]], self._level_indices[key[1]],
+                   np.arange(self._data.shape[2])[key[2]], np.arange(self._data.shape[3])[key[3]]]
+        return self._scale(self._read(indices))
+
+    def __array__(self, dtype=None, copy=None):
+        values = self[:, :, :, :]
+        return values if dtype is None else values.astype(dtype)
+
+    def select(self, time=None, level=None):
+        """
+        Restrict the map to some times and/or levels without reading any values
+
+        Args:
+            time (optional): Index of the times to keep (slice, list or array of integers)
+                Defaults to None (keep all times)
+            level (optional): Index of the levels to keep (integer, slice, list or array of
+                              integers). An integer keeps the level dimension with length 1.
+                Defaults to None (keep all levels)
+
+        Returns:
+            LazyMap with the selected times and levels
+        """
+        time_indices = self._time_indices if time is None else self._time_indices[time]
+        level_indices = (self._level_indices if level is None
+                         else np.atleast_1d(self._level_indices[level]))
+        return LazyMap(self.file, self.variable, np.atleast_1d(time_indices), level_indices)
+
+    def level_index(self, level):
+        """
+        Find the index of a level by its value, e.g. the pressure level 30 hPa
+
+        Args:
+            level (float): Value of the level coordinate
+
+        Returns:
+            Index of the closest level of this map
+        """
+        return int(np.argmin(np.abs(self.levels - level)))
+
+    def fingerprint(self):
+        """
+        Identify the values of this map without reading them
+
+        Returns:
+            String made of the path, size and modification time of the file, the variable and
+            the selected times and levels
+        """
+        stat = os.stat(self.file.filename)
+        return "{}:{}:{}:{}:{}:{}".format(os.path.abspath(self.file.filename), stat.st_size,
+                                          stat.st_mtime, self.variable,
+                                          self._time_indices.tolist(), self._level_indices.tolist())
+
+    def close(self):
+        """
+        Close the underlying NetCDF file. Arrays read before remain valid.
+        """
+        self._data = None
+        self.file.close()
+
+    def _coordinate(self, dimension, length):
+        if dimension in self.file.variables:
+            return np.array(self.file.variables[dimension].data)
+        return np.arange(length)
+
+    def _read(self, indices):
+        """
+        Read the values at the given indices, using basic slicing where the indices are ranges
+
+        Args:
+            indices (list): Index per dimension, either an integer or a 1 dimensional integer array
+
+        Returns:
+            numpy.ndarray with the values read from the file
+        """
+        keys = [_as_slice(index) for index in indices]
+        if all(isinstance(key, (slice, np.integer, int)) for key in keys):
+            return np.array(self._data[tuple(keys)])
+
+        #Advanced indexing, read only the selected values
+        array_axes = [i for i, index in enumerate(indices) if np.ndim(index) > 0]
+        arrays = np.ix_(*[indices[i] for i in array_axes])
+        full_key = [index if np.ndim(index) == 0 else None for index in indices]
+        for axis, array in zip(array_axes, arrays):
+            full_key[axis] = array
+        return np.array(self._data[tuple(full_key)])
+
+    def _scale(self, values):
+        values = values.astype(float)
+        if self._fill_value is not None:
+            values[values == self._fill_value] = np.nan
+        if self._scale_factor is not None:
+            values *= self._scale_factor
+        if self._add_offset is not None:
+            values += self._add_offset
+        return values
+
+
+def _as_slice(index):
+    """
+    Convert an index array that forms an arithmetic progression into a slice
+
+    Args:
+        index: Integer or 1 dimensional integer array
+
+    Returns:
+        Equivalent slice if possible, otherwise the index itself
+    """
+    if np.ndim(index) == 0:
+        return int(index)
+    if len(index) == 0:
+        return index
+    if len(index) == 1:
+        return slice(int(index[0]), int(index[0]) + 1)
+    step = index[1] - index[0]
+    if step > 0 and np.all(np.diff(index) == step):
+        return slice(int(index[0]), int(index[-1]) + 1, int(step))
+    return index
@@ -0,0 +1,110 @@
+"""
+Module to configure how point-wise similarity computations are executed
+
+An Execution describes the backend (serial, threads or processes), the number of workers and
+how many grid points one task contains. default_execution picks these from the cost of the
+similarity measure (see similarity_measures.MEASURE_COSTS).
+"""
+import os
+import numpy as np
+from joblib import Parallel, delayed # pylint: disable=E0401
+import similarity_measures
+
+BACKENDS = ["serial", "threading", "multiprocessing", "loky"]
+
+#Maps that take less time than this (in seconds) are computed serially
+SERIAL_THRESHOLD = 0.5
+#Aimed duration of one task (in seconds), long enough to hide the scheduling overhead
+TASK_DURATION = 0.2
+#Minimal number of tasks per worker, so expensive measures can balance uneven load
+TASKS_PER_WORKER = 4
+
+
+class Execution:
+    """
+    Execution settings for point-wise similarity computations
+
+    Attributes:
+        backend (str): One of "serial", "threading", "multiprocessing" or "loky"
+        n_jobs (int): Number of workers, -1 uses all CPUs
+        batch_size (int): Number of grid points per task, None computes one latitude per task
+    """
+    def __init__(self, backend="loky", n_jobs=-1, batch_size=None):
+        if backend not in BACKENDS:
+            raise ValueError("Backend {} not available, choose one of {}".format(backend, BACKENDS))
+        self.backend = backend
+        self.n_jobs = n_jobs
+        self.batch_size = batch_size
+
+    def __repr__(self):
+        return "Execution(backend={!r}, n_jobs={}, batch_size={})".format(self.backend, self.n_jobs,
+                                                                          self.batch_size)
+
+    @property
+    def shares_memory(self):
+        """
+        True if the workers run in this process and can use its arrays directly
+        """
+        return self.backend in ("serial", "threading")
+
+    def batches(self, len_latitude, len_longitude):
+        """
+        Split the points of a map into tasks
+
+        Args:
+            len_latitude (int): Number of latitudes
+            len_longitude (int): Number of longitudes
+
+        Returns:
+            List of (start, end) ranges of flat point indices (latitude * len_longitude + longitude)
+        """
+        n_points = len_latitude * len_longitude
+        batch_size = len_longitude if self.batch_size is None else max(1, int(self.batch_size))
+        return [(start, min(start + batch_size, n_points)) for start in range(0, n_points, batch_size)]
+
+    def run(self, func, arguments):
+        """
+        Call func with every tuple of arguments using the configured backend
+
+        Args:
+            func (function): Function to call
+            arguments (iterable): Tuples of positional arguments, one per task
+
+        Returns:
+            List with the results of the calls
+        """
+        if self.backend == "serial":
+            return [func(*args) for args in arguments]
+        return Parallel(n_jobs=self.n_jobs, backend=self.backend)(delayed(func)(*args)
+                                                                  for args in arguments)
+
+
+def default_execution(sim_func, n_points, len_time=500, n_jobs=-1):
+    """
+    Choose execution settings for computing one or several similarity measures on a number of points
+
+    Cheap maps are computed serially. Otherwise loky processes are used with tasks that take
+    about TASK_DURATION seconds, but at least TASKS_PER_WORKER tasks per worker so that expensive
+    measures are balanced across the workers.
+
+    Args:
+        sim_func (function or list): Similarity measure or list of similarity measures that are
+                                     computed in the same tasks
+        n_points (int): Number of grid points
+        len_time (int, optional): Length of the series
+            Defaults to 500
+        n_jobs (int, optional): Number of workers, -1 uses all CPUs
+            Defaults to -1
+
+    Returns:
+        Execution
+    """
+    measures = sim_func if isinstance(sim_func, (list, tuple)) else [sim_func]
+    cost = sum(similarity_measures.get_measure_cost(measure, len_time) for measure in measures)
+    if cost * n_points < SERIAL_THRESHOLD:
+        return Execution("serial")
+
+    n_workers = (os.cpu_count() or 1) if n_jobs < 0 else n_jobs
+    batch_size = int(np.clip(TASK_DURATION / cost, 1,
+                             max(1, n_points // (TASKS_PER_WORKER * n_workers))))
+    return Execution("loky", n_jobs, batch_size)
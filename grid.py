@@ -0,0 +1,225 @@
+"""
+Module to find the grid indices of geographical coordinates
+
+A GridIndex is built once per dataset from its latitudes and longitudes. It sorts the
+coordinates once, so looking up many coordinates takes one searchsorted per dimension, and
+works with any rectilinear grid such as the N128 Gaussian grid, whose latitudes are not
+equally spaced. Longitudes of global grids wrap around, e.g. -10 is found as 350.
+"""
+import numpy as np
+
+MODES = ["nearest", "bilinear"]
+
+
+class GridIndex:
+    """
+    Lookup of grid indices for latitudes and longitudes
+
+    Attributes:
+        latitudes (numpy.ndarray): Latitudes of the grid in degrees, in the order of the data
+        longitudes (numpy.ndarray): Longitudes of the grid in degrees, in the order of the data
+        wrap_longitude (bool): True if the longitudes cover the whole globe
+    """
+    def __init__(self, latitudes, longitudes, wrap_longitude=None):
+        self.latitudes = np.asarray(latitudes, dtype=float)
+        self.longitudes = np.asarray(longitudes, dtype=float)
+        if wrap_longitude is None:
+            spacing = np.max(np.diff(np.sort(self.longitudes))) if len(self.longitudes) > 1 else 0
+            span = np.ptp(self.longitudes) + spacing
+            wrap_longitude = bool(np.isclose(span, 360, atol=1e-3 + 1e-6 * span))
+        self.wrap_longitude = wrap_longitude
+        self._latitude_axis = _Axis(self.latitudes)
+        self._longitude_axis = _Axis(self.longitudes, 360. if wrap_longitude else None)
+
+    @classmethod
+    def from_dataset(cls, dataset, wrap_longitude=None):
+        """
+        Build the index of a dataset
+
+        Args:
+            dataset: datasets.LazyMap or scipy.io.netcdf_file with the variables latitude and
+                     longitude
+            wrap_longitude (bool, optional): See GridIndex
+                Defaults to None (detected from the longitudes)
+
+        Returns:
+            GridIndex
+        """
+        if hasattr(dataset, "latitudes"):
+            return cls(dataset.latitudes, dataset.longitudes, wrap_longitude)
+        return cls(dataset.variables["latitude"][:], dataset.variables["longitude"][:],
+                   wrap_longitude)
+
+    def latitude_index(self, latitude):
+        """
+        Find the indices of the grid latitudes closest to latitudes
+
+        Args:
+            latitude (float or numpy.ndarray): Latitudes in degrees
+
+        Returns:
+            Index or numpy.ndarray of indices
+        """
+        return self._latitude_axis.nearest(latitude)
+
+    def longitude_index(self, longitude):
+        """
+        Find the indices of the grid longitudes closest to longitudes
+
+        Args:
+            longitude (float or numpy.ndarray): Longitudes in degrees
+
+        Returns:
+            Index or numpy.ndarray of indices
+        """
+        return self._longitude_axis.nearest(longitude)
+
+    def indices(self, latitude, longitude):
+        """
+        Find the indices of the grid points closest to coordinates
+
+        Args:
+            latitude (float or numpy.ndarray): Latitudes in degrees
+            longitude (float or numpy.ndarray): Longitudes in degrees, broadcastable to latitude
+
+        Returns:
+            Tuple of the latitude indices and the longitude indices
+        """
+        return self.latitude_index(latitude), self.longitude_index(longitude)
+
+    def interpolate(self, field, latitude, longitude, mode="nearest"):
+        """
+        Sample fields at coordinates
+
+        Args:
+            field (numpy.ndarray): Fields with latitude and longitude as last dimensions, e.g. a
+                                   map with dimensions time, level, latitude, longitude
+            latitude (float or numpy.ndarray): Latitudes in degrees
+            longitude (float or numpy.ndarray): Longitudes in degrees, broadcastable to latitude
+            mode (str, optional): "nearest" to take the closest grid point or "bilinear" to
+                                  interpolate between the four surrounding grid points
+                Defaults to "nearest"
+
+        Returns:
+            numpy.ndarray with the leading dimensions of field and the dimensions of the
+            coordinates
+        """
+        field = np.asarray(field, dtype=float)
+        (latitude, longitude) = np.broadcast_arrays(latitude, longitude)
+        if mode == "nearest":
+            return field[..., self.latitude_index(latitude), self.longitude_index(longitude)]
+        if mode == "bilinear":
+            (lat_indices, lat_weights) = self._latitude_axis.bracket(latitude)
+            (lon_indices, lon_weights) = self._longitude_axis.bracket(longitude)
+            values = 0
+            for i in range(2):
+                for j in range(2):
+                    values = values + (field[..., lat_indices[i], lon_indices[j]]
+                                       * (lat_weights[i] * lon_weights[j]))
+            return values
+        raise ValueError("Mode {} not available, choose one of {}".format(mode, MODES))
+
+    def box(self, south, north, west, east):
+        """
+        Find the smallest box centred on a grid point that covers a region, as arguments of
+        calculations.derive
+
+        Args:
+            south (float): Southern latitude of the region in degrees
+            north (float): Northern latitude of the region in degrees
+            west (float): Western longitude of the region in degrees
+            east (float): Eastern longitude of the region in degrees, regions crossing the
+                          dateline of a global grid may have east < west
+
+        Returns:
+            Dictionary with lat, lon, lat_step and lon_step
+        """
+        lat_indices = np.flatnonzero((self.latitudes >= min(south, north))
+                                     & (self.latitudes <= max(south, north)))
+        if len(lat_indices) == 0:
+            lat_indices = np.atleast_1d(self.latitude_index(0.5 * (south + north)))
+        (lat_first, lat_last) = (lat_indices.min(), lat_indices.max())
+
+        len_longitude = len(self.longitudes)
+        if self.wrap_longitude and (east - west) % 360 == 0 and east != west:
+            (lon_first, count) = (0, len_longitude)
+        else:
+            (lon_first, lon_last) = (self.longitude_index(west), self.longitude_index(east))
+            if self.wrap_longitude:
+                count = (lon_last - lon_first) % len_longitude + 1
+            else:
+                (lon_first, count) = (min(lon_first, lon_last), abs(lon_last - lon_first) + 1)
+        return {"lat": int(lat_first + lat_last) // 2,
+                "lon": int(lon_first + count // 2) % len_longitude,
+                "lat_step": int(lat_last - lat_first + 1) // 2,
+                "lon_step": int(count // 2)}
+
+
+def nearest_index(coordinates, values, period=None):
+    """
+    Find the indices of the coordinates closest to values
+
+    Args:
+        coordinates (numpy.ndarray): 1 dimensional coordinates, in any order
+        values (float or numpy.ndarray): Values to look up
+        period (float, optional): Period of periodic coordinates, e.g. 360 for global longitudes
+            Defaults to None
+
+    Returns:
+        Index or numpy.ndarray of indices
+    """
+    return _Axis(np.asarray(coordinates, dtype=float), period).nearest(values)
+
+
+class _Axis:
+    """
+    Sorted coordinates of one dimension, optionally periodic
+    """
+    def __init__(self, coordinates, period=None):
+        self.order = np.argsort(coordinates, kind='mergesort')
+        self.sorted = coordinates[self.order]
+        self.period = period
+
+    def nearest(self, values):
+        values = self._normalize(values)
+        (left, right, weight) = self._neighbors(values)
+        nearest = np.where(weight > 0.5, right, left)
+        return self.order[nearest]
+
+    def bracket(self, values):
+        """
+        Returns:
+            Tuple of the indices of the grid coordinates below and above the values and their
+            linear interpolation weights
+        """
+        (left, right, weight) = self._neighbors(self._normalize(values))
+        return (self.order[left], self.order[right]), (1 - weight, weight)
+
+    def _normalize(self, values):
+        values = np.asarray(values, dtype=float)
+        if self.period is not None:
+            values = self.sorted[0] + np.mod(values - self.sorted[0], self.period)
+        return values
+
+    def _neighbors(self, values):
+        """
+        Find the sorted positions of the neighbouring grid coordinates and the relative distance
+        of the values from the left one, values outside a non-periodic axis are clamped
+        """
+        length = len(self.sorted)
+        if length == 1:
+            zeros = np.zeros(np.shape(values), dtype=int)
+            return zeros, zeros, np.zeros(np.shape(values))
+        right = np.searchsorted(self.sorted, values, side='right')
+        if self.period is not None:
+            #Between the last and the first coordinate, across the wrap
+            left = (right - 1) % length
+            right = right % length
+            upper = np.where(right == 0, self.sorted[0] + self.period, self.sorted[right])
+            lower = self.sorted[left]
+        else:
+            right = np.clip(right, 1, length - 1)
+            left = right - 1
+            (lower, upper) = (self.sorted[left], self.sorted[right])
+        weight = np.clip((values - lower) / (upper - lower), 0, 1)
+        return left, right, weight
@@ -0,0 +1,453 @@
+"""
+Module to estimate information-theoretic measures between many series and a reference series
+
+All series of a map are discretized at once and the entropies of all series are computed
+together from joint histograms counted with np.bincount. The binning is explicit:
+
+    integer:     truncate the series, shifted to non-negative values (what pyinform does
+                 with float series)
+    equal_width: bins of equal width between the minimum and the maximum of each series
+    quantile:    bins with (about) the same number of values of each series
+    ksg:         no binning, the k-nearest-neighbor estimator of Kraskov, Stoegbauer and
+                 Grassberger (only for mutual_information). Unlike the binnings, it searches
+                 the neighbors of every series separately and is much slower on large maps.
+
+Series containing NaN (e.g. fill values of datasets.LazyMap) get NaN, the other series of the
+map are not affected. All values are in bits.
+"""
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.special import digamma
+
+BINNINGS = ["integer", "equal_width", "quantile", "ksg"]
+
+#Number of bins of the histograms of all series up to which states are counted without
+#renumbering them first
+HISTOGRAM_SIZE = 2 ** 24
+
+
+def discretize(series, binning="integer", bins=10):
+    """
+    Discretize series into integer states
+
+    Args:
+        series (numpy.ndarray): Series with time as first dimension, e.g. time, latitude, longitude
+        binning (str, optional): One of "integer", "equal_width" or "quantile"
+            Defaults to "integer"
+        bins (int, optional): Number of bins of "equal_width" and "quantile"
+            Defaults to 10
+
+    Returns:
+        numpy.ndarray of non-negative integers with the shape of series
+    """
+    series = np.asarray(series, dtype=float)
+    rows = np.ascontiguousarray(series.reshape(series.shape[0], -1).T)
+    return _discretize_rows(rows, binning, bins).T.reshape(series.shape)
+
+
+def mutual_information(map_array, reference_series, binning="integer", bins=10, neighbors=3):
+    """
+    Compute the Mutual Information between every series of a map and a reference series
+
+    Args:
+        map_array (numpy.ndarray): Map with time as first dimension, e.g. time, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        binning (str, optional): One of BINNINGS
+            Defaults to "integer"
+        bins (int, optional): Number of bins of "equal_width" and "quantile"
+            Defaults to 10
+        neighbors (int, optional): Number of nearest neighbors of "ksg"
+            Defaults to 3
+
+    Returns:
+        numpy.ndarray with the dimensions of map_array except time containing the Mutual
+        Information between each series and the reference series
+    """
+    (series, reference, shape, missing) = _flatten(map_array, reference_series)
+    if binning == "ksg":
+        return _mask(_ksg_mutual_information(series, reference, neighbors), missing, shape)
+
+    (states, reference_states) = _discretize_pair(series, reference, binning, bins)
+    information = (_entropies(states) + _entropies(reference_states)
+                   - _entropies(_combine(states, reference_states)))
+    return _mask(information, missing, shape)
+
+
+def conditional_entropy(map_array, reference_series, binning="integer", bins=10):
+    """
+    Compute the Conditional Entropy of a reference series given every series of a map
+
+    Args:
+        map_array (numpy.ndarray): Map with time as first dimension, e.g. time, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        binning (str, optional): One of "integer", "equal_width" or "quantile"
+            Defaults to "integer"
+        bins (int, optional): Number of bins of "equal_width" and "quantile"
+            Defaults to 10
+
+    Returns:
+        numpy.ndarray with the dimensions of map_array except time containing the Conditional
+        Entropy of the reference series given each series
+    """
+    (series, reference, shape, missing) = _flatten(map_array, reference_series)
+    (states, reference_states) = _discretize_pair(series, reference, binning, bins)
+    entropy = _entropies(_combine(states, reference_states)) - _entropies(states)
+    return _mask(entropy, missing, shape)
+
+
+def transfer_entropy(map_array, reference_series, k=2, lag=1, binning="integer", bins=10):
+    """
+    Compute the Transfer Entropy from every series of a map to a reference series
+
+    The next value of the reference series is predicted from its last k values and the value of
+    the series of the map lag time steps before.
+
+    Args:
+        map_array (numpy.ndarray): Map with time as first dimension, e.g. time, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        k (int, optional): Length of the history of the reference series
+            Defaults to 2
+        lag (int, optional): Time steps between the source value and the predicted value
+            Defaults to 1
+        binning (str, optional): One of "integer", "equal_width" or "quantile"
+            Defaults to "integer"
+        bins (int, optional): Number of bins of "equal_width" and "quantile"
+            Defaults to 10
+
+    Returns:
+        numpy.ndarray with the dimensions of map_array except time containing the Transfer
+        Entropy from each series to the reference series
+    """
+    (series, reference, shape, missing) = _flatten(map_array, reference_series)
+    (states, reference_states) = _discretize_pair(series, reference, binning, bins)
+    len_time = states.shape[1]
+    start = max(k, lag)
+    if k < 1 or lag < 1 or start >= len_time:
+        raise ValueError("History length k={} and lag={} must be between 1 and the length of the "
+                         "series {}".format(k, lag, len_time))
+
+    following = reference_states[:, start:]
+    history = reference_states[:, start - 1:len_time - 1]
+    for j in range(2, k + 1):
+        history = _combine(history, reference_states[:, start - j:len_time - j])
+    source = states[:, start - lag:len_time - lag]
+
+    history_source = _combine(history, source)
+    entropy = (_entropies(_combine(following, history)) + _entropies(history_source)
+               - _entropies(_combine(following, history_source)) - _entropies(history))
+    return _mask(entropy, missing, shape)
+
+
+def mutual_information_of_references(map_array, references, binning="integer", bins=10):
+    """
+    Compute the Mutual Information between every series of a map and each of several reference
+    series, e.g. one reference series shifted by different time lags
+
+    The map is discretized and its entropies are computed once for all reference series.
+
+    Args:
+        map_array (numpy.ndarray): Map with time as first dimension, e.g. time, latitude, longitude
+        references (list): 1 dimensional reference series
+        binning (str, optional): One of "integer", "equal_width" or "quantile"
+            Defaults to "integer"
+        bins (int, optional): Number of bins of "equal_width" and "quantile"
+            Defaults to 10
+
+    Returns:
+        numpy.ndarray with dimensions reference and the dimensions of map_array except time
+    """
+    (states, entropies, shape, missing) = _discretize_map(map_array, binning, bins)
+    information = np.empty((len(references), states.shape[0]))
+    for i, reference_series in enumerate(references):
+        (reference_states, reference_missing) = _discretize_reference(reference_series, binning,
+                                                                      bins)
+        information[i] = (entropies + _entropies(reference_states)
+                          - _entropies(_combine(states, reference_states)))
+        information[i, missing | reference_missing] = np.nan
+    return information.reshape((len(references),) + shape)
+
+
+def conditional_entropy_of_references(map_array, references, binning="integer", bins=10):
+    """
+    Compute the Conditional Entropy of each of several reference series given every series of a
+    map, see mutual_information_of_references
+
+    Args:
+        map_array (numpy.ndarray): Map with time as first dimension, e.g. time, latitude, longitude
+        references (list): 1 dimensional reference series
+        binning (str, optional): One of "integer", "equal_width" or "quantile"
+            Defaults to "integer"
+        bins (int, optional): Number of bins of "equal_width" and "quantile"
+            Defaults to 10
+
+    Returns:
+        numpy.ndarray with dimensions reference and the dimensions of map_array except time
+    """
+    (states, entropies, shape, missing) = _discretize_map(map_array, binning, bins)
+    entropy = np.empty((len(references), states.shape[0]))
+    for i, reference_series in enumerate(references):
+        (reference_states, reference_missing) = _discretize_reference(reference_series, binning,
+                                                                      bins)
+        entropy[i] = _entropies(_combine(states, reference_states)) - entropies
+        entropy[i, missing | reference_missing] = np.nan
+    return entropy.reshape((len(references),) + shape)
+
+
+def _discretize_map(map_array, binning, bins):
+    """
+    Discretize all series of a map and compute their entropies, which are shared by several
+    reference series
+
+    Args:
+        map_array (numpy.ndarray): Map with time as first dimension, e.g. time, latitude, longitude
+        binning (str): One of "integer", "equal_width" or "quantile"
+        bins (int): Number of bins of "equal_width" and "quantile"
+
+    Returns:
+        Tuple of the compacted states of the map (series, time), their entropies, the shape of
+        the map without time and which series contain NaN
+    """
+    (series, _, shape, missing) = _flatten(map_array, [])
+    if binning == "ksg":
+        raise ValueError("The ksg estimator is only available for mutual_information")
+    states = _compact(_discretize_rows(series, binning, bins))
+    return states, _entropies(states), shape, missing
+
+
+def _discretize_reference(reference_series, binning, bins):
+    """
+    Discretize a reference series, a reference series containing NaN is discretized as zeros
+
+    Args:
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        binning (str): One of "integer", "equal_width" or "quantile"
+        bins (int): Number of bins of "equal_width" and "quantile"
+
+    Returns:
+        Tuple of the compacted states of the reference series (one row) and whether it
+        contains NaN
+    """
+    reference = np.asarray(reference_series, dtype=float).reshape(1, -1)
+    missing = bool(np.isnan(reference).any())
+    if missing:
+        reference = np.zeros(reference.shape)
+    return _compact(_discretize_rows(reference, binning, bins)), missing
+
+
+def _flatten(map_array, reference_series):
+    """
+    Arrange the series of a map as rows and mark the series containing NaN as missing
+
+    Missing series are replaced by zeros, so that they can be discretized with the others. If
+    the reference series contains NaN, it is replaced by zeros and all series are missing.
+
+    Args:
+        map_array (numpy.ndarray): Map with time as first dimension, e.g. time, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+
+    Returns:
+        Tuple of the map as 2 dimensional array with one row per series (series, time), the
+        reference series as array with one row, the shape of the map without time and which
+        series are missing
+    """
+    map_array = np.asarray(map_array, dtype=float)
+    rows = np.ascontiguousarray(map_array.reshape(map_array.shape[0], -1).T)
+    reference = np.asarray(reference_series, dtype=float).reshape(1, -1)
+    missing = np.isnan(rows).any(axis=1)
+    if missing.any():
+        rows = np.where(missing[:, np.newaxis], 0, rows)
+    if np.isnan(reference).any():
+        (reference, missing) = (np.zeros(reference.shape), np.ones(len(rows), dtype=bool))
+    return rows, reference, map_array.shape[1:], missing
+
+
+def _mask(values, missing, shape):
+    """
+    Set the results of missing series to NaN and restore the shape of the map
+
+    Args:
+        values (numpy.ndarray): 1 dimensional results, one per series (modified in place)
+        missing (numpy.ndarray): Boolean array marking the series containing NaN, see _flatten
+        shape (tuple): Shape of the map without time
+
+    Returns:
+        values with NaN for the missing series, reshaped to shape
+    """
+    values[missing] = np.nan
+    return values.reshape(shape)
+
+
+def _discretize_rows(rows, binning, bins):
+    """
+    Discretize every row of a 2 dimensional array - series, time, see discretize
+    """
+    if binning == "integer":
+        #Like similarity_measures.shift_to_positive followed by the conversion of pyinform
+        minimum = rows.min(axis=1, keepdims=True)
+        return np.where(minimum < 0, rows - minimum, rows).astype(np.int64)
+    if binning == "equal_width":
+        minimum = rows.min(axis=1, keepdims=True)
+        width = rows.max(axis=1, keepdims=True) - minimum
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scaled = (rows - minimum) / width * bins
+        scaled[~np.isfinite(scaled)] = 0 #Constant series fall in one bin
+        return np.minimum(scaled.astype(np.int64), bins - 1)
+    if binning == "quantile":
+        return _rank(rows, dense=False) * bins // rows.shape[1]
+    raise ValueError("Binning {} not available, choose one of {}".format(binning, BINNINGS[:3]))
+
+
+def _discretize_pair(series, reference, binning, bins):
+    """
+    Discretize the series of a map and a reference series with the same binning
+
+    Args:
+        series (numpy.ndarray): 2 dimensional array - series, time
+        reference (numpy.ndarray): Reference series with one row
+        binning (str): One of "integer", "equal_width" or "quantile"
+        bins (int): Number of bins of "equal_width" and "quantile"
+
+    Returns:
+        Tuple of the compacted states of the series and of the reference series
+    """
+    if binning == "ksg":
+        raise ValueError("The ksg estimator is only available for mutual_information")
+    return (_compact(_discretize_rows(series, binning, bins)),
+            _compact(_discretize_rows(reference, binning, bins)))
+
+
+def _rank(rows, dense):
+    """
+    Rank the values of every row, equal values get the same rank
+
+    Args:
+        rows (numpy.ndarray): 2 dimensional array - series, time
+        dense (bool): Number the distinct values consecutively (0, 1, 2, ...) instead of giving
+                      them the number of smaller values (like rankdata with method "min" - 1)
+
+    Returns:
+        numpy.ndarray of integers with the ranks
+    """
+    order = np.argsort(rows, axis=1, kind='mergesort')
+    ordered = np.take_along_axis(rows, order, axis=1)
+    new = np.ones(rows.shape, dtype=bool)
+    new[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    if dense:
+        ranks_ordered = np.cumsum(new, axis=1) - 1
+    else:
+        ranks_ordered = np.maximum.accumulate(np.where(new, np.arange(rows.shape[1]), 0), axis=1)
+    ranks = np.empty(rows.shape, dtype=np.int64)
+    np.put_along_axis(ranks, order, ranks_ordered, axis=1)
+    return ranks
+
+
+def _compact(states):
+    """
+    Number the distinct states of every row consecutively from 0 if their histograms would be
+    too large
+
+    Entropies do not depend on the labels of the states, and after compacting a row of
+    length n has less than n states, which bounds the size of the histograms.
+
+    Args:
+        states (numpy.ndarray): 2 dimensional integer array - series, time
+
+    Returns:
+        numpy.ndarray of the same shape with the states of each row
+    """
+    n_states = int(states.max()) + 1
+    if n_states <= states.shape[1] or n_states * states.shape[0] <= HISTOGRAM_SIZE:
+        return states
+    return _rank(states, dense=True)
+
+
+def _combine(states1, states2):
+    """
+    Combine the states of two variables into the states of the joint variable
+
+    Args:
+        states1 (numpy.ndarray): 2 dimensional states - series, time
+        states2 (numpy.ndarray): 2 dimensional states, broadcastable to states1
+
+    Returns:
+        Joint states
+    """
+    return _compact(states1 * (int(states2.max()) + 1) + states2)
+
+
+def _entropies(states):
+    """
+    Compute the entropy of every row of states from a joint histogram of all rows
+
+    Args:
+        states (numpy.ndarray): 2 dimensional states - series, time
+
+    Returns:
+        numpy.ndarray with the entropy in bits of each row
+    """
+    (n_series, len_time) = states.shape
+    n_states = int(states.max()) + 1
+    offsets = np.arange(n_series)[:, np.newaxis] * n_states
+    counts = np.bincount((states + offsets).ravel(), minlength=n_series * n_states)
+    counts = counts.reshape(n_series, n_states).astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weighted = np.where(counts > 0, counts * np.log2(counts), 0)
+    return np.log2(len_time) - weighted.sum(axis=1) / len_time
+
+
+def _ksg_mutual_information(series, reference, neighbors=3, random_state=0):
+    """
+    Estimate the Mutual Information with the first algorithm of Kraskov, Stoegbauer and
+    Grassberger from the distances to the nearest neighbors
+
+    The series are standardized and a tiny reproducible noise breaks ties between equal values.
+    Every series builds its own k-d tree in a loop, so the cost grows with the number of series
+    times n log n, far above the binned estimators.
+
+    Args:
+        series (numpy.ndarray): 2 dimensional array - series, time
+        reference (numpy.ndarray): Reference series with one row
+        neighbors (int, optional): Number of nearest neighbors
+            Defaults to 3
+        random_state (int, optional): Seed of the noise
+            Defaults to 0
+
+    Returns:
+        numpy.ndarray with the Mutual Information in bits of each series
+    """
+    rng = np.random.RandomState(random_state)
+    len_time = series.shape[1]
+    (series, reference) = (_standardize(series), _standardize(reference))
+    series = series + 1e-10 * rng.randn(*series.shape)
+    reference = reference[0] + 1e-10 * rng.randn(len_time)
+
+    reference_sorted = np.sort(reference)
+    information = np.empty(series.shape[0])
+    for i in range(series.shape[0]):
+        points = np.column_stack([series[i], reference])
+        #Distance to the k-th neighbor in the maximum norm, the point itself is the first
+        radius = cKDTree(points).query(points, k=neighbors + 1, p=np.inf)[0][:, -1]
+        n_series = _count_within(np.sort(series[i]), series[i], radius)
+        n_reference = _count_within(reference_sorted, reference, radius)
+        information[i] = (digamma(neighbors) + digamma(len_time)
+                          - np.mean(digamma(n_series + 1) + digamma(n_reference + 1)))
+    return information / np.log(2)
+
+
+def _standardize(series):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        standardized = ((series - series.mean(axis=1, keepdims=True))
+                        / series.std(axis=1, keepdims=True))
+    standardized[~np.isfinite(standardized)] = 0
+    return standardized
+
+
+def _count_within(values_sorted, values, radius):
+    """
+    Count the other values closer than radius to each value
+
+    Returns:
+        numpy.ndarray with the number of values with a distance strictly less than radius
+    """
+    return (np.searchsorted(values_sorted, values + radius, side='left')
+            - np.searchsorted(values_sorted, values - radius, side='right') - 1)
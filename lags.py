@@ -0,0 +1,229 @@
+"""
+Module to compute similarities between a map and a reference series shifted by many time lags
+
+Shifting follows calculations.shift: the reference series is shifted to the left by the lag and
+the values shifted in are filled with its mean. Measures registered in LAG_MEASURES compute all
+lags at once: Pearson's correlation from one FFT cross-correlation of every series of the map with
+the reference series, Spearman's correlation from ranks of the map computed once and the
+information measures from the discretized map computed once. Other measures are computed lag by
+lag, see calculations.calculate_lagged_similarities.
+"""
+import functools
+import numpy as np
+from scipy.stats import rankdata
+import information
+import similarity_measures
+
+
+def shift(series, lag):
+    """
+    Shift a series to the left by lag time steps, filling the values shifted in with its mean
+
+    Args:
+        series (numpy.ndarray): 1 dimensional series
+        lag (int): Number of time steps, negative values shift to the right
+
+    Returns:
+        numpy.ndarray with the shifted series, like calculations.shift
+    """
+    series = np.asarray(series, dtype=float)
+    shifted = np.full(len(series), series.mean())
+    if lag >= 0:
+        shifted[:max(len(series) - lag, 0)] = series[lag:]
+    else:
+        shifted[-lag:] = series[:max(len(series) + lag, 0)]
+    return shifted
+
+
+def pearson_correlation_lags(map_array, reference_series, lags):
+    """
+    Compute the Pearson correlation coefficient between every series of a map and a reference
+    series shifted by every lag
+
+    Since the map series are centered, filling with the mean of the reference series adds
+    nothing to the covariance, which is therefore the cross-correlation of the centered series
+    at the lag. It is computed for all lags with one FFT per series. The variance of the shifted
+    reference series only depends on the lag.
+
+    Args:
+        map_array (numpy.ndarray): Map with time as first dimension, e.g. time, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        lags (list): Time lags, see shift
+
+    Returns:
+        numpy.ndarray with dimensions lag and the dimensions of map_array except time
+    """
+    map_array = np.asarray(map_array, dtype=float)
+    len_time = map_array.shape[0]
+    series = map_array.reshape(len_time, -1)
+    centered = series - series.mean(axis=0)
+    reference = np.asarray(reference_series, dtype=float)
+    reference = reference - reference.mean()
+
+    n_fft = 1 << int(np.ceil(np.log2(2 * len_time - 1)))
+    spectrum = np.conj(np.fft.rfft(centered, n_fft, axis=0)) * np.fft.rfft(reference, n_fft)[:, None]
+    cross_correlation = np.fft.irfft(spectrum, n_fft, axis=0)
+
+    lags = np.asarray(lags, dtype=int)
+    covariance = np.zeros((len(lags), series.shape[1]))
+    reference_norm = np.zeros(len(lags))
+    for i, lag in enumerate(lags):
+        if abs(lag) >= len_time:
+            continue
+        covariance[i] = cross_correlation[lag % n_fft]
+        overlap = reference[lag:] if lag >= 0 else reference[:len_time + lag]
+        reference_norm[i] = np.sqrt(max(np.sum(np.square(overlap))
+                                        - np.square(np.sum(overlap)) / len_time, 0))
+
+    norm = np.sqrt(np.sum(np.square(centered), axis=0)) * reference_norm[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correlation = covariance / norm
+    return np.clip(correlation, -1, 1).reshape((len(lags),) + map_array.shape[1:])
+
+
+def pearson_correlation_abs_lags(map_array, reference_series, lags):
+    """
+    Compute the absolute Pearson correlation coefficient for every lag, see
+    pearson_correlation_lags
+
+    Returns:
+        numpy.ndarray with dimensions lag and the dimensions of map_array except time
+    """
+    return np.abs(pearson_correlation_lags(map_array, reference_series, lags))
+
+
+def spearman_correlation_lags(map_array, reference_series, lags):
+    """
+    Compute the Spearman correlation coefficient between every series of a map and a reference
+    series shifted by every lag
+
+    The map is ranked and centered once, the correlations with all shifted reference series are
+    one matrix product.
+
+    Args:
+        map_array (numpy.ndarray): Map with time as first dimension, e.g. time, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        lags (list): Time lags, see shift
+
+    Returns:
+        numpy.ndarray with dimensions lag and the dimensions of map_array except time
+    """
+    map_array = np.asarray(map_array, dtype=float)
+    ranks = rankdata(map_array.reshape(map_array.shape[0], -1), axis=0)
+    centered = ranks - ranks.mean(axis=0)
+
+    references = np.array([rankdata(shift(reference_series, lag)) for lag in lags])
+    references -= references.mean(axis=1, keepdims=True)
+    covariance = np.dot(references, centered)
+    norm = np.outer(np.linalg.norm(references, axis=1), np.linalg.norm(centered, axis=0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correlation = covariance / norm
+    return np.clip(correlation, -1, 1).reshape((len(lags),) + map_array.shape[1:])
+
+
+def mutual_information_lags(map_array, reference_series, lags, binning="integer", bins=10,
+                            neighbors=3):
+    """
+    Compute the Mutual Information between every series of a map and a reference series shifted
+    by every lag, discretizing the map once
+
+    Args:
+        map_array (numpy.ndarray): Map with time as first dimension, e.g. time, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        lags (list): Time lags, see shift
+        binning (str, optional): One of information.BINNINGS
+            Defaults to "integer"
+        bins (int, optional): Number of bins of "equal_width" and "quantile"
+            Defaults to 10
+        neighbors (int, optional): Number of nearest neighbors of "ksg"
+            Defaults to 3
+
+    Returns:
+        numpy.ndarray with dimensions lag and the dimensions of map_array except time
+    """
+    if binning == "ksg":
+        return np.array([information.mutual_information(map_array, shift(reference_series, lag),
+                                                        binning, bins, neighbors)
+                         for lag in lags])
+    return information.mutual_information_of_references(
+        map_array, [shift(reference_series, lag) for lag in lags], binning, bins)
+
+
+def conditional_entropy_lags(map_array, reference_series, lags, binning="integer", bins=10):
+    """
+    Compute the Conditional Entropy of a reference series shifted by every lag given every series
+    of a map, discretizing the map once
+
+    Args:
+        map_array (numpy.ndarray): Map with time as first dimension, e.g. time, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        lags (list): Time lags, see shift
+        binning (str, optional): One of "integer", "equal_width" or "quantile"
+            Defaults to "integer"
+        bins (int, optional): Number of bins of "equal_width" and "quantile"
+            Defaults to 10
+
+    Returns:
+        numpy.ndarray with dimensions lag and the dimensions of map_array except time
+    """
+    return information.conditional_entropy_of_references(
+        map_array, [shift(reference_series, lag) for lag in lags], binning, bins)
+
+
+def best_lags(similarities, lags, maximize=True):
+    """
+    Find the lag with the highest (or lowest) similarity for every point
+
+    Args:
+        similarities (numpy.ndarray): Similarities with dimensions lag, latitude, longitude
+        lags (list): Time lags of the similarities
+        maximize (bool, optional): True for similarity measures, False for distances
+            Defaults to True
+
+    Returns:
+        Tuple of a map of the best lags and a map of the similarity at the best lag, both NaN
+        where all similarities are NaN
+    """
+    similarities = np.asarray(similarities, dtype=float)
+    worst = -np.inf if maximize else np.inf
+    filled = np.where(np.isnan(similarities), worst, similarities)
+    best = np.argmax(filled, axis=0) if maximize else np.argmin(filled, axis=0)
+    best_value = np.take_along_axis(similarities, best[np.newaxis], axis=0)[0]
+    best_lag = np.asarray(lags, dtype=float)[best]
+    best_lag[np.all(np.isnan(similarities), axis=0)] = np.nan
+    return best_lag, best_value
+
+
+#Measures that compute all lags at once
+LAG_MEASURES = {
+    similarity_measures.pearson_correlation: pearson_correlation_lags,
+    similarity_measures.pearson_correlation_abs: pearson_correlation_abs_lags,
+    similarity_measures.spearman_correlation: spearman_correlation_lags,
+    similarity_measures.mutual_information: mutual_information_lags,
+    similarity_measures.conditional_entropy: conditional_entropy_lags,
+}
+
+
+def get_lag_measure(sim_func):
+    """
+    Look up the counterpart of a similarity measure that computes all lags at once
+
+    A functools.partial of a registered measure with keyword arguments is mapped to the same
+    partial of its counterpart, like similarity_measures.get_map_measure.
+
+    Args:
+        sim_func (function): Similarity measure that compares two series
+
+    Returns:
+        Function that takes a map with time as first dimension, a reference series and the lags,
+        or None if sim_func has no such counterpart
+    """
+    if isinstance(sim_func, functools.partial):
+        lag_func = None if sim_func.args else get_lag_measure(sim_func.func)
+        if lag_func is None:
+            return None
+        return functools.partial(lag_func, **sim_func.keywords)
+    try:
+        return LAG_MEASURES.get(sim_func)
+    except TypeError: #Unhashable callables can not be looked up
+        return None
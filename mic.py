@@ -0,0 +1,168 @@
+"""
+Module to compute the Maximal Information Coefficient (MIC) of many series and a reference series
+
+minepy estimators are kept in a pool with one estimator per configuration and thread, so the
+workers of a map computation configure their estimators once instead of once per point. Whole
+blocks of series are scored with minepy.cstats if the installed minepy offers it.
+
+For screening, approximate_mic computes a fast approximation of MIC without minepy: the largest
+normalized mutual information over the equal-frequency grids allowed by alpha, vectorized over
+all series.
+"""
+import threading
+import numpy as np
+from scipy.stats import rankdata
+import minepy # pylint: disable=E0401
+
+#Parameters of minepy.MINE: exponent of the maximal grid size B(n) = n^alpha, clumping factor c
+#and estimator ("mic_approx" or "mic_e")
+DEFAULT_ALPHA = 0.6
+DEFAULT_C = 15
+DEFAULT_EST = "mic_approx"
+
+_pool = threading.local()
+
+
+def get_estimator(alpha=DEFAULT_ALPHA, c=DEFAULT_C, est=DEFAULT_EST):
+    """
+    Get the minepy.MINE estimator of this thread with the given configuration
+
+    Args:
+        alpha (float, optional): Exponent of the maximal grid size, or the grid size if > 1
+            Defaults to DEFAULT_ALPHA
+        c (float, optional): Clumping factor
+            Defaults to DEFAULT_C
+        est (str, optional): Estimator, "mic_approx" or "mic_e"
+            Defaults to DEFAULT_EST
+
+    Returns:
+        minepy.MINE
+    """
+    estimators = getattr(_pool, "estimators", None)
+    if estimators is None:
+        estimators = _pool.estimators = {}
+    key = (alpha, c, est)
+    if key not in estimators:
+        estimators[key] = minepy.MINE(alpha=alpha, c=c, est=est)
+    return estimators[key]
+
+
+def mic(series1, series2, alpha=DEFAULT_ALPHA, c=DEFAULT_C, est=DEFAULT_EST):
+    """
+    Compute the Maximal Information Coefficient between two series with a pooled estimator
+
+    Args:
+        series1 (numpy.ndarray): First series
+        series2 (numpy.ndarray): Second series
+        alpha (float, optional): Exponent of the maximal grid size, or the grid size if > 1
+            Defaults to DEFAULT_ALPHA
+        c (float, optional): Clumping factor
+            Defaults to DEFAULT_C
+        est (str, optional): Estimator, "mic_approx" or "mic_e"
+            Defaults to DEFAULT_EST
+
+    Returns:
+        Maximal Information Coefficient between the two series
+    """
+    estimator = get_estimator(alpha, c, est)
+    estimator.compute_score(np.asarray(series1, dtype=float), np.asarray(series2, dtype=float))
+    return estimator.mic()
+
+
+def mic_map(map_array, reference_series, alpha=DEFAULT_ALPHA, c=DEFAULT_C, est=DEFAULT_EST,
+            chunk_size=1024):
+    """
+    Compute the Maximal Information Coefficient between every series of a map and a reference
+    series
+
+    Blocks of series are scored with one call of minepy.cstats, older minepy versions without
+    cstats use the pooled estimator for every series.
+
+    Args:
+        map_array (numpy.ndarray): Map with time as first dimension, e.g. time, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        alpha (float, optional): Exponent of the maximal grid size, or the grid size if > 1
+            Defaults to DEFAULT_ALPHA
+        c (float, optional): Clumping factor
+            Defaults to DEFAULT_C
+        est (str, optional): Estimator, "mic_approx" or "mic_e"
+            Defaults to DEFAULT_EST
+        chunk_size (int, optional): Number of series scored in one call of minepy.cstats
+            Defaults to 1024
+
+    Returns:
+        numpy.ndarray with the dimensions of map_array except time containing the Maximal
+        Information Coefficient between each series and the reference series
+    """
+    map_array = np.asarray(map_array, dtype=float)
+    rows = np.ascontiguousarray(map_array.reshape(map_array.shape[0], -1).T)
+    reference = np.ascontiguousarray(np.asarray(reference_series, dtype=float)[np.newaxis, :])
+
+    coefficients = np.empty(rows.shape[0])
+    if not hasattr(minepy, "cstats"):
+        for i, row in enumerate(rows):
+            coefficients[i] = mic(row, reference[0], alpha, c, est)
+        return coefficients.reshape(map_array.shape[1:])
+
+    for start in range(0, rows.shape[0], chunk_size):
+        (block_mic, _) = minepy.cstats(reference, rows[start:start + chunk_size],
+                                       alpha=alpha, c=c, est=est)
+        coefficients[start:start + chunk_size] = block_mic[0]
+    return coefficients.reshape(map_array.shape[1:])
+
+
+def approximate_mic(map_array, reference_series, alpha=DEFAULT_ALPHA):
+    """
+    Approximate the Maximal Information Coefficient between every series of a map and a
+    reference series for screening
+
+    MIC is the largest mutual information I over the grids with x times y cells (x * y <= B(n)),
+    normalized by log(min(x, y)). MINE searches the best partition for each grid size, this
+    approximation only evaluates the equal-frequency partitions, with equal values always in the
+    same bin. It is computed for all series at once with histograms and meant to find the series
+    worth computing MIC for, its values are not comparable to those of minepy. Series containing
+    NaN get NaN, all series if the reference series contains NaN.
+
+    Args:
+        map_array (numpy.ndarray): Map with time as first dimension, e.g. time, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        alpha (float, optional): Exponent of the maximal grid size, or the grid size if > 1
+            Defaults to DEFAULT_ALPHA
+
+    Returns:
+        numpy.ndarray with the approximate Maximal Information Coefficient of each series
+    """
+    map_array = np.asarray(map_array, dtype=float)
+    reference_series = np.asarray(reference_series, dtype=float)
+    if np.isnan(reference_series).any():
+        return np.full(map_array.shape[1:], np.nan)
+    rows = map_array.reshape(map_array.shape[0], -1).T
+    (n_series, len_time) = rows.shape
+    max_cells = int(alpha) if alpha > 1 else max(int(len_time ** alpha), 4)
+    #Series containing NaN are ranked as zeros and masked afterwards
+    missing = np.isnan(rows).any(axis=1)
+    if missing.any():
+        rows = np.where(missing[:, np.newaxis], 0, rows)
+
+    #Ranks starting at 0 that are equal for tied values, equal-frequency bins are then
+    #ranks * bins // len_time
+    ranks = rankdata(rows, method='min', axis=1) - 1
+    reference_ranks = rankdata(reference_series, method='min') - 1
+    offsets = np.arange(n_series)[:, np.newaxis]
+
+    coefficients = np.zeros(n_series)
+    for bins in range(2, max_cells // 2 + 1):
+        states = ranks * bins // len_time
+        for reference_bins in range(2, max_cells // bins + 1):
+            reference_states = reference_ranks * reference_bins // len_time
+            joint = (offsets * bins + states) * reference_bins + reference_states
+            counts = np.bincount(joint.ravel(), minlength=n_series * bins * reference_bins)
+            counts = counts.reshape(n_series, bins, reference_bins) / float(len_time)
+            marginals = (counts.sum(axis=2, keepdims=True) * counts.sum(axis=1, keepdims=True))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                terms = np.where(counts > 0, counts * np.log(counts / marginals), 0)
+            information = terms.sum(axis=(1, 2)) / np.log(min(bins, reference_bins))
+            np.maximum(coefficients, information, out=coefficients)
+    coefficients = np.clip(coefficients, 0, 1)
+    coefficients[missing] = np.nan
+    return coefficients.reshape(map_array.shape[1:])
@@ -0,0 +1,298 @@
+"""
+Module computing the maps shown by the functions of plots, without plotting
+
+Every function returns a stack of maps with the rows and columns of the corresponding figure as
+leading dimensions, e.g. (time shift, measure, latitude, longitude) for
+plots.plot_time_delayed_dependencies. It does not import matplotlib or Basemap, so results can
+be computed on machines without a display and rendered later, e.g. with
+plots.render_figures.
+
+Maps are scaled with the scaling_func of the figure, every map on its own, see
+agreement.scale_similarities.
+"""
+import numpy as np
+import agreement as agr
+import calculations as calc
+import comparing as comp
+
+
+def similarities_whole_period(map_array, reference_series, measures,
+                              scaling_func=comp.binning_values_to_quantiles, level=0):
+    """
+    Compute the maps of plots.plot_similarities_whole_period
+
+    Args:
+        map_array (numpy.ndarray): Map with 4 dimensions - time, level, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        measures (list): List with similarity measures to compute similarity between two time series
+        scaling_func (function, optional): Function that scales a map of similarity values
+            Defaults to comp.binning_values_to_quantiles
+        level (int, optional): Level on which the similarity should be calculated
+            Defaults to 0
+
+    Returns:
+        numpy.ndarray with dimensions measure, latitude, longitude
+    """
+    similarities = calc.calculate_series_similarities(map_array, reference_series, measures, level)
+    return scale(similarities, scaling_func)
+
+
+def similarities_per_month(map_array, reference_series, measures,
+                           scaling_func=comp.binning_values_to_quantiles, level=0, n_years=40):
+    """
+    Compute the maps of plots.plot_similarities_whole_period_per_month
+
+    Args:
+        map_array (numpy.ndarray): Monthly map with 4 dimensions - time, level, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        measures (list): List with similarity measures to compute similarity between two time series
+        scaling_func (function, optional): Function that scales a map of similarity values
+            Defaults to comp.binning_values_to_quantiles
+        level (int, optional): Level on which the similarity should be calculated
+            Defaults to 0
+        n_years (int, optional): Number of years taken into account
+            Defaults to 40
+
+    Returns:
+        numpy.ndarray with dimensions month, measure, latitude, longitude
+    """
+    reference_series = np.asarray(reference_series)
+    similarities = []
+    for month in range(12):
+        #Only read the requested level of this month
+        map_array_month = np.asarray(map_array[month:12 * n_years:12, [level], :, :])
+        similarities.append(calc.calculate_series_similarities(
+            map_array_month, reference_series[month:12 * n_years:12], measures, 0))
+    return scale(np.array(similarities), scaling_func)
+
+
+def similarities_winter_only(map_array, reference_series, measures,
+                             scaling_func=comp.binning_values_to_quantiles, level=0, n_years=40):
+    """
+    Compute the maps of plots.plot_similarities_winter_only, the similarities over December,
+    January and February of every year
+
+    Args:
+        map_array (numpy.ndarray): Monthly map with 4 dimensions - time, level, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series starting in January
+        measures (list): List with similarity measures to compute similarity between two time series
+        scaling_func (function, optional): Function that scales a map of similarity values
+            Defaults to comp.binning_values_to_quantiles
+        level (int, optional): Level on which the similarity should be calculated
+            Defaults to 0
+        n_years (int, optional): Number of years taken into account
+            Defaults to 40
+
+    Returns:
+        numpy.ndarray with dimensions measure, latitude, longitude
+    """
+    #January, February and December of every year
+    winter_indices = (12 * np.arange(n_years)[:, np.newaxis] + [0, 1, 11]).ravel()
+    similarities = calc.calculate_series_similarities(map_array[winter_indices, :, :, :],
+                                                      np.asarray(reference_series)[winter_indices],
+                                                      measures, level)
+    return scale(similarities, scaling_func)
+
+
+def similarity_measures_combinations(map_array, reference_series, combination_func, measures,
+                                     scaling_func=comp.binning_values_to_quantiles, level=0):
+    """
+    Compute the maps of plots.plot_similarity_measures_combinations
+
+    Args:
+        map_array (numpy.ndarray): Map with 4 dimensions - time, level, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        combination_func (function): Function that combines two similarity values into one
+        measures (list): List with similarity measures to compute similarity between two time series
+        scaling_func (function, optional): Function that scales a map of similarity values
+            Defaults to comp.binning_values_to_quantiles
+        level (int, optional): Level on which the similarity should be calculated
+            Defaults to 0
+
+    Returns:
+        numpy.ndarray with dimensions measure, measure, latitude, longitude
+    """
+    similarities = similarities_whole_period(map_array, reference_series, measures, scaling_func,
+                                             level)
+    return np.array([[calc.combine_similarity_measures(similarity_i, similarity_j, combination_func)
+                      for similarity_j in similarities] for similarity_i in similarities])
+
+
+def level_of_agreement(map_array, reference_series, scoring_func, measures,
+                       scaling_func=comp.binning_values_to_quantiles, level=0):
+    """
+    Compute the map of plots.plot_level_of_agreement
+
+    Args:
+        map_array (numpy.ndarray): Map with 4 dimensions - time, level, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        scoring_func (function): Function that takes values and outputs booleans, see
+                                 agreement.level_of_agreement
+        measures (list): List with similarity measures to compute similarity between two time series
+        scaling_func (function, optional): Function that scales a map of similarity values
+            Defaults to comp.binning_values_to_quantiles
+        level (int, optional): Level on which the similarity should be calculated
+            Defaults to 0
+
+    Returns:
+        numpy.ndarray with dimensions latitude, longitude
+    """
+    similarities = similarities_whole_period(map_array, reference_series, measures, scaling_func,
+                                             level)
+    return agr.level_of_agreement(similarities, scoring_func)
+
+
+def time_delayed_dependencies(map_array, reference_series, time_shifts, measures,
+                              scaling_func=comp.binning_values_to_quantiles, level=0):
+    """
+    Compute the maps of plots.plot_time_delayed_dependencies, with all time shifts in one pass
+    over the map
+
+    Args:
+        map_array (numpy.ndarray): Map with 4 dimensions - time, level, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        time_shifts (list): Time shifts of the reference series, see calculations.shift
+        measures (list): List with similarity measures to compute similarity between two time series
+        scaling_func (function, optional): Function that scales a map of similarity values
+            Defaults to comp.binning_values_to_quantiles
+        level (int, optional): Level on which the similarity should be calculated
+            Defaults to 0
+
+    Returns:
+        numpy.ndarray with dimensions time shift, measure, latitude, longitude
+    """
+    similarities = calc.calculate_lagged_similarities(map_array, reference_series, time_shifts,
+                                                      measures, level)
+    return scale(np.swapaxes(similarities, 0, 1), scaling_func)
+
+
+def similarities_to_different_datasets(datasets, reference_series, measures,
+                                       scaling_func=comp.binning_values_to_quantiles, level=0):
+    """
+    Compute the maps of plots.plot_similarities_to_different_datasets
+
+    Args:
+        datasets (list): List with datasets to compute the similarity to
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        measures (list): List with similarity measures to compute similarity between two time series
+        scaling_func (function, optional): Function that scales a map of similarity values
+            Defaults to comp.binning_values_to_quantiles
+        level (int, optional): Level on which the similarity should be calculated
+            Defaults to 0
+
+    Returns:
+        numpy.ndarray with dimensions dataset, measure, latitude, longitude
+    """
+    return np.array([similarities_whole_period(dataset, reference_series, measures, scaling_func,
+                                               level) for dataset in datasets])
+
+
+def similarities_to_different_levels(map_array, reference_series, measures, levels=None,
+                                     scaling_func=comp.binning_values_to_quantiles):
+    """
+    Compute the maps of plots.plot_similarities_to_different_levels, with all levels in one pass
+    over the map
+
+    Args:
+        map_array (numpy.ndarray): Map with 4 dimensions - time, level, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        measures (list): List with similarity measures to compute similarity between two time series
+        levels (list, optional): Indices of the levels
+            Defaults to None (all levels)
+        scaling_func (function, optional): Function that scales a map of similarity values
+            Defaults to comp.binning_values_to_quantiles
+
+    Returns:
+        numpy.ndarray with dimensions level, measure, latitude, longitude
+    """
+    similarities = calc.calculate_series_similarities_volume(map_array, reference_series, measures,
+                                                             levels)
+    return scale(np.swapaxes(similarities, 0, 1), scaling_func)
+
+
+def time_delayed_similarities_to_different_datasets(datasets, reference_series, time_shifts,
+                                                    measure,
+                                                    scaling_func=comp.binning_values_to_quantiles,
+                                                    level=0):
+    """
+    Compute the maps of plots.plot_time_delayed_similarities_to_different_datasets
+
+    Args:
+        datasets (list): List with datasets to compute the similarity to
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        time_shifts (list): Time shifts of the reference series, see calculations.shift
+        measure (function): Similarity measure to compute similarity between two time series
+        scaling_func (function, optional): Function that scales a map of similarity values
+            Defaults to comp.binning_values_to_quantiles
+        level (int, optional): Level on which the similarity should be calculated
+            Defaults to 0
+
+    Returns:
+        numpy.ndarray with dimensions dataset, time shift, latitude, longitude
+    """
+    return np.array([scale(calc.calculate_lagged_similarity(dataset, reference_series, time_shifts,
+                                                            level, measure)[0], scaling_func)
+                     for dataset in datasets])
+
+
+def time_delayed_agreement_areas(datasets, reference_series, time_shifts, measures, value_threshold,
+                                 agreement_threshold, agreement_func=np.std, filter_values_high=True,
+                                 filter_agreement_high=False,
+                                 scaling_func=comp.binning_values_to_quantiles, level=0):
+    """
+    Compute the maps of plots.plot_time_delayed_agreeableness_to_different_datasets, the agreement
+    areas of calculations.calculate_filtered_agreement_areas for every dataset and time shift
+
+    Args:
+        datasets (list): List with datasets to compute the similarity to
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        time_shifts (list): Time shifts of the reference series, see calculations.shift
+        measures (list): List with similarity measures to compute similarity between two time series
+        value_threshold (float): Threshold to filter the combined similarity values on
+        agreement_threshold (float): Threshold to filter the agreement on
+        agreement_func (function, optional): Function to compute agreement between similarity values
+            Defaults to np.std
+        filter_values_high (Boolean, optional): Keep combined similarity values >= (True) or
+                                                < (False) the threshold
+            Defaults to True
+        filter_agreement_high (Boolean, optional): Keep agreement values >= (True) or < (False)
+                                                   the threshold
+            Defaults to False
+        scaling_func (function, optional): Function that scales a map of similarity values
+            Defaults to comp.binning_values_to_quantiles
+        level (int, optional): Level on which the similarity should be calculated
+            Defaults to 0
+
+    Returns:
+        numpy.ndarray with dimensions dataset, time shift, latitude, longitude
+    """
+    areas = []
+    for dataset in datasets:
+        similarities = scale(calc.calculate_lagged_similarities(dataset, reference_series,
+                                                                time_shifts, measures, level),
+                             scaling_func)
+        areas.append([agr.agreement_areas(np.mean(similarities[:, j], axis=0),
+                                          agreement_func(similarities[:, j], axis=0),
+                                          [value_threshold], [agreement_threshold],
+                                          filter_values_high, filter_agreement_high)[0, 0]
+                      for j in range(len(time_shifts))])
+    return np.array(areas, dtype=float)
+
+
+def scale(maps, scaling_func=comp.binning_values_to_quantiles):
+    """
+    Scale every map of a stack with any number of leading dimensions
+
+    Args:
+        maps (numpy.ndarray): Maps with latitude and longitude as last dimensions
+        scaling_func (function, optional): Function that scales a map, None keeps the values
+            Defaults to comp.binning_values_to_quantiles
+
+    Returns:
+        numpy.ndarray of the shape of maps with the scaled maps
+    """
+    maps = np.asarray(maps, dtype=float)
+    if scaling_func is None:
+        return maps
+    scaled = agr.scale_similarities(maps.reshape((-1,) + maps.shape[-2:]), scaling_func)
+    return scaled.reshape(maps.shape)
@@ -0,0 +1,447 @@
+"""
+Module to run analyses without a notebook from declarative experiment specifications
+
+An experiment specification is a YAML or JSON file, for example:
+
+    name: qbo_u
+    output: results
+    datasets:
+      u: {file: data/era-int_pl_1979-2019-mm-u.nc, variable: u}
+    reference:                 #Index the maps are compared to
+      dataset: u
+      level: 30                #Value of the level coordinate, e.g. hPa
+      box: {south: -5, north: 5, west: 0, east: 360}   #or point: {latitude: 1, longitude: 104}
+      deseasonalize: true
+    levels: [3, 30, 70, 300]   #Values of the level coordinate or "all"
+    deseasonalize: false       #Deseasonalize the maps
+    measures:                  #Names in similarity_measures, optionally with parameters
+      - pearson_correlation
+      - {name: mutual_information, binning: quantile, bins: 8}
+      - {name: transfer_entropy, invert: true}
+    scaling: quantiles         #One of SCALINGS
+    lags: {start: -24, stop: 24, step: 1}
+    windows: {length: 120, step: 1}
+    agreement: {func: std, value_thresholds: [0.8, 0.9], agreement_thresholds: [0.1, 0.2]}
+    experiments:               #Optional variants, each overriding the settings above
+      - {name: qbo_u_kendall, measures: [kendall_tau]}
+
+Every experiment is split into stages per dataset (similarity, lags, windows and agreement,
+which depends on similarity). Stages without dependencies between them run in parallel. Every
+stage writes a .npz file whose name contains a hash of its settings and inputs, so stages whose
+output exists already are skipped, and a manifest.json that lists the outputs.
+
+Run from the command line:
+
+    python pipeline.py experiment.yaml [more.json ...] [--jobs 4] [--force] [--dry-run]
+"""
+import argparse
+import copy
+import functools
+import hashlib
+import json
+import os
+import sys
+import numpy as np
+from joblib import Parallel, delayed # pylint: disable=E0401
+import agreement
+import caching
+import calculations as calc
+import climatology
+import comparing as comp
+import datasets
+import grid
+import lags as lag_measures
+import similarity_measures
+import windows
+
+#Change to recompute all stages, e.g. when the output format changes
+PIPELINE_VERSION = 1
+
+SCALINGS = {
+    "quantiles": comp.binning_values_to_quantiles,
+    "min_max": comp.min_max_normalization,
+    "histogram": comp.equalize_histogram,
+    "none": None,
+}
+
+AGREEMENT_FUNCTIONS = {
+    "std": agreement.std_agreement,
+    "entropy": agreement.entropy_agreement,
+}
+
+STAGES = ["similarity", "lags", "windows", "agreement"]
+
+#Results that are the same for all levels
+SHARED_RESULTS = ["lags", "window_starts"]
+
+
+def load_specs(filename):
+    """
+    Read the experiments of a specification file
+
+    Args:
+        filename (str): Path to a .yaml, .yml or .json file
+
+    Returns:
+        List of experiment specifications (dictionaries), one per entry of "experiments" or the
+        specification itself if it has none
+    """
+    with open(filename) as file:
+        if filename.endswith((".yaml", ".yml")):
+            import yaml # pylint: disable=C0415
+            spec = yaml.safe_load(file)
+        else:
+            spec = json.load(file)
+
+    variants = spec.pop("experiments", None)
+    if not variants:
+        return [spec]
+    specs = []
+    for variant in variants:
+        merged = copy.deepcopy(spec)
+        merged.update(variant)
+        specs.append(merged)
+    return specs
+
+
+def get_measure(measure_spec):
+    """
+    Build a similarity measure from its specification
+
+    Args:
+        measure_spec (str or dict): Name of a function of similarity_measures or a dictionary with
+                                    the name, invert (optional) and keyword arguments
+
+    Returns:
+        Similarity measure
+    """
+    if isinstance(measure_spec, str):
+        measure_spec = {"name": measure_spec}
+    parameters = dict(measure_spec)
+    name = parameters.pop("name")
+    invert = parameters.pop("invert", False)
+    parameters.pop("maximize", None)
+
+    measure = getattr(similarity_measures, name, None)
+    if not callable(measure):
+        raise ValueError("Similarity measure {} not found in similarity_measures".format(name))
+    if parameters:
+        measure = functools.partial(measure, **parameters)
+    return comp.invert(measure) if invert else measure
+
+
+def derive_reference(spec):
+    """
+    Derive the reference series of an experiment
+
+    Args:
+        spec (dict): Experiment specification
+
+    Returns:
+        numpy.ndarray with the reference series
+    """
+    reference = spec["reference"]
+    if "file" in reference:
+        series = np.loadtxt(reference["file"], usecols=reference.get("column", 0))
+    else:
+        dataset = _open(spec["datasets"][reference["dataset"]])
+        index = grid.GridIndex.from_dataset(dataset)
+        if "box" in reference:
+            box = reference["box"]
+            arguments = index.box(box["south"], box["north"], box["west"], box["east"])
+        elif "point" in reference:
+            (lat, lon) = index.indices(reference["point"]["latitude"],
+                                       reference["point"]["longitude"])
+            arguments = {"lat": int(lat), "lon": int(lon)}
+        else:
+            arguments = {key: reference[key] for key in ("lat", "lon", "lat_step", "lon_step")
+                         if key in reference}
+        level = dataset.level_index(reference["level"]) if "level" in reference else 0
+        latitudes = dataset.latitudes if reference.get("weighted", False) else None
+        series = calc.derive(dataset, level=level, latitudes=latitudes,
+                             wrap_longitude=index.wrap_longitude, **arguments)
+
+    if reference.get("deseasonalize", False):
+        series = climatology.deseasonalize(series, reference.get("period_length", 12))
+    return np.asarray(series, dtype=float)
+
+
+def plan(spec, reference_series):
+    """
+    Split an experiment into stages
+
+    Args:
+        spec (dict): Experiment specification
+        reference_series (numpy.ndarray): Reference series of the experiment
+
+    Returns:
+        List of stages (dictionaries with kind, dataset, key, output, depends and the settings)
+    """
+    output = os.path.join(spec.get("output", "results"), spec.get("name", "experiment"))
+    settings = {key: spec.get(key) for key in ("levels", "deseasonalize", "period_length",
+                                               "measures", "scaling", "chunk_size")}
+    reference_hash = caching.fingerprint_dataset(reference_series)
+
+    stages = []
+    for (dataset_name, dataset_spec) in sorted(spec["datasets"].items()):
+        inputs = [str(PIPELINE_VERSION), caching.fingerprint_dataset(_open(dataset_spec)),
+                  reference_hash]
+        keys = {}
+        for kind in STAGES:
+            if kind != "similarity" and not spec.get(kind):
+                continue
+            stage_settings = dict(settings, **{kind: spec.get(kind)})
+            depends = ["similarity"] if kind == "agreement" else []
+            key = _hash(inputs + [kind, json.dumps(stage_settings, sort_keys=True)]
+                        + [keys[dependency] for dependency in depends])
+            keys[kind] = key
+            stages.append({"kind": kind, "dataset": dataset_name, "dataset_spec": dataset_spec,
+                           "key": key, "settings": stage_settings, "cache": spec.get("cache"),
+                           "depends": [_output(output, dataset_name, dependency,
+                                               keys[dependency]) for dependency in depends],
+                           "output": _output(output, dataset_name, kind, key)})
+    return stages
+
+
+def run(spec, n_jobs=1, force=False, dry_run=False):
+    """
+    Run all stages of an experiment whose output does not exist yet
+
+    Args:
+        spec (dict): Experiment specification
+        n_jobs (int, optional): Number of stages run in parallel, -1 uses all CPUs
+            Defaults to 1
+        force (bool, optional): Run stages even if their output exists
+            Defaults to False
+        dry_run (bool, optional): Only plan the stages
+            Defaults to False
+
+    Returns:
+        Manifest (dictionary) listing the reference series and the stages with their outputs
+    """
+    output = os.path.join(spec.get("output", "results"), spec.get("name", "experiment"))
+    reference_series = derive_reference(spec)
+    stages = plan(spec, reference_series)
+    pending = [stage for stage in stages if force or not os.path.exists(stage["output"])]
+    manifest = {"name": spec.get("name", "experiment"), "spec": spec,
+                "reference": os.path.join(output, "reference.npy"),
+                "stages": [{key: stage[key] for key in ("kind", "dataset", "key", "output")}
+                           for stage in stages]}
+    if dry_run:
+        for stage in stages:
+            print("{} {} {} -> {}".format("run " if stage in pending else "skip", stage["kind"],
+                                          stage["dataset"], stage["output"]))
+        return manifest
+
+    os.makedirs(output, exist_ok=True)
+    np.save(manifest["reference"], reference_series)
+    #Stages run in waves, each after the stages it depends on
+    while pending:
+        outputs = [stage["output"] for stage in pending]
+        ready = [stage for stage in pending
+                 if not any(dependency in outputs for dependency in stage["depends"])]
+        Parallel(n_jobs=n_jobs)(delayed(run_stage)(stage, reference_series) for stage in ready)
+        pending = [stage for stage in pending if stage not in ready]
+
+    _atomic_write(os.path.join(output, "manifest.json"),
+                  lambda filename: _write_json(filename, manifest))
+    return manifest
+
+
+def run_stage(stage, reference_series):
+    """
+    Run one stage and write its output
+
+    Args:
+        stage (dict): Stage, see plan
+        reference_series (numpy.ndarray): Reference series of the experiment
+    """
+    if stage["cache"]:
+        caching.enable_cache(stage["cache"])
+    settings = stage["settings"]
+    measures = [get_measure(measure) for measure in settings["measures"]]
+    names = np.array([_measure_name(measure) for measure in settings["measures"]])
+    dataset = _open(stage["dataset_spec"])
+    levels = _level_indices(dataset, settings["levels"])
+    results = {"measures": names, "levels": dataset.levels[levels]}
+
+    if stage["kind"] == "agreement":
+        with np.load(stage["depends"][0]) as similarity:
+            results.update(_agreement(similarity, settings["agreement"]))
+    else:
+        for (i, (map_array, level, series)) in enumerate(_level_maps(dataset, levels,
+                                                                     reference_series, settings)):
+            for (name, values) in _calculate(stage["kind"], map_array, level, series, measures,
+                                             settings).items():
+                if name in SHARED_RESULTS:
+                    results[name] = values
+                else:
+                    results.setdefault(name, np.zeros((len(levels),) + values.shape))[i] = values
+
+    _atomic_write(stage["output"], lambda filename: np.savez_compressed(filename, **results))
+
+
+def main(argv=None):
+    """
+    Run the experiments of the specification files given on the command line
+    """
+    parser = argparse.ArgumentParser(description="Run experiments from YAML or JSON specifications")
+    parser.add_argument("specs", nargs="+", help="Specification files")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of stages run in parallel, -1 uses all CPUs")
+    parser.add_argument("--force", action="store_true", help="Rerun stages with existing output")
+    parser.add_argument("--dry-run", action="store_true", help="Only list the stages")
+    arguments = parser.parse_args(argv)
+
+    for filename in arguments.specs:
+        for spec in load_specs(filename):
+            print("Experiment {}".format(spec.get("name", "experiment")))
+            run(spec, arguments.jobs, arguments.force, arguments.dry_run)
+    return 0
+
+
+def _calculate(kind, map_array, level, reference_series, measures, settings):
+    """
+    Calculate the results of a stage on one level
+
+    Returns:
+        Dictionary of result arrays
+    """
+    if kind == "similarity":
+        similarity = calc.calculate_series_similarities(map_array, reference_series, measures,
+                                                        level, settings["chunk_size"])
+        scaling_func = SCALINGS[settings["scaling"] or "none"]
+        if scaling_func is None:
+            return {"similarity": similarity}
+        return {"similarity": similarity,
+                "scaled": agreement.scale_similarities(similarity, scaling_func)}
+
+    if kind == "lags":
+        time_lags = _lags(settings["lags"])
+        sim = calc.calculate_lagged_similarities(map_array, reference_series, time_lags, measures,
+                                                 level, settings["chunk_size"])
+        best = [lag_measures.best_lags(sim[i], time_lags, _maximize(measure))
+                for (i, measure) in enumerate(settings["measures"])]
+        return {"similarity": sim, "lags": np.array(time_lags),
+                "best_lag": np.array([lag for (lag, _) in best]),
+                "best_value": np.array([value for (_, value) in best])}
+
+    (length, step) = (settings["windows"]["length"], settings["windows"].get("step", 1))
+    sim = calc.calculate_series_similarities_in_windows(map_array, reference_series, length,
+                                                        measures, step, level,
+                                                        settings["chunk_size"])
+    return {"similarity": sim,
+            "window_starts": windows.window_starts(len(reference_series), length, step)}
+
+
+def _agreement(similarity, settings):
+    """
+    Compute the agreement areas of every level from the output of a similarity stage
+
+    Returns:
+        Dictionary with the bit-packed agreement areas (level, value threshold, agreement
+        threshold, latitude, packed longitude) and the thresholds
+    """
+    scaled = similarity["scaled"] if "scaled" in similarity else similarity["similarity"]
+    agreement_func = AGREEMENT_FUNCTIONS[settings.get("func", "std")]
+    (packed_areas, shape) = ([], None)
+    for level_similarities in scaled:
+        areas = agreement.agreement_areas(np.mean(level_similarities, axis=0),
+                                          agreement_func(level_similarities, axis=0),
+                                          settings["value_thresholds"],
+                                          settings["agreement_thresholds"],
+                                          settings.get("filter_values_high", True),
+                                          settings.get("filter_agreement_high", False),
+                                          packed=True)
+        packed_areas.append(areas.bits)
+        shape = areas.shape
+    return {"areas": np.array(packed_areas), "areas_shape": np.array((len(scaled),) + shape),
+            "value_thresholds": np.array(settings["value_thresholds"]),
+            "agreement_thresholds": np.array(settings["agreement_thresholds"])}
+
+
+def _level_maps(dataset, levels, reference_series, settings):
+    """
+    Iterate over the maps of the levels, cut to the length of the reference series and
+    deseasonalized if requested
+
+    Yields:
+        Tuple of the map (time, level, latitude, longitude), the level to use and the reference
+        series
+    """
+    len_time = min(len(dataset), len(reference_series))
+    reference_series = reference_series[:len_time]
+    for level in levels:
+        if not settings["deseasonalize"]:
+            yield dataset.select(time=slice(0, len_time)), level, reference_series
+            continue
+        level_map = climatology.deseasonalize(dataset.select(time=slice(0, len_time), level=level),
+                                              settings["period_length"] or 12, np.float32)
+        yield level_map, 0, reference_series[:len(level_map)]
+
+
+def _level_indices(dataset, levels):
+    if levels is None or levels == "all":
+        return list(range(len(dataset.levels)))
+    return [dataset.level_index(level) for level in np.atleast_1d(levels)]
+
+
+def _lags(lag_spec):
+    if isinstance(lag_spec, dict):
+        return list(range(lag_spec.get("start", 0), lag_spec["stop"] + 1, lag_spec.get("step", 1)))
+    return [int(lag) for lag in lag_spec]
+
+
+def _maximize(measure_spec):
+    if isinstance(measure_spec, str):
+        measure_spec = {"name": measure_spec}
+    if "maximize" in measure_spec:
+        return measure_spec["maximize"]
+    #Distances are minimized, unless invert turned them into similarities
+    distance = measure_spec["name"] in similarity_measures.DISTANCE_MEASURES
+    return distance == bool(measure_spec.get("invert", False))
+
+
+def _measure_name(measure_spec):
+    if isinstance(measure_spec, str):
+        return measure_spec
+    parameters = ["{}={}".format(key, value) for (key, value) in sorted(measure_spec.items())
+                  if key != "name"]
+    return "{}({})".format(measure_spec["name"], ", ".join(parameters))
+
+
+def _open(dataset_spec):
+    if isinstance(dataset_spec, str):
+        dataset_spec = {"file": dataset_spec}
+    return datasets.open_dataset(dataset_spec["file"], dataset_spec.get("variable", "u"))
+
+
+def _output(output, dataset_name, kind, key):
+    return os.path.join(output, "{}-{}-{}.npz".format(dataset_name, kind, key[:16]))
+
+
+def _hash(parts):
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _atomic_write(filename, write):
+    """
+    Write a file under a temporary name first, so interrupted stages leave no partial output
+    """
+    (base, extension) = os.path.splitext(filename)
+    temporary = "{}.{}.tmp{}".format(base, os.getpid(), extension)
+    write(temporary)
+    os.replace(temporary, filename)
+
+
+def _write_json(filename, values):
+    with open(filename, "w") as file:
+        json.dump(values, file, indent=2, default=str)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,17 @@
 """
     TODO: Module Docstring
 """
+import functools
 import matplotlib.pyplot as plt
 import matplotlib
 import numpy as np
+from joblib import Parallel, delayed # pylint: disable=E0401
 from mpl_toolkits.basemap import Basemap
 from scipy.stats import entropy
 import calculations as calc
 import comparing as comp
 import combining as comb
+import panels
 import similarity_measures as sim
 
 months = ["January", "February", "March", "April", "May",
@@ -77,22 +80,10 @@ def plot_similarities_whole_period(map_array, reference_series, measures, labels
         level (int, optional): Level on which the similarity should be calculated
             Defaults to 0
     """
-    fig, ax = plt.subplots(nrows=1, ncols=len(measures), figsize=(8*len(measures), 10))
-
-    for i, measure in enumerate(measures):
-        #Compute similarity
-        sim_whole_period = calc.calculate_series_similarity(map_array,
-                                                            reference_series,
-                                                            level,
-                                                            measure)
-        #Check if only one map
-        axis = check_axis(ax, column=i, column_count=len(measures))
-
-        #Draw map
-        plot_map(scaling_func(sim_whole_period), axis)
-
-    annotate(ax, column_count=len(measures), column_labels=labels)
-    fig.suptitle("Similarity between QBO and all other points for the whole period")
+    similarities = panels.similarities_whole_period(map_array, reference_series, measures, scaling_func, level)
+    plot_map_grid(similarities[np.newaxis], column_labels=labels,
+                  title="Similarity between QBO and all other points for the whole period",
+                  figsize=(8*len(measures), 10))
     plt.show()
 
 
@@ -120,27 +111,10 @@ def plot_similarities_whole_period_per_month(map_array, reference_series, measur
             Defaults to 0
     """
     len_measures = len(measures)
-    fig, ax = plt.subplots(figsize=(8*len_measures, 14*len_measures), nrows=12, ncols=len(measures))
-
-    for month in range(len(months)):
-        #Extract monthly values
-        map_array_month = np.array([map_array[12 * i + month, :, :, :] for i in range(40)])
-        reference_series_month = [reference_series[12 * i + month] for i in range(40)]
-
-        for i, measure in enumerate(measures):
-            #Calculate similarity
-            similarity_month = calc.calculate_series_similarity(map_array_month,
-                                                                reference_series_month,
-                                                                level,
-                                                                measure)
-            axis = check_axis(ax, row=month, column=i, row_count=len(months), column_count=len_measures)
-
-            #Plot Map
-            scaled_similarity = scaling_func(similarity_month)
-            plot_map(scaled_similarity, axis, colorbar=False)
-
-    annotate(ax, row_count=len(months), column_count=len_measures, row_labels=months, column_labels=labels)
-    fig.suptitle("Similarity between QBO and all other points 1979 - 2019 per month")
+    similarities = panels.similarities_per_month(map_array, reference_series, measures, scaling_func, level)
+    plot_map_grid(similarities, row_labels=months, column_labels=labels,
+                  title="Similarity between QBO and all other points 1979 - 2019 per month",
+                  colorbar=False, figsize=(8*len_measures, 14*len_measures))
     plt.show()
 
 
@@ -167,34 +141,10 @@ def plot_similarities_winter_only(map_array, reference_series, measures, labels,
         level (int, optional): Level on which the similarity should be calculated
             Defaults to 0
     """
-    fig, ax = plt.subplots(nrows=1, ncols=len(measures), figsize=(8*len(measures), 10))
-
-    winter_indices = []
-    for i in range(40):
-        year = 12 * i
-        winter_indices.append(year) #January
-        winter_indices.append(year + 1) #February
-        winter_indices.append(year + 11) #December
-
-    #Extract winter values
-    reference_series_winter = reference_series[winter_indices]
-    map_array_winter = map_array[winter_indices, :, :, :]
-
-    for i, measure in enumerate(measures):
-        #Compute similarity
-        sim_whole_period_winter = calc.calculate_series_similarity(map_array_winter,
-                                                                   reference_series_winter,
-                                                                   level,
-                                                                   measure)
-
-        #Check if only one map
-        axis = check_axis(ax, column=i, column_count=len(measures))
-
-        #Draw map
-        plot_map(scaling_func(sim_whole_period_winter), axis)
-
-    annotate(ax, column_count=len(measures), column_labels=labels)
-    fig.suptitle("Similarity between QBO and all other points 1979 - 2019 for Winter months")
+    similarities = panels.similarities_winter_only(map_array, reference_series, measures, scaling_func, level)
+    plot_map_grid(similarities[np.newaxis], column_labels=labels,
+                  title="Similarity between QBO and all other points 1979 - 2019 for Winter months",
+                  figsize=(8*len(measures), 10))
     plt.show()
 
 
@@ -212,12 +162,7 @@ def plot_similarity_dependency(map_array, reference_series, measures, labels, le
             Defaults to 0
     """
     #Compute similarities
-    similarities = []
-    for i, measure in enumerate(measures):
-        similarities.append(np.array(calc.calculate_series_similarity(map_array,
-                                                                      reference_series,
-                                                                      level,
-                                                                      measure)))
+    similarities = calc.calculate_series_similarities(map_array, reference_series, measures, level)
 
     n_measures = len(measures)
     #Plot dependencies in matrix
@@ -255,25 +200,11 @@ def plot_similarity_measures_combinations(map_array, reference_series, combinati
         level (int, optional): Level on which the similarity should be calculated
             Defaults to 0
     """
-    #Compute similarities
-    similarities = []
-    for i, measure in enumerate(measures):
-        sim = calc.calculate_series_similarity(map_array, reference_series, level, measure)
-        similarities.append(scaling_func(sim))
-
+    combinations = panels.similarity_measures_combinations(map_array, reference_series, combination_func, measures,
+                                                           scaling_func, level)
     n_measures = len(measures)
-    #Plot dependencies in matrix
-    fig, ax = plt.subplots(nrows=n_measures, ncols=n_measures, figsize=(8 * n_measures, 8 * n_measures))
-
-
-    for i in range(n_measures):
-        for j in range(n_measures):
-            combination = calc.combine_similarity_measures(similarities[i], similarities[j], combination_func)
-            axis = check_axis(ax, row=i, column=j, row_count=n_measures, column_count=n_measures)
-            plot_map(combination[:], axis)
-
-    annotate(ax, row_count=n_measures, column_count=n_measures, row_labels=labels, column_labels=labels)
-    fig.suptitle("Combination of similarity measures")
+    plot_map_grid(combinations, row_labels=labels, column_labels=labels, title="Combination of similarity measures",
+                  figsize=(8 * n_measures, 8 * n_measures))
     plt.show()
 
 
@@ -375,7 +306,8 @@ def plot_level_of_agreement(map_array, reference_series, scoring_func, measures,
         map_array (numpy.ndarray): Map with 4 dimensions - time, level, latitude, longitude
         reference_series (numpy.ndarray): 1 dimensional reference series
         scoring_func (function): Function that takes in a value and outputs a boolean (whether there
-                                 is a dependency or not)
+                                 is a dependency or not). Vectorized functions are applied to all
+                                 similarity maps at once, see agreement.level_of_agreement
         measures (list): List of similarity measures to compute similarity between two time series
         labels (list): List of labels for the measures
         scaling_func (function, optional): Function that takes a map of similarity values and scales them in order
@@ -385,17 +317,8 @@ def plot_level_of_agreement(map_array, reference_series, scoring_func, measures,
             Defaults to 0
     """
     #Compute agreement
-    similarities = []
-    agreement = np.zeros((256, 512))
-    for i, measure in enumerate(measures):
-        similarity = calc.calculate_series_similarity(map_array, reference_series, level, measure)
-        similarities.append(scaling_func(similarity))
-        n_measures = len(measures)
-
-    for similarity_map in similarities:
-        agreement = sum([agreement, np.vectorize(scoring_func)(similarity_map)])
-
-    agreement = agreement / n_measures
+    n_measures = len(measures)
+    agreement = panels.level_of_agreement(map_array, reference_series, scoring_func, measures, scaling_func, level)
 
 
     #Draw Map
@@ -498,12 +421,13 @@ def combinations_with_pearson(map_array, reference_series, combination_func, mea
     """
     similarities = []
     combinations = []
-    for i, measure in enumerate(measures):
-        similarity = calc.calculate_series_similarity(map_array, reference_series, level, measure)
+    all_similarities = calc.calculate_series_similarities(map_array, reference_series,
+                                                          list(measures) + [sim.pearson_correlation], level)
+    for similarity in all_similarities[:-1]:
         similarities.append(scaling_func(similarity))
     n_measures = len(measures)
 
-    pearson_similarity = calc.calculate_series_similarity(map_array, reference_series, level, sim.pearson_correlation)
+    pearson_similarity = all_similarities[-1]
 
     for i in range(n_measures):
         combination = calc.combine_similarity_measures(pearson_similarity, similarities[i], combination_func)
@@ -534,30 +458,12 @@ def plot_time_delayed_dependencies(map_array, reference_series, time_shifts, mea
         level (int, optional): Level on which the similarity should be calculated
             Defaults to 0
     """
-    #Compute time delayed similarities
-    len_time_shifts = len(time_shifts)
-    len_measures = len(measures)
-    fig, ax = plt.subplots(nrows=len_time_shifts, ncols=len_measures, figsize=(10 * len_measures, 14 * len_time_shifts))
-
-    for j, shift in enumerate(time_shifts):
-        shifted_reference_series = calc.shift(reference_series, shift)
-        for i, measure in enumerate(measures):
-            similarity = calc.calculate_series_similarity(map_array, shifted_reference_series, level, measure)
-
-            #Scale results for similarity measures different than Pearson's
-            if (measure != sim.pearson_correlation or measure !=sim.pearson_correlation_abs):
-                similarity = scaling_func(similarity)
-
-            #Check axis
-            axis = check_axis(ax, row=j, column=i, row_count=len_time_shifts, column_count=len_measures)
-
-            #Plot results on map
-            plot_map(similarity, axis)
-
-    #Annotate rows and columns
+    #All time shifts in one pass over the map
+    similarities = panels.time_delayed_dependencies(map_array, reference_series, time_shifts, measures, scaling_func,
+                                                    level)
     shift_labels = ["Shifted by {}".format(i) for i in time_shifts]
-    annotate(ax, row_count=len_time_shifts, column_count=len_measures, row_labels=shift_labels, column_labels=measure_labels)
-    fig.suptitle("Similarities to different time steps")
+    plot_map_grid(similarities, row_labels=shift_labels, column_labels=labels,
+                  title="Similarities to different time steps")
 
 
 def plot_similarities_to_different_datasets(datasets, dataset_labels, reference_series, measures, measure_labels,
@@ -580,27 +486,39 @@ def plot_similarities_to_different_datasets(datasets, dataset_labels, reference_
         level (int, optional): Level on which the similarity should be calculated
             Defaults to 0
     """
-    n_datasets = len(datasets)
-    len_measures = len(measures)
-    fig, ax = plt.subplots(nrows=n_datasets, ncols=len_measures, figsize=(10 * len_measures, 14 * n_datasets))
+    similarities = panels.similarities_to_different_datasets(datasets, reference_series, measures, scaling_func, level)
+    plot_map_grid(similarities, row_labels=dataset_labels, column_labels=measure_labels,
+                  title="Similarities to different datasets")
 
-    for j, file in enumerate(datasets):
-        for i, measure in enumerate(measures):
-            similarity = calc.calculate_series_similarity(file, reference_series, level, measure)
 
-            #Scale results for similarity measures different than Pearson's
-            if (measure != sim.pearson_correlation or measure !=sim.pearson_correlation_abs):
-                similarity = scaling_func(similarity)
+def plot_similarities_to_different_levels(map_array, reference_series, measures, measure_labels, levels=None,
+                                         level_labels=None, scaling_func=comp.binning_values_to_quantiles):
+    """
+    Plot the similarities for different similarity measures between a reference series and different levels of a map.
 
-            #Check axis
-            axis = check_axis(ax, row=j, column=i, row_count=n_datasets, column_count=len_measures)
+    All levels are computed in one pass over the map using calc.calculate_series_similarities_volume.
+    The results of all measures, including Pearson's Correlation, are made comparable using the scaling_func.
 
-            #Plot results on map
-            plot_map(similarity, axis)
 
-    #Annotate rows and columns
-    annotate(ax, row_count=n_datasets, column_count=len_measures, row_labels=dataset_labels, column_labels=measure_labels)
-    fig.suptitle("Similarities to different datasets")
+    Args:
+        map_array (numpy.ndarray): Map with 4 dimensions - time, level, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        measures (list): List of similarity measures to compute similarity between two time series
+        measure_labels (list): List of labels for the measures
+        levels (list, optional): Indices of the levels
+            Defaults to None (all levels)
+        level_labels (list, optional): List of labels for the levels
+            Defaults to None ("Level" and the index)
+        scaling_func (function, optional): Function that takes a map of similarity values and scales them in order
+                                           to make the similarity values of different similarity measures comparable
+            Defaults to comp.binning_values_to_quantiles
+    """
+    levels = np.arange(map_array.shape[1]) if levels is None else np.atleast_1d(levels)
+    if level_labels is None:
+        level_labels = ["Level {}".format(level) for level in levels]
+    similarities = panels.similarities_to_different_levels(map_array, reference_series, measures, levels, scaling_func)
+    plot_map_grid(similarities, row_labels=level_labels, column_labels=measure_labels,
+                  title="Similarities to different levels")
 
 
 def plot_time_delayed_similarities_to_different_datasets(datasets, dataset_labels, reference_series, time_shifts, measure,
@@ -626,30 +544,12 @@ def plot_time_delayed_similarities_to_different_datasets(datasets, dataset_label
         level (int, optional): Level on which the similarity should be calculated
             Defaults to 0
     """
-    n_datasets = len(datasets)
-    len_shifts = len(time_shifts)
-    fig, ax = plt.subplots(nrows=n_datasets, ncols=len_shifts, figsize=(10 * len_shifts, 14 * n_datasets))
-
-    for i, shift in enumerate(time_shifts):
-        for j, dataset in enumerate(datasets):
-            shifted_reference_series = calc.shift(reference_series, shift)
-            similarity = calc.calculate_series_similarity(dataset, shifted_reference_series, level, measure)
-
-            #Scale results for similarity measures different than Pearson's
-            if (measure != sim.pearson_correlation or measure !=sim.pearson_correlation_abs):
-                similarity = scaling_func(similarity)
-
-            #Check axis
-            axis = check_axis(ax, row=j, column=i, row_count=n_datasets, column_count=len_shifts)
-
-            #Plot results on map
-            plot_map(similarity, axis)
-
-    #Annotate rows and columns
+    #All time shifts in one pass over every dataset
+    similarities = panels.time_delayed_similarities_to_different_datasets(datasets, reference_series, time_shifts,
+                                                                          measure, scaling_func, level)
     shift_labels = ["Shifted by {}".format(i) for i in time_shifts]
-    annotate(ax, row_count=n_datasets, column_count=len_shifts, row_labels=dataset_labels, column_labels=shift_labels)
-
-    fig.suptitle("Similarities to different datasets for different time delays using {}".format(measure.__name__))
+    plot_map_grid(similarities, row_labels=dataset_labels, column_labels=shift_labels,
+                  title="Similarities to different datasets for different time delays using {}".format(measure.__name__))
 
 
 def plot_time_delayed_agreeableness_to_different_datasets(datasets, dataset_labels, reference_series, time_shifts, measures,
@@ -688,25 +588,14 @@ def plot_time_delayed_agreeableness_to_different_datasets(datasets, dataset_labe
         level (int, optional): Level on which the similarity should be calculated
             Defaults to 0
     """
-    n_datasets = len(datasets)
-    len_shifts = len(time_shifts)
-    fig, ax = plt.subplots(nrows=n_datasets, ncols=len_shifts, figsize=(10 * len_shifts, 14 * n_datasets))
-
-    for i, shift in enumerate(time_shifts):
-        for j, dataset in enumerate(datasets):
-            shifted_reference_series = calc.shift(reference_series, shift)
-            map = calc.calculate_filtered_agreement_areas(dataset, shifted_reference_series, measures, [value_threshold], [agreement_threshold],
-                                                          agreement_func=agreement_func, filter_values_high=filter_values_high,
-                                                          filter_agreement_high=filter_agreement_high,scaling_func=scaling_func, level=level)
-            axis = check_axis(ax, row=j, column=i, row_count=n_datasets, column_count=len_shifts)
-            plot_map(map[0, 0, :, :], axis, colorbar=False)
-
-    #Annotate rows and columns
+    #All time shifts in one pass over every dataset
+    areas = panels.time_delayed_agreement_areas(datasets, reference_series, time_shifts, measures, value_threshold,
+                                                agreement_threshold, agreement_func, filter_values_high,
+                                                filter_agreement_high, scaling_func, level)
     shift_labels = ["Shifted by {}".format(i) for i in time_shifts]
-    annotate(ax, row_count=n_datasets, column_count=len_shifts, row_labels=dataset_labels, column_labels=shift_labels)
-
-    fig.suptitle("Agreeableness between {} to different datasets for different time delays using {} (Value threshold: {}, Agreement threshold: {})"
-       .format(measure_labels, agreement_func.__name__, value_threshold, agreement_threshold))
+    plot_map_grid(areas, row_labels=dataset_labels, column_labels=shift_labels, colorbar=False,
+                  title="Agreeableness between {} to different datasets for different time delays using {} (Value threshold: {}, Agreement threshold: {})"
+                  .format(measure_labels, agreement_func.__name__, value_threshold, agreement_threshold))
 
 
 def plot_map(values, axis, cmap=plt.cm.get_cmap("viridis"), colorbar=True, invert_colorbar=False):
@@ -722,20 +611,101 @@ def plot_map(values, axis, cmap=plt.cm.get_cmap("viridis"), colorbar=True, inver
             Defaults to True
         invert_colorbar (boolean, optional): Boolean indicating if the colobar should be inverted
     """
-    #Create map
-    m = Basemap(projection='mill', lon_0=30, resolution='l', ax=axis)
-    m.drawcoastlines()
-    lons, lats = m.makegrid(512, 256)
-    x, y = m(lons, lats)
+    #Map and grid are shared by all maps of the same shape
+    m, x, y = get_map_projection(*np.shape(values))
+    m.drawcoastlines(ax=axis)
 
     #Draw values in map
-    cs = m.contourf(x, y, values, cmap=cmap)
+    cs = m.contourf(x, y, values, cmap=cmap, ax=axis)
     if colorbar:
-        cbar = m.colorbar(cs, location='bottom', pad="5%")
+        cbar = m.colorbar(cs, location='bottom', pad="5%", ax=axis)
         cbar.ax.set_xticklabels(cbar.ax.get_xticklabels(), rotation=45)
         if invert_colorbar:
             cbar.ax.invert_xaxis()
 
+
+@functools.lru_cache(maxsize=None)
+def get_map_projection(len_latitude, len_longitude):
+    """
+    Create the Basemap projection and the projected grid for maps of a shape once, the coastlines
+    and the grid are reused by all subplots
+
+    Args:
+        len_latitude (int): Number of latitudes of the maps
+        len_longitude (int): Number of longitudes of the maps
+
+    Returns:
+        Tuple of the Basemap and the x and y coordinates of the grid points
+    """
+    m = Basemap(projection='mill', lon_0=30, resolution='l')
+    lons, lats = m.makegrid(len_longitude, len_latitude)
+    x, y = m(lons, lats)
+    return m, x, y
+
+
+def plot_map_grid(maps, row_labels=None, column_labels=None, title=None, colorbar=True, figsize=None):
+    """
+    Plot a grid of maps, e.g. computed with a function of panels
+
+    Args:
+        maps (numpy.ndarray): Maps with 4 dimensions - row, column, latitude, longitude
+        row_labels (list, optional): List of labels for the rows
+            Defaults to None
+        column_labels (list, optional): List of labels for the columns
+            Defaults to None
+        title (str, optional): Title of the figure
+            Defaults to None
+        colorbar (boolean, optional): Boolean indicating if colorbars should be plotted
+            Defaults to True
+        figsize (tuple, optional): Size of the figure
+            Defaults to None (10 per column and 14 per row)
+
+    Returns:
+        matplotlib.figure.Figure
+    """
+    n_rows, n_columns = np.shape(maps)[:2]
+    if figsize is None:
+        figsize = (10 * n_columns, 14 * n_rows)
+    fig, ax = plt.subplots(nrows=n_rows, ncols=n_columns, figsize=figsize)
+
+    for j in range(n_rows):
+        for i in range(n_columns):
+            axis = check_axis(ax, row=j, column=i, row_count=n_rows, column_count=n_columns)
+            plot_map(maps[j][i], axis, colorbar=colorbar)
+
+    annotate(ax, row_count=n_rows, column_count=n_columns, row_labels=row_labels, column_labels=column_labels)
+    if title is not None:
+        fig.suptitle(title)
+    return fig
+
+
+def render_figures(figures, n_jobs=-1):
+    """
+    Render grids of maps to files off-screen in parallel processes
+
+    Args:
+        figures (list): List of dictionaries with the filename, the maps (see plot_map_grid) and
+                        optionally row_labels, column_labels, title, colorbar, figsize and dpi
+        n_jobs (int, optional): Number of figures rendered in parallel, -1 uses all CPUs
+            Defaults to -1
+
+    Returns:
+        List of the written filenames
+    """
+    return Parallel(n_jobs=n_jobs)(delayed(_render_figure)(figure) for figure in figures)
+
+
+def _render_figure(figure):
+    #No display is needed to draw into files
+    plt.switch_backend("Agg")
+    options = dict(figure)
+    filename = options.pop("filename")
+    dpi = options.pop("dpi", None)
+    fig = plot_map_grid(options.pop("maps"), **options)
+    fig.savefig(filename, dpi=dpi)
+    plt.close(fig)
+    return filename
+
 def check_axis(ax, row=0, column=0, row_count=1, column_count=1):
     axis = None
     if row_count == 1:
@@ -1,14 +1,70 @@
 """
 Module containing different similarity measures for time series
 """
+import functools
 import numpy as np
 import scipy.spatial.distance as sc
-from scipy.stats import spearmanr, kendalltau
-import pyinform # pylint: disable=E0401
-import minepy # pylint: disable=E0401
-import similaritymeasures # pylint: disable=E0401
-from sklearn.decomposition import PCA # pylint: disable=E0401
-from rdc import rdc
+from scipy.stats import kendalltau, rankdata
+from rdc import rdc_batch, copula_transform
+import information
+import mic
+import warping
+
+class PreparedReference(np.ndarray):
+    """
+    Reference series that caches values derived from it
+
+    Behaves like the numpy.ndarray it wraps, so it can be passed to every similarity measure.
+    Measures store what they derive from the reference series (ranks, shifted series, embeddings,
+    ...) in the cache the first time and reuse it for every other point of the map. The cache is
+    pickled along with the series, so Parallel workers receive it once per job. Slices and other
+    views of the series start with an empty cache.
+    """
+    def __new__(cls, series):
+        prepared = np.asarray(series, dtype=float).view(cls)
+        prepared.cache = {}
+        return prepared
+
+    def __array_finalize__(self, obj):
+        self.cache = {}
+
+    def __reduce__(self):
+        (reconstruct, arguments, state) = super(PreparedReference, self).__reduce__()
+        return (reconstruct, arguments, (state, self.cache))
+
+    def __setstate__(self, state):
+        (array_state, cache) = state
+        super(PreparedReference, self).__setstate__(array_state)
+        self.cache = cache
+
+    def derive(self, name, func):
+        """
+        Return the value derived from the series with func, computing it only on first use
+
+        Args:
+            name (str): Key of the derived value in the cache
+            func (function): Function that takes the series as numpy.ndarray
+
+        Returns:
+            Derived value
+        """
+        if name not in self.cache:
+            self.cache[name] = func(np.asarray(self))
+        return self.cache[name]
+
+def prepare_reference(reference_series):
+    """
+    Wrap a reference series so that similarity measures cache what they derive from it
+
+    Args:
+        reference_series (numpy.ndarray): 1 dimensional reference series
+
+    Returns:
+        PreparedReference of the series
+    """
+    if isinstance(reference_series, PreparedReference):
+        return reference_series
+    return PreparedReference(reference_series)
 
 def pearson_correlation(series1, series2):
     """
@@ -23,7 +79,11 @@ def pearson_correlation(series1, series2):
     Returns:
         Pearson correlation coefficient between the two series
     """
-    return np.corrcoef([series1, series2])[0, 1]
+    (centered1, norm1) = _derived(series1, "centered", _center)
+    (centered2, norm2) = _derived(series2, "centered", _center)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correlation = np.dot(centered1, centered2) / (norm1 * norm2)
+    return np.clip(correlation, -1, 1)
 
 def pearson_correlation_abs(series1, series2):
     """
@@ -40,6 +100,21 @@ def pearson_correlation_abs(series1, series2):
     """
     return abs(pearson_correlation(series1, series2))
 
+def covariance(series1, series2):
+    """
+    Compute the sample covariance between two series
+
+    Args:
+        series1 (numpy.ndarray): First series
+        series2 (numpy.ndarray): Second series
+
+    Returns:
+        Covariance between the two series, like numpy.cov
+    """
+    (centered1, _) = _derived(series1, "centered", _center)
+    (centered2, _) = _derived(series2, "centered", _center)
+    return np.dot(centered1, centered2) / (len(centered1) - 1)
+
 def spearman_correlation(series1, series2):
     """
     Compute the Spearman correlation coefficient between two series
@@ -53,7 +128,84 @@ def spearman_correlation(series1, series2):
     Returns:
         Spearman correlation coefficient between the two series
     """
-    return spearmanr(series1, series2).correlation
+    return pearson_correlation(_derived(series1, "ranks", rankdata),
+                               _derived(series2, "ranks", rankdata))
+
+def pearson_correlation_map(map_array, reference_series):
+    """
+    Compute the Pearson correlation coefficient between every series of a map and a reference series
+
+    Vectorized counterpart of pearson_correlation. All coefficients are computed at once from
+    centered dot products instead of calling np.corrcoef for every point.
+
+    Args:
+        map_array (numpy.ndarray): Map with time as first dimension, e.g. time, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+
+    Returns:
+        numpy.ndarray with the dimensions of map_array except time containing the Pearson
+        correlation coefficient between each series and the reference series
+    """
+    map_array = np.asarray(map_array, dtype=float)
+    reference_series = np.asarray(reference_series, dtype=float)
+
+    map_centered = map_array - map_array.mean(axis=0)
+    reference_centered = reference_series - reference_series.mean()
+
+    covariance = np.tensordot(reference_centered, map_centered, axes=(0, 0))
+    norm = np.sqrt(np.sum(np.square(map_centered), axis=0)) * np.linalg.norm(reference_centered)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correlation = covariance / norm
+    return np.clip(correlation, -1, 1)
+
+def pearson_correlation_abs_map(map_array, reference_series):
+    """
+    Compute the absolute Pearson correlation coefficient between every series of a map and a
+    reference series
+
+    Args:
+        map_array (numpy.ndarray): Map with time as first dimension, e.g. time, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+
+    Returns:
+        numpy.ndarray with the absolute Pearson correlation coefficient of each series
+    """
+    return np.abs(pearson_correlation_map(map_array, reference_series))
+
+def covariance_map(map_array, reference_series):
+    """
+    Compute the sample covariance between every series of a map and a reference series
+
+    Args:
+        map_array (numpy.ndarray): Map with time as first dimension, e.g. time, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+
+    Returns:
+        numpy.ndarray with the covariance of each series
+    """
+    map_array = np.asarray(map_array, dtype=float)
+    reference_series = np.asarray(reference_series, dtype=float)
+    map_centered = map_array - map_array.mean(axis=0)
+    reference_centered = reference_series - reference_series.mean()
+    return np.tensordot(reference_centered, map_centered, axes=(0, 0)) / (len(reference_series) - 1)
+
+def spearman_correlation_map(map_array, reference_series):
+    """
+    Compute the Spearman correlation coefficient between every series of a map and a reference series
+
+    The series are ranked along the time dimension and correlated with pearson_correlation_map,
+    which is what spearmanr does for a single pair.
+
+    Args:
+        map_array (numpy.ndarray): Map with time as first dimension, e.g. time, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+
+    Returns:
+        numpy.ndarray with the Spearman correlation coefficient of each series
+    """
+    map_ranks = rankdata(np.asarray(map_array, dtype=float), axis=0)
+    reference_ranks = rankdata(np.asarray(reference_series, dtype=float))
+    return pearson_correlation_map(map_ranks, reference_ranks)
 
 def kendall_tau(series1, series2):
     """
@@ -113,58 +265,195 @@ def cosine_similarity(series1, series2):
     """
     return 1 - sc.cosine(series1, series2)
 
-def mutual_information(series1, series2):
+def manhattan_distance_map(map_array, reference_series):
+    """
+    Compute the City Block (Manhattan) distance between every series of a map and a reference series
+
+    Vectorized counterpart of manhattan_distance that reduces over the time dimension in one pass.
+
+    Args:
+        map_array (numpy.ndarray): Map with time as first dimension, e.g. time, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+
+    Returns:
+        numpy.ndarray with the City Block (Manhattan) distance of each series
+    """
+    map_array = np.asarray(map_array, dtype=float)
+    return np.sum(np.abs(map_array - _expand_reference(reference_series, map_array)), axis=0)
+
+def euclidean_distance_map(map_array, reference_series):
+    """
+    Compute the Euclidean distance between every series of a map and a reference series
+
+    Vectorized counterpart of euclidean_distance that reduces over the time dimension in one pass.
+
+    Args:
+        map_array (numpy.ndarray): Map with time as first dimension, e.g. time, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+
+    Returns:
+        numpy.ndarray with the Euclidean distance of each series
+    """
+    map_array = np.asarray(map_array, dtype=float)
+    difference = map_array - _expand_reference(reference_series, map_array)
+    return np.sqrt(np.sum(np.square(difference), axis=0))
+
+def cosine_similarity_map(map_array, reference_series):
+    """
+    Compute the Cosine similarity between every series of a map and a reference series
+
+    Vectorized counterpart of cosine_similarity that reduces over the time dimension in one pass.
+
+    Args:
+        map_array (numpy.ndarray): Map with time as first dimension, e.g. time, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+
+    Returns:
+        numpy.ndarray with the Cosine similarity of each series
+    """
+    map_array = np.asarray(map_array, dtype=float)
+    reference_series = np.asarray(reference_series, dtype=float)
+
+    dot_product = np.tensordot(reference_series, map_array, axes=(0, 0))
+    norm = np.sqrt(np.sum(np.square(map_array), axis=0) * np.dot(reference_series, reference_series))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        similarity = dot_product / norm
+    #scipy clips the cosine distance to [0, 2]
+    return np.clip(similarity, -1, 1)
+
+def kendall_tau_map(map_array, reference_series, chunk_size=8192):
+    """
+    Compute the Kendall Tau coefficient between every series of a map and a reference series
+
+    Vectorized counterpart of kendall_tau (tau-b, like scipy.stats.kendalltau). The reference
+    series is sorted once and every series on the map is reordered accordingly. The discordant
+    pairs are then counted as inversions with a merge sort over all series at once, which takes
+    O(n log n) per series. Like scipy.stats.kendalltau, series containing NaN get NaN.
+
+    Args:
+        map_array (numpy.ndarray): Map with time as first dimension, e.g. time, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        chunk_size (int, optional): Number of series processed at once
+            Defaults to 8192
+
+    Returns:
+        numpy.ndarray with the Kendall Tau coefficient of each series
+    """
+    map_array = np.asarray(map_array, dtype=float)
+    reference_series = np.asarray(reference_series, dtype=float)
+    len_time = map_array.shape[0]
+    series = map_array.reshape(len_time, -1)
+    if np.isnan(reference_series).any():
+        return np.full(map_array.shape[1:], np.nan)
+    missing = np.isnan(series).any(axis=0)
+
+    #Sort the reference series once and number its groups of tied values
+    order = np.argsort(reference_series, kind='mergesort')
+    reference_sorted = reference_series[order]
+    reference_groups = np.concatenate(([0], np.cumsum(reference_sorted[1:] != reference_sorted[:-1])))
+    has_ties = reference_groups[-1] < len_time - 1
+
+    total = len_time * (len_time - 1) / 2.
+    reference_ties = _count_tied_pairs(reference_sorted[None, :])[0]
+
+    tau = np.zeros(series.shape[1])
+    for start in range(0, series.shape[1], chunk_size):
+        #One row per series, ordered like the sorted reference series
+        values = np.ascontiguousarray(series[order, start:start + chunk_size].T)
+        if has_ties:
+            #Within a group of tied reference values sort by the series values, like scipy does
+            by_value = np.argsort(values, axis=1, kind='mergesort')
+            by_group = np.argsort(reference_groups[by_value], axis=1, kind='mergesort')
+            values = np.take_along_axis(values, np.take_along_axis(by_value, by_group, axis=1), axis=1)
+            joint_ties = _count_tied_pairs(values, reference_groups)
+        else:
+            joint_ties = 0
+
+        (values_sorted, discordant) = _count_inversions(values)
+        series_ties = _count_tied_pairs(values_sorted)
+
+        concordant_minus_discordant = (total - reference_ties - series_ties + joint_ties
+                                       - 2 * discordant)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            chunk_tau = (concordant_minus_discordant / np.sqrt(total - reference_ties)
+                         / np.sqrt(total - series_ties))
+        chunk_tau[(series_ties == total) | (reference_ties == total)] = np.nan
+        tau[start:start + chunk_size] = np.clip(chunk_tau, -1, 1)
+
+    #Merge sorting NaN gives arbitrary counts, so these series are only masked afterwards
+    tau[missing] = np.nan
+    return tau.reshape(map_array.shape[1:])
+
+def mutual_information(series1, series2, binning="integer", bins=10, neighbors=3):
     """
     Compute the Mutual Information between two series
 
     Measure of the amount of mutual dependence between two random variables.
+    The series are discretized with the given binning, see information.BINNINGS. The default
+    "integer" binning truncates the series shifted to positive values, like pyinform.
 
     Args:
         series1 (numpy.ndarray): First series
         series2 (numpy.ndarray): Second series
+        binning (str, optional): One of "integer", "equal_width", "quantile" or "ksg"
+            Defaults to "integer"
+        bins (int, optional): Number of bins of "equal_width" and "quantile"
+            Defaults to 10
+        neighbors (int, optional): Number of nearest neighbors of "ksg"
+            Defaults to 3
 
     Returns:
         Mutual Information between the two series
     """
-    return pyinform.mutualinfo.mutual_info(shift_to_positive(series1),
-                                           shift_to_positive(series2))
+    return float(information.mutual_information(series1, series2, binning, bins, neighbors))
 
-def transfer_entropy(series1, series2):
+def transfer_entropy(series1, series2, k=2, lag=1, binning="integer", bins=10):
     """
     Compute the Transfer Entropy between two series
 
     Quantify information transfer between an information
-    source and destination, conditioning out shared history effects.
+    source (series1) and destination (series2), conditioning out shared history effects.
 
     Args:
         series1 (numpy.ndarray): First series
         series2 (numpy.ndarray): Second series
+        k (int, optional): Length of the history of series2
+            Defaults to 2
+        lag (int, optional): Time steps between the value of series1 and the predicted value
+                             of series2
+            Defaults to 1
+        binning (str, optional): One of "integer", "equal_width" or "quantile"
+            Defaults to "integer"
+        bins (int, optional): Number of bins of "equal_width" and "quantile"
+            Defaults to 10
 
     Returns:
         Transfer Entropy between the two series
     """
-    return pyinform.transferentropy.transfer_entropy(shift_to_positive(series1),
-                                                     shift_to_positive(series2),
-                                                     k=2)
+    return float(information.transfer_entropy(series1, series2, k, lag, binning, bins))
 
-def conditional_entropy(series1, series2):
+def conditional_entropy(series1, series2, binning="integer", bins=10):
     """
     Compute the Relative Entropy between two series
 
     Measure of the amount of information required to describe a
-    random variable series1 given knowledge of another random variable series2
+    random variable series2 given knowledge of another random variable series1
 
     Args:
         series1 (numpy.ndarray): First series
         series2 (numpy.ndarray): Second series
+        binning (str, optional): One of "integer", "equal_width" or "quantile"
+            Defaults to "integer"
+        bins (int, optional): Number of bins of "equal_width" and "quantile"
+            Defaults to 10
 
     Returns:
         Relative Entropy between the two series
     """
-    return pyinform.conditionalentropy.conditional_entropy(shift_to_positive(series1),
-                                                           shift_to_positive(series2))
+    return float(information.conditional_entropy(series1, series2, binning, bins))
 
-def dynamic_time_warping_distance(series1, series2):
+def dynamic_time_warping_distance(series1, series2, window=None, time_weight=1.,
+                                  max_distance=None):
     """
     Compute the Dynamic Time Warping distance between two series
 
@@ -180,25 +469,53 @@ def dynamic_time_warping_distance(series1, series2):
         4. Repeat 2 and 3 but with the second series as a reference point.
         5. Add up all the minimum distances that were stored and this is a
             true measure of similarity between the two series.
+    The distance between two points is the Euclidean distance of (time index, value), see
+    warping for the engine.
 
     Args:
         series1 (numpy.ndarray): First series
         series2 (numpy.ndarray): Second series
+        window (int, optional): Maximal shift in time steps (Sakoe-Chiba band)
+            Defaults to None (no constraint)
+        time_weight (float, optional): Weight of the time index in the distance of two points
+            Defaults to 1.
+        max_distance (float, optional): Abandon the computation once the distance exceeds this
+                                        and return numpy.inf
+            Defaults to None (compute the full distance)
 
     Returns:
         Dynamic time warping distance between the two series
     """
-    series1_2d = np.zeros((len(series1), 2))
-    series1_2d[:, 0] = range(len(series1))
-    series1_2d[:, 1] = series1
+    return float(warping.dtw_distance(series1, series2, window, time_weight, max_distance))
 
-    series2_2d = np.zeros((len(series2), 2))
-    series2_2d[:, 0] = range(len(series2))
-    series2_2d[:, 1] = series2
+def dynamic_time_warping_distance_map(map_array, reference_series, window=None, time_weight=1.,
+                                      max_distance=None):
+    """
+    Compute the Dynamic Time Warping distance between every series of a map and a reference series
 
-    return similaritymeasures.dtw(series1_2d, series2_2d)[0]
+    Vectorized counterpart of dynamic_time_warping_distance, the series of a latitude are warped
+    at once. With max_distance and a window, series whose LB_Keogh lower bound exceeds
+    max_distance are skipped, see warping.dtw_distance.
 
-def principal_component_distance(series1, series2, k=2):
+    Args:
+        map_array (numpy.ndarray): Map with time as first dimension, e.g. time, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        window (int, optional): Maximal shift in time steps (Sakoe-Chiba band)
+            Defaults to None (no constraint)
+        time_weight (float, optional): Weight of the time index in the distance of two points
+            Defaults to 1.
+        max_distance (float, optional): Distances larger than this are set to numpy.inf
+            Defaults to None (compute all distances)
+
+    Returns:
+        numpy.ndarray with the Dynamic Time Warping distance of each series
+    """
+    map_array = np.asarray(map_array, dtype=float)
+    chunk_size = map_array.shape[-1] if map_array.ndim > 1 else 1
+    return warping.dtw_distance(map_array, reference_series, window, time_weight, max_distance,
+                                chunk_size)
+
+def principal_component_distance(series1, series2, k=2, include_time=True):
     """
     Compute the distance of the first k principal components between two series
 
@@ -210,25 +527,49 @@ def principal_component_distance(series1, series2, k=2):
         series2 (numpy.ndarray): Second series
         k (int): Number of Principal Components
             Defaults to 2
+        include_time (bool, optional): Embed the series with their time index, otherwise the
+                                       only principal component is the centered series
+            Defaults to True
 
     Returns:
         Distance of values mapped into the first k principal components
     """
-    series1_2d = np.zeros((len(series1), 2))
-    series1_2d[:, 0] = range(len(series1))
-    series1_2d[:, 1] = series1
-
-    series2_2d = np.zeros((len(series2), 2))
-    series2_2d[:, 0] = range(len(series2))
-    series2_2d[:, 1] = series2
-
-    pca1 = PCA().fit_transform(series1_2d)
-    pca2 = PCA().fit_transform(series2_2d)
+    pca1 = _derived(series1, ("principal_components", include_time),
+                    lambda series: _principal_components(series, include_time))
+    pca2 = _derived(series2, ("principal_components", include_time),
+                    lambda series: _principal_components(series, include_time))
 
     distance = np.sqrt(np.sum(np.square(pca1[:, :k] - pca2[:, :k])))
     return distance
 
-def maximal_information_coefficient(series1, series2):
+def principal_component_distance_map(map_array, reference_series, k=2, include_time=True):
+    """
+    Compute the distance of the first k principal components between every series of a map and
+    a reference series
+
+    Vectorized counterpart of principal_component_distance, the principal components of all
+    series are computed at once, see _principal_components.
+
+    Args:
+        map_array (numpy.ndarray): Map with time as first dimension, e.g. time, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        k (int): Number of Principal Components
+            Defaults to 2
+        include_time (bool, optional): Embed the series with their time index
+            Defaults to True
+
+    Returns:
+        numpy.ndarray with the distance of the principal components of each series
+    """
+    map_components = _principal_components(map_array, include_time)[..., :k]
+    reference_components = _principal_components(reference_series, include_time)[..., :k]
+    reference_components = reference_components.reshape(
+        (len(reference_components),) + (1,) * (map_components.ndim - 2) + (-1,))
+    difference = np.square(map_components - reference_components)
+    return np.sqrt(np.sum(difference, axis=(0, -1)))
+
+def maximal_information_coefficient(series1, series2, alpha=mic.DEFAULT_ALPHA, c=mic.DEFAULT_C,
+                                    est=mic.DEFAULT_EST):
     """
     Compute the maximal information coefficient between two series.
 
@@ -240,15 +581,37 @@ def maximal_information_coefficient(series1, series2):
     Args:
         series1 (numpy.ndarray): First series
         series2 (numpy.ndarray): Second series
+        alpha (float, optional): Exponent of the maximal grid size n^alpha, or the grid size if > 1
+            Defaults to 0.6
+        c (float, optional): Clumping factor of MINE
+            Defaults to 15
+        est (str, optional): Estimator, "mic_approx" or "mic_e"
+            Defaults to "mic_approx"
 
     Returns:
         Maximal information coefficient between the two series
     """
-    mine = minepy.MINE()
-    mine.compute_score(series1, series2)
-    return mine.mic()
+    return mic.mic(series1, series2, alpha, c, est)
 
-def randomized_dependence_coefficient(series1, series2):
+def approximate_maximal_information_coefficient(series1, series2, alpha=mic.DEFAULT_ALPHA):
+    """
+    Approximate the maximal information coefficient between two series for screening
+
+    Approximation of maximal_information_coefficient that only evaluates equal-frequency grids,
+    see mic.approximate_mic. Much faster, e.g. to find the regions worth computing MIC for.
+
+    Args:
+        series1 (numpy.ndarray): First series
+        series2 (numpy.ndarray): Second series
+        alpha (float, optional): Exponent of the maximal grid size n^alpha, or the grid size if > 1
+            Defaults to 0.6
+
+    Returns:
+        Approximate maximal information coefficient between the two series
+    """
+    return float(mic.approximate_mic(series1, series2, alpha))
+
+def randomized_dependence_coefficient(series1, series2, random_state=None):
     """
     Compute the randomized dependence coefficient between two series
 
@@ -258,17 +621,55 @@ def randomized_dependence_coefficient(series1, series2):
     Args:
         series1 (numpy.ndarray): First series
         series2 (numpy.ndarray): Second series
+        random_state (int or numpy.random.RandomState, optional): Seed of the random projections
+            Defaults to None (the global numpy random state)
 
     Returns:
         Randomized dependence coefficient between the two series
     """
-    return rdc(np.array(series1), np.array(series2))
+    #Computed like randomized_dependence_coefficient_map with series2 (the reference series in
+    #calculations) projected first, so both give the same values for the same random_state
+    series1 = np.asarray(series1, dtype=float)
+    return float(rdc_batch(np.asarray(series2, dtype=float), series1.reshape(len(series1), 1),
+                           cx=_derived(series2, "copula", copula_transform),
+                           random_state=random_state)[0])
+
+def randomized_dependence_coefficient_map(map_array, reference_series, random_state=None):
+    """
+    Compute the randomized dependence coefficient between every series of a map and a reference
+    series
+
+    Vectorized counterpart of randomized_dependence_coefficient. The copula and the random
+    projection of the reference series are computed once and one random projection is shared by
+    all series of the map, so the coefficients of different points are comparable. The canonical
+    correlations of all points are computed with batched linear algebra.
+
+    Args:
+        map_array (numpy.ndarray): Map with time as first dimension, e.g. time, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        random_state (int or numpy.random.RandomState, optional): Seed of the random projections
+            Defaults to None (the global numpy random state)
+
+    Returns:
+        numpy.ndarray with the randomized dependence coefficient of each series
+    """
+    map_array = np.asarray(map_array, dtype=float)
+    series = map_array.reshape(map_array.shape[0], -1)
+    coefficients = rdc_batch(np.asarray(reference_series, dtype=float), series,
+                             cx=_derived(reference_series, "copula", copula_transform),
+                             random_state=random_state)
+    return coefficients.reshape(map_array.shape[1:])
 
 def distance_correlation(series1, series2):
     """
     Calculate the distance correlation introduced by Gábor J. Székely between two
     time series
 
+    For two univariate series the O(n log n) algorithm of Huo and Székely is used, which does not
+    build the n x n distance matrices. Multivariate series longer than
+    DISTANCE_CORRELATION_BLOCK_SIZE are processed in blocks of rows of the distance matrices to
+    bound the memory.
+
     Args:
         series1 (numpy.ndarray): First series
         series2 (numpy.ndarray): Second series
@@ -278,8 +679,14 @@ def distance_correlation(series1, series2):
 
     Source:
         https://gist.github.com/satra/aa3d19a12b74e9ab7941
+        Huo, X., Székely, G. J. (2016): Fast computing for distance covariance. Technometrics
 
     """
+    if np.ndim(series1) == 1 and np.ndim(series2) == 1:
+        if len(series1) != len(series2):
+            raise ValueError('Number of samples must match')
+        return _fast_distance_correlation(series1, series2)
+
     series1 = np.atleast_1d(series1)
     series2 = np.atleast_1d(series2)
     if np.prod(series1.shape) == len(series1):
@@ -291,6 +698,10 @@ def distance_correlation(series1, series2):
     n = series1.shape[0]
     if series2.shape[0] != series1.shape[0]:
         raise ValueError('Number of samples must match')
+
+    if n > DISTANCE_CORRELATION_BLOCK_SIZE:
+        return _blockwise_distance_correlation(series1, series2)
+
     a = sc.squareform(sc.pdist(series1))
     b = sc.squareform(sc.pdist(series2))
     A = a - a.mean(axis=0)[None, :] - a.mean(axis=1)[:, None] + a.mean()
@@ -316,6 +727,317 @@ def shift_to_positive(series):
         return series #No need to shift
     return series - min(series)
 
+def _derived(series, name, func):
+    """
+    Derive a value from a series, using the cache if the series is a PreparedReference
+
+    Args:
+        series (numpy.ndarray): Series to derive the value from
+        name (str): Key of the derived value in the cache of a PreparedReference
+        func (function): Function that takes the series and returns the derived value
+
+    Returns:
+        Derived value
+    """
+    if isinstance(series, PreparedReference):
+        return series.derive(name, func)
+    return func(series)
+
+def _center(series):
+    """
+    Center a series and compute the norm of the centered series
+
+    Args:
+        series (numpy.ndarray): Series to center
+
+    Returns:
+        Tuple of the centered series and its Euclidean norm
+    """
+    series = np.asarray(series, dtype=float)
+    centered = series - series.mean()
+    return centered, np.linalg.norm(centered)
+
+def _principal_components(series, include_time=True):
+    """
+    Map series, embedded with their time index, into their principal components
+
+    The covariance matrix of (time index, value) is 2 x 2, so its eigenvectors are a rotation by
+    the angle 0.5 * arctan2(2 cov(t, x), var(t) - var(x)), computed for all series at once.
+    Like sklearn.decomposition.PCA (before version 1.5), the sign of each component is chosen
+    so that its largest absolute value is positive.
+
+    Args:
+        series (numpy.ndarray): Series with time as first dimension, e.g. time or time, latitude,
+                                longitude
+        include_time (bool, optional): Embed the series with their time index, otherwise the
+                                       only principal component is the centered series
+            Defaults to True
+
+    Returns:
+        numpy.ndarray with the dimensions of series and one more - principal component
+    """
+    series = np.asarray(series, dtype=float)
+    centered = series - series.mean(axis=0)
+    if not include_time:
+        return _flip_signs(centered[..., np.newaxis])
+
+    time = _expand_reference(np.arange(len(series)) - (len(series) - 1) / 2., series)
+    variance_time = np.sum(np.square(time))
+    covariance = np.sum(time * centered, axis=0)
+    variance = np.sum(np.square(centered), axis=0)
+    angle = 0.5 * np.arctan2(2 * covariance, variance_time - variance)
+    (cos, sin) = (np.cos(angle), np.sin(angle))
+    return _flip_signs(np.stack([time * cos + centered * sin, centered * cos - time * sin],
+                                axis=-1))
+
+def _flip_signs(components):
+    """
+    Flip the sign of principal components so that their value with the largest magnitude is
+    positive
+
+    Args:
+        components (numpy.ndarray): Principal components with time as first dimension
+
+    Returns:
+        numpy.ndarray with the flipped components
+    """
+    largest = np.argmax(np.abs(components), axis=0)
+    signs = np.sign(np.take_along_axis(components, largest[np.newaxis], axis=0))
+    return components * signs
+
+def _expand_reference(reference_series, map_array):
+    """
+    Reshape a reference series so that it broadcasts along the time dimension of a map
+
+    Args:
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        map_array (numpy.ndarray): Map with time as first dimension
+
+    Returns:
+        Reference series with one trailing axis of length 1 per non-time dimension of the map
+    """
+    reference_series = np.asarray(reference_series, dtype=float)
+    return reference_series.reshape((-1,) + (1,) * (np.ndim(map_array) - 1))
+
+def _fast_distance_correlation(series1, series2):
+    """
+    Calculate the distance correlation between two univariate series in O(n log n)
+
+    Implements the algorithm of Huo and Székely: the row sums of the distance matrices follow
+    from sorting, and the sum of products of distances from a merge-sort based dominance count.
+
+    Args:
+        series1 (numpy.ndarray): First series (1 dimensional)
+        series2 (numpy.ndarray): Second series (1 dimensional)
+
+    Returns:
+        Distance Correlation between the two series
+    """
+    (x, row_sums_x, sum_xx) = _derived(series1, "distance_sums", _distance_sums)
+    (y, row_sums_y, sum_yy) = _derived(series2, "distance_sums", _distance_sums)
+    n = len(x)
+
+    #Sum over all pairs of |x_i - x_j| * |y_i - y_j|
+    order = np.argsort(x, kind='mergesort')
+    x = x[order]
+    y = y[order]
+    y_keys = np.unique(y, return_inverse=True)[1].ravel()
+    weights = np.vstack([np.ones(n), x, y, x * y])
+    lower = _dominance_sums(y_keys, weights)
+    before = np.cumsum(weights, axis=1) - weights
+
+    def product_sum(sums):
+        return sums[0] * x * y - x * sums[2] - y * sums[1] + sums[3]
+
+    sum_xy = 2 * np.sum(2 * product_sum(lower) - product_sum(before))
+
+    return _distance_correlation_from_sums(n, row_sums_x, row_sums_y, sum_xy, sum_xx, sum_yy)
+
+def _blockwise_distance_correlation(series1, series2, block_size=None):
+    """
+    Calculate the distance correlation between two series holding only a block of rows of the
+    distance matrices in memory at once
+
+    Args:
+        series1 (numpy.ndarray): First series with 2 dimensions - samples, variables
+        series2 (numpy.ndarray): Second series with 2 dimensions - samples, variables
+        block_size (int, optional): Number of rows per block
+            Defaults to DISTANCE_CORRELATION_BLOCK_SIZE
+
+    Returns:
+        Distance Correlation between the two series
+    """
+    if block_size is None:
+        block_size = DISTANCE_CORRELATION_BLOCK_SIZE
+    n = series1.shape[0]
+    row_sums_x = np.zeros(n)
+    row_sums_y = np.zeros(n)
+    sum_xy = sum_xx = sum_yy = 0.
+    for start in range(0, n, block_size):
+        a = sc.cdist(series1[start:start + block_size], series1)
+        b = sc.cdist(series2[start:start + block_size], series2)
+        row_sums_x[start:start + block_size] = a.sum(axis=1)
+        row_sums_y[start:start + block_size] = b.sum(axis=1)
+        sum_xy += (a * b).sum()
+        sum_xx += (a * a).sum()
+        sum_yy += (b * b).sum()
+
+    return _distance_correlation_from_sums(n, row_sums_x, row_sums_y, sum_xy, sum_xx, sum_yy)
+
+def _distance_correlation_from_sums(n, row_sums_x, row_sums_y, sum_xy, sum_xx, sum_yy):
+    """
+    Combine sums over the distance matrices a and b into the distance correlation
+
+    Uses sum(A * B) = sum(a * b) - 2 / n * sum(a_i. * b_i.) + a.. * b.. / n^2 for the double
+    centered matrices A and B.
+
+    Args:
+        n (int): Number of samples
+        row_sums_x (numpy.ndarray): Row sums a_i. of the distance matrix of the first series
+        row_sums_y (numpy.ndarray): Row sums b_i. of the distance matrix of the second series
+        sum_xy (float): Sum of a * b
+        sum_xx (float): Sum of a * a
+        sum_yy (float): Sum of b * b
+
+    Returns:
+        Distance Correlation
+    """
+    total_x = row_sums_x.sum()
+    total_y = row_sums_y.sum()
+
+    def centered_product_sum(sum_ab, row_sums_a, row_sums_b, total_a, total_b):
+        return (sum_ab - 2. / n * np.dot(row_sums_a, row_sums_b)
+                + total_a * total_b / float(n * n))
+
+    dcov2_xy = max(centered_product_sum(sum_xy, row_sums_x, row_sums_y, total_x, total_y), 0)/float(n * n)
+    dcov2_xx = centered_product_sum(sum_xx, row_sums_x, row_sums_x, total_x, total_x)/float(n * n)
+    dcov2_yy = centered_product_sum(sum_yy, row_sums_y, row_sums_y, total_y, total_y)/float(n * n)
+    return np.sqrt(dcov2_xy)/np.sqrt(np.sqrt(dcov2_xx) * np.sqrt(dcov2_yy))
+
+def _distance_sums(series):
+    """
+    Compute the sums over the distance matrix |x_i - x_j| of a univariate series that the
+    distance correlation needs
+
+    Args:
+        series (numpy.ndarray): 1 dimensional series
+
+    Returns:
+        Tuple of the centered series, the row sums and the sum of the squared distances
+    """
+    #Distances do not change when shifting the series, centering improves the precision
+    centered = np.asarray(series, dtype=float)
+    centered = centered - centered.mean()
+    return (centered, _distance_row_sums(centered),
+            2 * len(centered) * np.sum(np.square(centered)))
+
+def _distance_row_sums(series):
+    """
+    Compute the row sums of the distance matrix |x_i - x_j| of a univariate series by sorting
+
+    Args:
+        series (numpy.ndarray): 1 dimensional series
+
+    Returns:
+        numpy.ndarray with sum_j |x_i - x_j| for every i
+    """
+    n = len(series)
+    order = np.argsort(series, kind='mergesort')
+    series_sorted = series[order]
+    sum_before = np.cumsum(series_sorted) - series_sorted
+    row_sums = np.empty(n)
+    row_sums[order] = (series_sorted * (2 * np.arange(n) - n) + series_sorted.sum()
+                       - 2 * sum_before)
+    return row_sums
+
+def _dominance_sums(keys, weights):
+    """
+    For every position j, sum the weights of all positions i < j with keys[i] < keys[j]
+
+    Bottom-up merge sort: on every level the left halves of all blocks are sorted at once and the
+    right halves look up their partial sums with np.searchsorted. Takes O(n log^2 n).
+
+    Args:
+        keys (numpy.ndarray): Integer keys in [0, n)
+        weights (numpy.ndarray): Weights with 2 dimensions - weight, position
+
+    Returns:
+        numpy.ndarray with the summed weights, same shape as weights
+    """
+    n = len(keys)
+    index = np.arange(n)
+    sums = np.zeros(weights.shape)
+    width = 1
+    while width < n:
+        block = index // (2 * width)
+        in_right = (index // width) % 2 == 1
+        composite_keys = block * n + keys
+
+        left_order = np.argsort(composite_keys[~in_right], kind='mergesort')
+        left_keys = composite_keys[~in_right][left_order]
+        left_cumsum = np.zeros((weights.shape[0], len(left_keys) + 1))
+        left_cumsum[:, 1:] = np.cumsum(weights[:, ~in_right][:, left_order], axis=1)
+
+        upper = np.searchsorted(left_keys, composite_keys[in_right], side='left')
+        lower = np.searchsorted(left_keys, block[in_right] * n, side='left')
+        sums[:, in_right] += left_cumsum[:, upper] - left_cumsum[:, lower]
+        width *= 2
+    return sums
+
+def _count_inversions(values):
+    """
+    Sort every row and count the pairs i < j with values[i] > values[j] with a bottom-up merge sort
+
+    Args:
+        values (numpy.ndarray): Array with 2 dimensions - row, position
+
+    Returns:
+        Tuple of the sorted values and the number of inversions per row
+    """
+    (len_rows, len_values) = values.shape
+    size = 1
+    while size < len_values:
+        size *= 2
+    #Padding at the end never forms an inversion
+    padded = np.full((len_rows, size), np.inf)
+    padded[:, :len_values] = values
+
+    inversions = np.zeros(len_rows)
+    width = 1
+    while width < size:
+        num_blocks = size // (2 * width)
+        blocks = padded.reshape(len_rows, num_blocks, 2 * width)
+        #Stable merge of the two sorted halves, equal values of the left half come first
+        order = np.argsort(blocks, axis=-1, kind='mergesort')
+        #A right element at index r that ends up at position p passes width - (p - r) left elements
+        right_positions = np.dot(order >= width, np.arange(2 * width, dtype=float))
+        inversions += (num_blocks * (width * width + width * (width - 1) / 2.)
+                       - right_positions.sum(axis=1))
+        padded = np.take_along_axis(blocks, order, axis=-1).reshape(len_rows, size)
+        width *= 2
+    return padded[:, :len_values], inversions
+
+def _count_tied_pairs(values, groups=None):
+    """
+    Count the pairs of equal values per row of a sorted array
+
+    Args:
+        values (numpy.ndarray): Array with 2 dimensions - row, position; sorted along position
+        groups (numpy.ndarray, optional): Group number per position. If given, only pairs that
+                                          also share the group are counted.
+            Defaults to None
+
+    Returns:
+        numpy.ndarray with the number of tied pairs per row
+    """
+    index = np.arange(values.shape[1])
+    new_run = np.ones(values.shape, dtype=bool)
+    new_run[:, 1:] = values[:, 1:] != values[:, :-1]
+    if groups is not None:
+        new_run[:, 1:] |= groups[1:] != groups[:-1]
+    run_start = np.maximum.accumulate(np.where(new_run, index, 0), axis=1)
+    return np.sum(index - run_start, axis=1).astype(float)
+
 def normalize(series):
     """
     Normalize time series
@@ -330,3 +1052,101 @@ def normalize(series):
     if norm == 0:
         return series
     return series / norm
+
+#Approximate cost of the point-wise similarity measures: seconds per pair of series with 500
+#time steps and the order in which it grows with the length of the series.
+#Used to choose how the computation of a map is executed, see execution.default_execution.
+DEFAULT_MEASURE_COST = (1e-3, 1)
+
+#Number of samples up to which distance_correlation builds the full distance matrices
+#of multivariate series
+DISTANCE_CORRELATION_BLOCK_SIZE = 1024
+
+#Names of the measures for which smaller values mean more similar series
+DISTANCE_MEASURES = {"manhattan_distance", "euclidean_distance", "dynamic_time_warping_distance",
+                     "principal_component_distance"}
+
+#Vectorized counterparts of the pairwise similarity measures.
+#calculations.calculate_series_similarity uses them automatically for the registered measures.
+MAP_MEASURES = {
+    pearson_correlation: pearson_correlation_map,
+    pearson_correlation_abs: pearson_correlation_abs_map,
+    covariance: covariance_map,
+    spearman_correlation: spearman_correlation_map,
+    kendall_tau: kendall_tau_map,
+    manhattan_distance: manhattan_distance_map,
+    euclidean_distance: euclidean_distance_map,
+    cosine_similarity: cosine_similarity_map,
+    randomized_dependence_coefficient: randomized_dependence_coefficient_map,
+    mutual_information: information.mutual_information,
+    transfer_entropy: information.transfer_entropy,
+    conditional_entropy: information.conditional_entropy,
+    dynamic_time_warping_distance: dynamic_time_warping_distance_map,
+    principal_component_distance: principal_component_distance_map,
+    maximal_information_coefficient: mic.mic_map,
+    approximate_maximal_information_coefficient: mic.approximate_mic,
+}
+
+MEASURE_COSTS = {
+    pearson_correlation: (3e-5, 1),
+    pearson_correlation_abs: (3e-5, 1),
+    covariance: (3e-5, 1),
+    spearman_correlation: (2.5e-4, 1),
+    kendall_tau: (1e-3, 1),
+    manhattan_distance: (1e-5, 1),
+    euclidean_distance: (1e-5, 1),
+    cosine_similarity: (1.5e-5, 1),
+    mutual_information: (1e-4, 1),
+    transfer_entropy: (1.2e-4, 1),
+    conditional_entropy: (1e-4, 1),
+    dynamic_time_warping_distance: (2e-2, 2),
+    principal_component_distance: (5e-4, 1),
+    maximal_information_coefficient: (5e-2, 2),
+    approximate_maximal_information_coefficient: (5e-4, 1),
+    randomized_dependence_coefficient: (3e-3, 1),
+    distance_correlation: (1e-3, 1),
+}
+
+def get_measure_cost(sim_func, len_time=500):
+    """
+    Estimate the time it takes to compare two series with a similarity measure
+
+    Args:
+        sim_func (function): Similarity measure that compares two series
+        len_time (int, optional): Length of the series
+            Defaults to 500
+
+    Returns:
+        Estimated duration in seconds, based on MEASURE_COSTS
+    """
+    if isinstance(sim_func, functools.partial):
+        sim_func = sim_func.func
+    try:
+        (cost, order) = MEASURE_COSTS.get(sim_func, DEFAULT_MEASURE_COST)
+    except TypeError: #Unhashable callables can not be looked up
+        (cost, order) = DEFAULT_MEASURE_COST
+    return cost * (len_time / 500.) ** order
+
+def get_map_measure(sim_func):
+    """
+    Look up the vectorized counterpart of a similarity measure
+
+    A functools.partial of a registered measure with keyword arguments (e.g. a seed) is mapped
+    to the same partial of its vectorized counterpart.
+
+    Args:
+        sim_func (function): Similarity measure that compares two series
+
+    Returns:
+        Function that takes a map with time as first dimension and a reference series and returns
+        the similarity of every series on the map, or None if sim_func has no vectorized counterpart
+    """
+    if isinstance(sim_func, functools.partial):
+        map_func = None if sim_func.args else get_map_measure(sim_func.func)
+        if map_func is None:
+            return None
+        return functools.partial(map_func, **sim_func.keywords)
+    try:
+        return MAP_MEASURES.get(sim_func)
+    except TypeError: #Unhashable callables can not be looked up
+        return None
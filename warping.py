@@ -0,0 +1,170 @@
+"""
+Module with a dynamic time warping engine for many series and a reference series
+
+The cumulative cost matrices of all series are filled anti-diagonal by anti-diagonal, so each
+step updates all series at once and only the last two anti-diagonals are kept. Warping can be
+constrained to a Sakoe-Chiba band, which bounds time and memory by the width of the band.
+With a maximal distance, series are skipped if their LB_Keogh lower bound exceeds it and
+abandoned as soon as every warping path exceeds it.
+
+The cost of matching x_i with y_j is the Euclidean distance of the points (i, x_i) and (j, y_j)
+with the time index weighted by time_weight, like similaritymeasures.dtw of the series embedded
+with their time index for time_weight=1. time_weight=0 gives the classic cost |x_i - y_j|.
+"""
+import numpy as np
+from scipy.ndimage import maximum_filter1d, minimum_filter1d
+
+
+def dtw_distance(map_array, reference_series, window=None, time_weight=1., max_distance=None,
+                 chunk_size=256):
+    """
+    Compute the dynamic time warping distance between every series of a map and a reference series
+
+    Args:
+        map_array (numpy.ndarray): Map with time as first dimension, e.g. time, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        window (int, optional): Radius of the Sakoe-Chiba band, the maximal shift in time steps
+            Defaults to None (no constraint)
+        time_weight (float, optional): Weight of the time index in the cost of a match
+            Defaults to 1.
+        max_distance (float, optional): Distances larger than this are not computed but set to
+                                        numpy.inf
+            Defaults to None (compute all distances)
+        chunk_size (int, optional): Number of series processed at once, e.g. one latitude
+            Defaults to 256
+
+    Returns:
+        numpy.ndarray with the dimensions of map_array except time containing the distance
+        between each series and the reference series
+    """
+    map_array = np.asarray(map_array, dtype=float)
+    reference = np.asarray(reference_series, dtype=float)
+    series = np.ascontiguousarray(map_array.reshape(map_array.shape[0], -1).T)
+
+    candidates = np.arange(series.shape[0])
+    if max_distance is not None and window is not None and series.shape[1] == len(reference):
+        bounds = lb_keogh(series.T, reference, window, envelope(reference, window))
+        candidates = candidates[bounds <= max_distance]
+
+    distances = np.full(series.shape[0], np.inf)
+    for start in range(0, len(candidates), chunk_size):
+        indices = candidates[start:start + chunk_size]
+        distances[indices] = _dtw_rows(series[indices], reference, window, time_weight,
+                                       max_distance)
+    return distances.reshape(map_array.shape[1:])
+
+
+def envelope(reference_series, window):
+    """
+    Compute the LB_Keogh envelope of a series: the minimum and maximum within window time steps
+
+    Args:
+        reference_series (numpy.ndarray): 1 dimensional series
+        window (int): Radius of the Sakoe-Chiba band
+
+    Returns:
+        Tuple of the lower and the upper envelope
+    """
+    reference = np.asarray(reference_series, dtype=float)
+    size = 2 * int(window) + 1
+    return (minimum_filter1d(reference, size, mode='nearest'),
+            maximum_filter1d(reference, size, mode='nearest'))
+
+
+def lb_keogh(map_array, reference_series, window, reference_envelope=None):
+    """
+    Compute the LB_Keogh lower bound of the dynamic time warping distance within a Sakoe-Chiba
+    band between every series of a map and a reference series of the same length
+
+    Every value of a series is matched at least once with a value of the reference series
+    within the band, so its distance to the envelope is a lower bound of its cost.
+
+    Args:
+        map_array (numpy.ndarray): Map with time as first dimension, e.g. time, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        window (int): Radius of the Sakoe-Chiba band
+        reference_envelope (tuple, optional): Envelope of the reference series, to reuse it
+            Defaults to None (computed with envelope)
+
+    Returns:
+        numpy.ndarray with the lower bound for each series
+    """
+    map_array = np.asarray(map_array, dtype=float)
+    (lower, upper) = (envelope(reference_series, window) if reference_envelope is None
+                      else reference_envelope)
+    shape = (-1,) + (1,) * (map_array.ndim - 1)
+    excess = (np.maximum(map_array - upper.reshape(shape), 0)
+              + np.maximum(lower.reshape(shape) - map_array, 0))
+    return excess.sum(axis=0)
+
+
+def _dtw_rows(rows, reference, window=None, time_weight=1., max_distance=None):
+    """
+    Compute the dynamic time warping distance between every row and a reference series
+
+    The cumulative cost of a match (i, j) is kept on anti-diagonal s = i + j at the offset
+    d = i - j. Its predecessors (i - 1, j), (i, j - 1) and (i - 1, j - 1) lie on the previous
+    anti-diagonal at the offsets d - 1 and d + 1 and on the one before at offset d.
+
+    Args:
+        rows (numpy.ndarray): 2 dimensional array - series, time
+        reference (numpy.ndarray): 1 dimensional reference series
+        window (int, optional): Radius of the Sakoe-Chiba band
+            Defaults to None (no constraint)
+        time_weight (float, optional): Weight of the time index in the cost of a match
+            Defaults to 1.
+        max_distance (float, optional): Abandon rows once their distance exceeds this
+            Defaults to None
+
+    Returns:
+        numpy.ndarray with the distance of each row, numpy.inf for abandoned rows
+    """
+    (n_rows, len_series) = rows.shape
+    len_reference = len(reference)
+    band = max(len_series, len_reference) if window is None else int(window)
+    offsets = np.arange(-min(band, len_reference - 1), min(band, len_series - 1) + 1)
+    distances = np.full(n_rows, np.inf)
+    if not offsets[0] <= len_series - len_reference <= offsets[-1]:
+        return distances #The last values can not be matched within the band
+
+    active = np.arange(n_rows)
+    padding = np.full((n_rows, 1), np.inf)
+    previous = np.full((n_rows, len(offsets)), np.inf)
+    before_previous = previous.copy()
+    for diagonal in range(len_series + len_reference - 1):
+        i = diagonal + offsets
+        valid = (i % 2 == 0)
+        i //= 2
+        j = i - offsets
+        valid &= (i >= 0) & (i < len_series) & (j >= 0) & (j < len_reference)
+        positions = np.flatnonzero(valid)
+        (i, j) = (i[positions], j[positions])
+
+        cost = np.sqrt(np.square(rows[:, i] - reference[j])
+                       + np.square(time_weight * (i - j)))
+        if diagonal == 0:
+            predecessor = np.zeros_like(cost)
+        else:
+            padded = np.hstack([padding, previous, padding])
+            predecessor = np.minimum(np.minimum(padded[:, positions], padded[:, positions + 2]),
+                                     before_previous[:, positions])
+        current = np.full(previous.shape, np.inf)
+        current[:, positions] = cost + predecessor
+        (before_previous, previous) = (previous, current)
+
+        if max_distance is not None:
+            #Every warping path passes through one of two consecutive anti-diagonals
+            frontier = np.minimum(previous.min(axis=1), before_previous.min(axis=1))
+            keep = frontier <= max_distance
+            if not np.all(keep):
+                (rows, previous, before_previous) = (rows[keep], previous[keep],
+                                                     before_previous[keep])
+                (active, padding) = (active[keep], padding[keep])
+                if len(active) == 0:
+                    return distances
+
+    end = np.flatnonzero(offsets == len_series - len_reference)[0]
+    distances[active] = previous[:, end]
+    if max_distance is not None:
+        distances[distances > max_distance] = np.inf
+    return distances
@@ -0,0 +1,250 @@
+"""
+Module to compute similarities between a map and a reference series in sliding time windows
+
+Measures registered in WINDOW_MEASURES only depend on a few sums over the window, e.g. Pearson's
+correlation on the sums of x, y, x * x, y * y and x * y. These sums are updated incrementally from
+one window to the next by adding the time steps entering the window and subtracting the ones
+leaving it, so each step costs O(step) per series instead of O(window). To bound the rounding
+errors of long updates, the sums are recomputed exactly once per window length. Products for
+Pearson's correlation and the covariance use the series centered by their overall mean, which
+does not change these measures but avoids cancellation.
+
+Other measures are computed from scratch for every window, see
+calculations.calculate_series_similarities_in_windows.
+"""
+import numpy as np
+import similarity_measures
+
+#Terms of the running sums: centered values (x, y) and their products, raw products for the
+#cosine similarity and differences (d = x - y) for the distances
+TERMS = ["x", "y", "xx", "yy", "xy", "raw_xx", "raw_yy", "raw_xy", "dd", "absolute_d"]
+
+#Variances of a window below this fraction of the largest possible sum of squared centered values
+#(max_xx, max_yy of running_sums) are rounding errors of the updates and treated as 0
+VARIANCE_TOLERANCE = 1e-10
+
+
+def window_starts(len_time, window, step=1):
+    """
+    Compute the first time steps of all complete windows
+
+    Args:
+        len_time (int): Length of the series
+        window (int): Length of a window in time steps, e.g. 120 for 10 years of monthly values
+        step (int, optional): Number of time steps between the starts of two windows
+            Defaults to 1
+
+    Returns:
+        numpy.ndarray with the first time step of each window
+    """
+    if window < 2 or step < 1:
+        raise ValueError("Window length {} must be at least 2 and step {} at least 1"
+                         .format(window, step))
+    return np.arange(0, len_time - window + 1, step)
+
+
+def running_sums(map_array, reference_series, window, step=1, terms=("x", "y", "xx", "yy", "xy")):
+    """
+    Iterate over the sums of terms over sliding windows, updating them incrementally
+
+    Args:
+        map_array (numpy.ndarray): Map with time as first dimension, e.g. time, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        window (int): Length of a window in time steps
+        step (int, optional): Number of time steps between the starts of two windows
+            Defaults to 1
+        terms (list, optional): Terms to sum, see TERMS
+            Defaults to the terms of Pearson's correlation
+
+    Yields:
+        Dictionary of the sums of every term over the window, with the dimensions of map_array
+        except time (scalars for terms of the reference series only). For xx and yy, it also
+        contains window times the largest value of the term (max_xx, max_yy), which bounds the
+        rounding errors of the updates.
+    """
+    values = _term_values(map_array, reference_series, terms)
+    bounds = {"max_" + term: window * values[term].max(axis=0)
+              for term in ("xx", "yy") if term in terms}
+    (sums, exact_start) = (None, 0)
+    for start in window_starts(len(values[terms[0]]), window, step):
+        if sums is None or start - exact_start >= window:
+            sums = {term: values[term][start:start + window].sum(axis=0) for term in terms}
+            exact_start = start
+        else:
+            previous = start - step
+            #Windows overlap, so the steps leaving and entering are disjoint ranges
+            for term in terms:
+                sums[term] = (sums[term] + values[term][previous + window:start + window].sum(axis=0)
+                              - values[term][previous:start].sum(axis=0))
+        yield dict(sums, **bounds)
+
+
+def rolling_similarities(map_array, reference_series, window, measures, step=1, out=None):
+    """
+    Compute measures of WINDOW_MEASURES between every series of a map and a reference series in
+    sliding windows
+
+    Args:
+        map_array (numpy.ndarray): Map with time as first dimension, e.g. time, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series
+        window (int): Length of a window in time steps
+        measures (list): Similarity measures registered in WINDOW_MEASURES
+        step (int, optional): Number of time steps between the starts of two windows
+            Defaults to 1
+        out (numpy.ndarray, optional): Array with dimensions measure, window and the dimensions of
+                                       map_array except time the similarities are written to
+            Defaults to None (a new array is allocated)
+
+    Returns:
+        numpy.ndarray (out, if given) with dimensions measure, window and the dimensions of
+        map_array except time
+    """
+    map_array = np.asarray(map_array, dtype=float)
+    (sum_funcs, terms) = ([], [])
+    for measure in measures:
+        (measure_terms, sum_func) = WINDOW_MEASURES[measure]
+        sum_funcs.append(sum_func)
+        terms.extend(term for term in measure_terms if term not in terms)
+
+    starts = window_starts(len(map_array), window, step)
+    if out is None:
+        out = np.zeros((len(measures), len(starts)) + map_array.shape[1:])
+    for (i, sums) in enumerate(running_sums(map_array, reference_series, window, step, terms)):
+        for (j, sum_func) in enumerate(sum_funcs):
+            out[j, i] = sum_func(sums, window)
+    return out
+
+
+def get_window_measure(sim_func):
+    """
+    Look up whether a similarity measure can be computed from running sums
+
+    Args:
+        sim_func (function): Similarity measure that compares two series
+
+    Returns:
+        True if sim_func is registered in WINDOW_MEASURES
+    """
+    try:
+        return sim_func in WINDOW_MEASURES
+    except TypeError: #Unhashable callables can not be looked up
+        return False
+
+
+def _term_values(map_array, reference_series, terms):
+    """
+    Compute the values of terms at every time step, which running_sums sums over the windows
+
+    Args:
+        map_array (numpy.ndarray): Map with time as first dimension, e.g. time, latitude, longitude
+        reference_series (numpy.ndarray): 1 dimensional reference series, cut to the length of
+                                          map_array
+        terms (list): Terms to compute, see TERMS
+
+    Returns:
+        Dictionary of the values of every term per time step, with the dimensions of map_array
+        (1 dimensional for terms of the reference series only)
+    """
+    x = map_array.reshape(map_array.shape[0], -1)
+    y = np.asarray(reference_series, dtype=float)[:len(x)]
+    shape = (len(x),) + map_array.shape[1:]
+    (centered_x, centered_y) = (x - x.mean(axis=0), y - y.mean())
+    factors = {
+        "x": lambda: centered_x,
+        "y": lambda: centered_y,
+        "xx": lambda: np.square(centered_x),
+        "yy": lambda: np.square(centered_y),
+        "xy": lambda: centered_x * centered_y[:, np.newaxis],
+        "raw_xx": lambda: np.square(x),
+        "raw_yy": lambda: np.square(y),
+        "raw_xy": lambda: x * y[:, np.newaxis],
+        "dd": lambda: np.square(x - y[:, np.newaxis]),
+        "absolute_d": lambda: np.abs(x - y[:, np.newaxis]),
+    }
+    values = {}
+    for term in terms:
+        term_values = factors[term]()
+        values[term] = term_values if term_values.ndim == 1 else term_values.reshape(shape)
+    return values
+
+
+def _covariance(sums, length):
+    """
+    Compute the sum of the products of the deviations from the window means
+
+    Args:
+        sums (dict): Sums of the terms x, y and xy over the window, see running_sums
+        length (int): Length of the window
+
+    Returns:
+        numpy.ndarray with the unnormalized covariance of each series
+    """
+    return sums["xy"] - sums["x"] * sums["y"] / length
+
+
+def _pearson_correlation(sums, length):
+    """
+    Compute Pearson's correlation from running sums
+
+    Args:
+        sums (dict): Sums of the terms x, y, xx, yy and xy over the window and the bounds
+                     max_xx and max_yy, see running_sums
+        length (int): Length of the window
+
+    Returns:
+        numpy.ndarray with the correlation of each series, NaN if a series is constant in the
+        window
+    """
+    variance = (_variance(sums["x"], sums["xx"], sums["max_xx"], length)
+                * _variance(sums["y"], sums["yy"], sums["max_yy"], length))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correlation = _covariance(sums, length) / np.sqrt(variance)
+    return np.where(variance > 0, np.clip(correlation, -1, 1), np.nan)
+
+
+def _variance(sums_x, sums_xx, max_xx, length):
+    """
+    Compute the sum of the squared deviations from the window mean
+
+    Args:
+        sums_x (numpy.ndarray): Sum of the centered values (term x or y) over the window
+        sums_xx (numpy.ndarray): Sum of their squares (term xx or yy) over the window
+        max_xx (numpy.ndarray): Bound of the rounding errors of sums_xx (max_xx or max_yy)
+        length (int): Length of the window
+
+    Returns:
+        numpy.ndarray with the unnormalized variance, 0 for constant series
+    """
+    variance = sums_xx - np.square(sums_x) / length
+    #Running updates leave a rounding residue in windows of constant series, the variance
+    #of the exact sums would be 0 and the correlation NaN
+    return np.where(variance <= VARIANCE_TOLERANCE * max_xx, 0, variance)
+
+
+def _cosine_similarity(sums, _):
+    """
+    Compute the Cosine similarity from running sums
+
+    Args:
+        sums (dict): Sums of the terms raw_xx, raw_yy and raw_xy over the window, see running_sums
+        _ (int): Length of the window, not needed
+
+    Returns:
+        numpy.ndarray with the Cosine similarity of each series
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        similarity = sums["raw_xy"] / np.sqrt(sums["raw_xx"] * sums["raw_yy"])
+    return np.clip(similarity, -1, 1)
+
+
+#Measures computed from running sums: terms and function of the sums and the window length
+WINDOW_MEASURES = {
+    similarity_measures.pearson_correlation: (["x", "y", "xx", "yy", "xy"], _pearson_correlation),
+    similarity_measures.pearson_correlation_abs:
+        (["x", "y", "xx", "yy", "xy"], lambda sums, length: np.abs(_pearson_correlation(sums, length))),
+    similarity_measures.covariance:
+        (["x", "y", "xy"], lambda sums, length: _covariance(sums, length) / (length - 1)),
+    similarity_measures.cosine_similarity: (["raw_xx", "raw_yy", "raw_xy"], _cosine_similarity),
+    similarity_measures.euclidean_distance: (["dd"], lambda sums, _: np.sqrt(np.maximum(sums["dd"], 0))),
+    similarity_measures.manhattan_distance: (["absolute_d"], lambda sums, _: sums["absolute_d"]),
+}